@@ -11,24 +11,27 @@ $(function() {
 
 	var cancellationToken = null;
 	var requests = [];
+	var currentJob = null;
+	var jobLogIndex = 0;
+	var jobEvents = null;
 
 	var sources = {
 
-		"🗺️ Bing Maps Road": "http://ecn.t0.tiles.virtualearth.net/tiles/r{quad}.jpeg?g=129&mkt=en&stl=H",
-		"🛰️ Bing Maps Satellite": "http://ecn.t0.tiles.virtualearth.net/tiles/a{quad}.jpeg?g=129&mkt=en&stl=H",
-		"🏙️ Bing Maps Hybrid": "http://ecn.t0.tiles.virtualearth.net/tiles/h{quad}.jpeg?g=129&mkt=en&stl=H",
+		"🗺️ Bing Maps Road": "http://ecn.t{switch:0,1,2,3}.tiles.virtualearth.net/tiles/r{quad}.jpeg?g=129&mkt=en&stl=H",
+		"🛰️ Bing Maps Satellite": "http://ecn.t{switch:0,1,2,3}.tiles.virtualearth.net/tiles/a{quad}.jpeg?g=129&mkt=en&stl=H",
+		"🏙️ Bing Maps Hybrid": "http://ecn.t{switch:0,1,2,3}.tiles.virtualearth.net/tiles/h{quad}.jpeg?g=129&mkt=en&stl=H",
 
 		"div-1B": "",
 
-		"📍 Google Maps (Download Only)": "https://mt0.google.com/vt?lyrs=m&x={x}&s=&y={y}&z={z}",
-		"🛰️ Google Maps Satellite (Download Only)": "https://mt0.google.com/vt?lyrs=s&x={x}&s=&y={y}&z={z}",
-		"🏙️ Google Maps Hybrid (Download Only)": "https://mt0.google.com/vt?lyrs=h&x={x}&s=&y={y}&z={z}",
-		"🏔️ Google Maps Terrain (Download Only)": "https://mt0.google.com/vt?lyrs=p&x={x}&s=&y={y}&z={z}",
+		"📍 Google Maps (Download Only)": "https://mt{switch:0,1,2,3}.google.com/vt?lyrs=m&x={x}&s=&y={y}&z={z}",
+		"🛰️ Google Maps Satellite (Download Only)": "https://mt{switch:0,1,2,3}.google.com/vt?lyrs=s&x={x}&s=&y={y}&z={z}",
+		"🏙️ Google Maps Hybrid (Download Only)": "https://mt{switch:0,1,2,3}.google.com/vt?lyrs=h&x={x}&s=&y={y}&z={z}",
+		"🏔️ Google Maps Terrain (Download Only)": "https://mt{switch:0,1,2,3}.google.com/vt?lyrs=p&x={x}&s=&y={y}&z={z}",
 
 		"div-2": "",
 
-		"🗺️ Open Street Maps": "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png",
-		"🚴 Open Cycle Maps": "http://a.tile.opencyclemap.org/cycle/{z}/{x}/{y}.png",
+		"🗺️ Open Street Maps": "https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png",
+		"🚴 Open Cycle Maps": "http://{s}.tile.opencyclemap.org/cycle/{z}/{x}/{y}.png",
 		"🚌 Open PT Transport": "http://openptmap.org/tiles/{z}/{x}/{y}.png",
 
 		"div-3": "",
@@ -40,7 +43,7 @@ $(function() {
 		"div-4": "",
 
 		"💡 Carto Light": "http://cartodb-basemaps-c.global.ssl.fastly.net/light_all/{z}/{x}/{y}.png",
-		"🎨 Stamen Toner B&W": "http://a.tile.stamen.com/toner/{z}/{x}/{y}.png",
+		"🎨 Stamen Toner B&W": "http://{s}.tile.stamen.com/toner/{z}/{x}/{y}.png",
 
 	};
 
@@ -166,6 +169,20 @@ $(function() {
 
 	}
 
+	function expandShards(url) {
+		// {s} and {switch:a,b,c} become one template per host, which mapbox spreads tiles over
+		var match = url.match(/\{(s|switch:[^}]*)\}/);
+		if (!match) {
+			return [url];
+		}
+
+		var choices = match[1] == "s" ? ["a", "b", "c"] : match[1].substring("switch:".length).split(",");
+
+		return choices.map(function(choice) {
+			return url.replace(match[0], choice.trim());
+		});
+	}
+
 	function switchMapSource(url, name) {
 		if (!url || url === "") return;
 
@@ -205,7 +222,7 @@ $(function() {
 			// Add the custom tile source
 			map.addSource('custom-tiles', {
 				'type': 'raster',
-				'tiles': [tileUrl],
+				'tiles': expandShards(tileUrl),
 				'tileSize': 256,
 				'attribution': name
 			});
@@ -430,28 +447,6 @@ $(function() {
 		return tileArray;
 	}
 
-	function getPolygonByBounds(bounds) {
-
-		var tilePolygonData = getArrayByBounds(bounds);
-
-		var polygon = turf.polygon([tilePolygonData]);
-
-		return polygon;
-	}
-
-	function isTileInSelection(tileRect) {
-
-		var polygon = getPolygonByBounds(tileRect);
-
-		var areaPolygon = draw.getAll().features[0];
-
-		if(turf.booleanDisjoint(polygon, areaPolygon) == false) {
-			return true;
-		}
-
-		return false;
-	}
-
 	function getBounds() {
 
 		if(draw.getAll().features.length === 0) {
@@ -467,61 +462,65 @@ $(function() {
 		return bounds;
 	}
 
-	function getGrid(zoomLevel) {
+	function fetchCoverage(minZoom, maxZoom, countOnly) {
 
-		var bounds = getBounds();
-		if (!bounds) {
-			return [];
-		}
+		var feature = draw.getAll().features[0];
 
-		var rects = [];
+		return $.ajax({
+			url: countOnly ? "/coverage?count=1" : "/coverage",
+			async: true,
+			timeout: 60 * 1000,
+			type: "post",
+			contentType: "application/json",
+			processData: false,
+			data: JSON.stringify({
+				geometry: feature.geometry,
+				minZoom: minZoom,
+				maxZoom: maxZoom,
+			}),
+			dataType: 'json',
+		});
+	}
 
-		var outputScale = $("#output-scale").val();
-		//var thisZoom = zoomLevel - (outputScale-1)
-		var thisZoom = zoomLevel
+	function tilesFromCoverage(coverage) {
 
-		var TY    = lat2tile(bounds.getNorthEast().lat, thisZoom);
-		var LX   = long2tile(bounds.getSouthWest().lng, thisZoom);
-		var BY = lat2tile(bounds.getSouthWest().lat, thisZoom);
-		var RX  = long2tile(bounds.getNorthEast().lng, thisZoom);
+		var tiles = [];
 
-		for(var y = TY; y <= BY; y++) {
-			for(var x = LX; x <= RX; x++) {
+		for(var z in coverage.zooms) {
+			var columns = coverage.zooms[z];
 
-				var rect = getTileRect(x, y, thisZoom);
+			for(var i = 0; i < columns.length; i++) {
+				var x = columns[i][0];
 
-				if(isTileInSelection(rect)) {
-					rects.push({
+				for(var y = columns[i][1]; y <= columns[i][2]; y++) {
+					tiles.push({
 						x: x,
 						y: y,
-						z: thisZoom,
-						rect: rect,
+						z: parseInt(z),
 					});
 				}
-
 			}
 		}
 
-		return rects
+		return tiles;
 	}
 
-	function getAllGridTiles() {
-		var allTiles = [];
+	async function getGrid(zoomLevel) {
 
-		for(var z = getMinZoom(); z <= getMaxZoom(); z++) {
-			var grid = getGrid(z);
-			// TODO shuffle grid via a heuristic (hamlet curve? :/)
-			allTiles = allTiles.concat(grid);
+		if (!getBounds()) {
+			return [];
 		}
 
-		return allTiles;
+		var coverage = await fetchCoverage(zoomLevel, zoomLevel);
+
+		return tilesFromCoverage(coverage);
 	}
 
 	function removeGrid() {
 		removeLayer("grid-preview");
 	}
 
-	function previewGrid() {
+	async function previewGrid() {
 
 		if(draw.getAll().features.length === 0) {
 			M.toast({html: 'Draw a rectangle first.', displayLength: 3000});
@@ -529,13 +528,20 @@ $(function() {
 		}
 
 		var maxZoom = getMaxZoom();
-		var grid = getGrid(maxZoom);
+		var grid;
+
+		try {
+			grid = await getGrid(maxZoom);
+		} catch(e) {
+			M.toast({html: (e.responseJSON && e.responseJSON.message) || 'Could not compute the grid.', displayLength: 4000});
+			return;
+		}
 
 		var pointsCollection = []
 
 		for(var i in grid) {
 			var feature = grid[i];
-			var array = getArrayByBounds(feature.rect);
+			var array = getArrayByBounds(getTileRect(feature.x, feature.y, feature.z));
 			pointsCollection.push(array);
 		}
 
@@ -555,34 +561,12 @@ $(function() {
 			}
 		});
 
-		var totalTiles = getAllGridTiles().length;
+		var coverage = await fetchCoverage(getMinZoom(), maxZoom, true);
+		var totalTiles = coverage.count;
 		M.toast({html: 'Total ' + totalTiles.toLocaleString() + ' tiles in the region.', displayLength: 5000})
 
 	}
 
-	function previewRect(rectInfo) {
-
-		var array = getArrayByBounds(rectInfo.rect);
-
-		var id = "temp-" + rectInfo.x + '-' + rectInfo.y + '-' + rectInfo.z;
-
-		map.addLayer({
-			'id': id,
-			'type': 'line',
-			'source': {
-				'type': 'geojson',
-				'data': turf.polygon([array]),
-			},
-			'layout': {},
-			'paint': {
-				"line-color": "#ff9f1a",
-				"line-width": 3,
-			}
-		});
-
-		return id;
-	}
-
 	function removeLayer(id) {
 		if(map.getSource(id) != null) {
 			map.removeLayer(id);
@@ -590,23 +574,6 @@ $(function() {
 		}
 	}
 
-	function generateQuadKey(x, y, z) {
-	    var quadKey = [];
-	    for (var i = z; i > 0; i--) {
-	        var digit = '0';
-	        var mask = 1 << (i - 1);
-	        if ((x & mask) != 0) {
-	            digit++;
-	        }
-	        if ((y & mask) != 0) {
-	            digit++;
-	            digit++;
-	        }
-	        quadKey.push(digit);
-	    }
-	    return quadKey.join('');
-	}
-
 	function initializeDownloader() {
 
 		bar = new ProgressBar.Circle($('#progress-radial').get(0), {
@@ -662,143 +629,166 @@ $(function() {
 		$("#download-sidebar").show();
 		$(".tile-strip").html("");
 		$("#stop-button").html("STOP");
+		$("#download-rate").text("Please wait...");
 		removeGrid();
 		clearLogs();
 		M.Toast.dismissAll();
 
 		var timestamp = Date.now().toString();
 
-		var allTiles = getAllGridTiles();
-		updateProgress(0, allTiles.length);
+		updateProgress(0, 0);
 
 		var numThreads = parseInt($("#parallel-threads-box").val());
 		var outputDirectory = $("#output-directory-box").val();
 		var outputFile = $("#output-file-box").val();
 		var outputType = $("#output-type").val();
 		var outputScale = $("#output-scale").val();
+		var overviewFromMaxZoom = $("#lower-zooms").val() == "overview";
 		var source = $("#source-box").val()
 
 		var bounds = getBounds();
 		var boundsArray = [bounds.getSouthWest().lng, bounds.getSouthWest().lat, bounds.getNorthEast().lng, bounds.getNorthEast().lat]
 		var centerArray = [bounds.getCenter().lng, bounds.getCenter().lat, getMaxZoom()]
-		
-		var data = new FormData();
-		data.append('minZoom', getMinZoom())
-		data.append('maxZoom', getMaxZoom())
-		data.append('outputDirectory', outputDirectory)
-		data.append('outputFile', outputFile)
-		data.append('outputType', outputType)
-		data.append('outputScale', outputScale)
-		data.append('source', source)
-		data.append('timestamp', timestamp)
-		data.append('bounds', boundsArray.join(","))
-		data.append('center', centerArray.join(","))
-
-		var request = await $.ajax({
-			url: "/start-download",
-			async: true,
-			timeout: 30 * 1000,
-			type: "post",
-			contentType: false,
-			processData: false,
-			data: data,
-			dataType: 'json',
-		})
 
-		let i = 0;
-		var iterator = async.eachLimit(allTiles, numThreads, function(item, done) {
-
-			if(cancellationToken) {
-				return;
-			}
+		var data = {
+			minZoom: getMinZoom(),
+			maxZoom: getMaxZoom(),
+			outputDirectory: outputDirectory,
+			outputFile: outputFile,
+			outputType: outputType,
+			outputScale: parseInt(outputScale),
+			overviewFromMaxZoom: overviewFromMaxZoom,
+			source: source,
+			timestamp: timestamp,
+			threads: numThreads,
+			bounds: boundsArray,
+			center: centerArray,
+			geometry: draw.getAll().features[0].geometry,
+		};
 
-			var boxLayer = previewRect(item);
-
-			var url = "/download-tile";
-
-			var data = new FormData();
-			data.append('x', item.x)
-			data.append('y', item.y)
-			data.append('z', item.z)
-			data.append('quad', generateQuadKey(item.x, item.y, item.z))
-			data.append('outputDirectory', outputDirectory)
-			data.append('outputFile', outputFile)
-			data.append('outputType', outputType)
-			data.append('outputScale', outputScale)
-			data.append('timestamp', timestamp)
-			data.append('source', source)
-			data.append('bounds', boundsArray.join(","))
-			data.append('center', centerArray.join(","))
-
-			var request = $.ajax({
-				"url": url,
+		try {
+			var response = await $.ajax({
+				url: "/jobs",
 				async: true,
 				timeout: 30 * 1000,
 				type: "post",
-			    contentType: false,
-			    processData: false,
-				data: data,
+				contentType: "application/json",
+				processData: false,
+				data: JSON.stringify(data),
 				dataType: 'json',
-			}).done(function(data) {
+			});
+		} catch(e) {
+			logItemRaw("Could not start the download job");
+			$("#stop-button").html("FINISH");
+			return;
+		}
 
-				if(cancellationToken) {
-					return;
-				}
+		currentJob = response.job.id;
+		jobLogIndex = 0;
 
-				if(data.code == 200) {
-					showTinyTile(data.image)
-					logItem(item.x, item.y, item.z, data.message);
-				} else {
-					logItem(item.x, item.y, item.z, data.code + " Error downloading tile");
-				}
+		logItemRaw("Job " + currentJob + " started");
+
+		if(window.EventSource) {
+			streamJob();
+		} else {
+			pollJob();
+		}
+	}
 
-			}).fail(function(data, textStatus, errorThrown) {
+	function streamJob() {
 
-				if(cancellationToken) {
-					return;
-				}
+		jobEvents = new EventSource("/jobs/" + currentJob + "/events?since=" + jobLogIndex);
 
-				logItem(item.x, item.y, item.z, "Error while relaying tile");
-				//allTiles.push(item);
+		jobEvents.addEventListener("progress", function(e) {
+			updateJob(JSON.parse(e.data));
+		});
 
-			}).always(function(data) {
-				i++;
+		jobEvents.addEventListener("thumbnail", function(e) {
+			showTinyTile(JSON.parse(e.data).image);
+		});
 
-				removeLayer(boxLayer);
-				updateProgress(i, allTiles.length);
+		jobEvents.addEventListener("end", function(e) {
+			closeJobEvents();
+			$("#stop-button").html("FINISH");
+		});
 
-				done();
-				
-				if(cancellationToken) {
-					return;
-				}
-			});
+		jobEvents.onerror = function() {
+			// fall back to polling instead of letting the browser replay the stream
+			closeJobEvents();
 
-			requests.push(request);
+			if(!cancellationToken) {
+				setTimeout(pollJob, 2000);
+			}
+		};
+	}
 
-		}, async function(err) {
+	function closeJobEvents() {
+		if(jobEvents) {
+			jobEvents.close();
+			jobEvents = null;
+		}
+	}
 
-			var request = await $.ajax({
-				url: "/end-download",
-				async: true,
-				timeout: 30 * 1000,
-				type: "post",
-				contentType: false,
-				processData: false,
-				data: data,
-				dataType: 'json',
-			})
+	function updateJob(job) {
 
-			updateProgress(allTiles.length, allTiles.length);
-			logItemRaw("All requests are done");
+		jobLogIndex = job.logIndex;
+		for(var i = 0; i < job.log.length; i++) {
+			logItemRaw(job.log[i]);
+		}
 
-			$("#stop-button").html("FINISH");
+		updateProgress(job.done, job.total);
+
+		var rate = Math.round(job.tilesPerSecond).toLocaleString() + " tiles/s";
+		if(job.bytesPerSecond !== undefined) {
+			rate += ", " + (job.bytesPerSecond / 1048576).toFixed(2) + " MB/s";
+		}
+		rate += ", " + job.ok.toLocaleString() + " downloaded, " + job.skip.toLocaleString() + " skipped, " + job.error.toLocaleString() + " errors";
+
+		$("#download-rate").text(rate);
+	}
+
+	function pollJob() {
+
+		if(cancellationToken) {
+			return;
+		}
+
+		var request = $.ajax({
+			url: "/jobs/" + currentJob + "?since=" + jobLogIndex,
+			async: true,
+			timeout: 30 * 1000,
+			type: "get",
+			dataType: 'json',
+		}).done(function(data) {
+
+			if(cancellationToken) {
+				return;
+			}
+
+			var job = data.job;
+
+			updateJob(job);
+
+			if(job.state == "queued" || job.state == "running") {
+				setTimeout(pollJob, 1000);
+			} else {
+				$("#stop-button").html("FINISH");
+			}
+
+		}).fail(function() {
+
+			if(cancellationToken) {
+				return;
+			}
+
+			setTimeout(pollJob, 2000);
 		});
 
+		requests.push(request);
 	}
 
 	function updateProgress(value, total) {
-		var progress = value / total;
+		var progress = total > 0 ? value / total : 0;
 
 		bar.animate(progress);
 		bar.setText(Math.round(progress * 100) + '<span>%</span>');
@@ -806,10 +796,6 @@ $(function() {
 		$("#progress-subtitle").html(value.toLocaleString() + " <span>out of</span> " + total.toLocaleString())
 	}
 
-	function logItem(x, y, z, text) {
-		logItemRaw(x + ',' + y + ',' + z + ' : ' + text)
-	}
-
 	function logItemRaw(text) {
 
 		var logger = $('#log-view');
@@ -825,6 +811,18 @@ $(function() {
 
 	function stopDownloading() {
 		cancellationToken = true;
+		closeJobEvents();
+
+		if(currentJob) {
+			$.ajax({
+				url: "/jobs/" + currentJob + "/cancel",
+				async: true,
+				timeout: 30 * 1000,
+				type: "post",
+				dataType: 'json',
+			});
+			currentJob = null;
+		}
 
 		for(var i =0 ; i < requests.length; i++) {
 			var request = requests[i];
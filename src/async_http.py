@@ -0,0 +1,155 @@
+import asyncio
+import ssl
+from urllib.parse import urlsplit, urljoin
+
+class AsyncHttpPool:
+
+	maxRedirects = 5
+
+	def __init__(self, maxPerHost=500, timeout=30):
+		self.maxPerHost = maxPerHost
+		self.timeout = timeout
+		self.sslContext = ssl._create_unverified_context()
+		self.pools = {}
+		self.counters = {"hits": 0, "misses": 0}
+		self.hostCounters = {}
+
+	def stats(self):
+		return dict(self.counters)
+
+	def hostStats(self):
+		return {host: dict(counters) for host, counters in self.hostCounters.items()}
+
+	async def acquire(self, key):
+
+		idle = self.pools.setdefault(key, [])
+
+		while idle:
+			reader, writer = idle.pop()
+			if not reader.at_eof() and not writer.is_closing():
+				self.counters["hits"] += 1
+				return reader, writer, True
+			writer.close()
+
+		self.counters["misses"] += 1
+
+		scheme, host, port = key
+		if scheme == "https":
+			reader, writer = await asyncio.open_connection(host, port, ssl=self.sslContext, server_hostname=host)
+		else:
+			reader, writer = await asyncio.open_connection(host, port)
+
+		return reader, writer, False
+
+	def release(self, key, reader, writer):
+
+		idle = self.pools.setdefault(key, [])
+
+		if len(idle) >= self.maxPerHost:
+			writer.close()
+			return
+
+		idle.append((reader, writer))
+
+	async def close(self):
+
+		for idle in self.pools.values():
+			for reader, writer in idle:
+				writer.close()
+
+		self.pools = {}
+
+	async def readResponse(self, reader):
+
+		statusLine = await reader.readline()
+		if not statusLine:
+			raise ConnectionResetError("Connection closed before response")
+
+		version, status = statusLine.decode("latin-1").split(" ", 2)[:2]
+		status = int(status)
+
+		headers = {}
+		while True:
+			line = await reader.readline()
+			if line in (b"\r\n", b"\n", b""):
+				break
+			name, _, value = line.decode("latin-1").partition(":")
+			headers[name.strip().lower()] = value.strip()
+
+		keepAlive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+		if status in (204, 304) or 100 <= status < 200:
+			body = b""
+		elif headers.get("transfer-encoding", "").lower() == "chunked":
+			chunks = []
+			while True:
+				size = int((await reader.readline()).split(b";")[0], 16)
+				if size == 0:
+					# trailers end with an empty line
+					while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+						pass
+					break
+				chunks.append(await reader.readexactly(size))
+				await reader.readexactly(2)
+			body = b"".join(chunks)
+		elif "content-length" in headers:
+			body = await reader.readexactly(int(headers["content-length"]))
+		else:
+			body = await reader.read()
+			keepAlive = False
+
+		return status, headers, body, keepAlive
+
+	async def request(self, url, headers):
+
+		parts = urlsplit(url)
+		port = parts.port or (443 if parts.scheme == "https" else 80)
+		key = (parts.scheme, parts.hostname, port)
+
+		path = parts.path or "/"
+		if parts.query:
+			path += "?" + parts.query
+
+		lines = ["GET " + path + " HTTP/1.1", "Host: " + parts.netloc]
+		for name, value in headers.items():
+			lines.append(name + ": " + value)
+		payload = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+		while True:
+			reader, writer, reused = await self.acquire(key)
+			hostCounters = self.hostCounters.setdefault(parts.netloc, {"hits": 0, "misses": 0})
+			hostCounters["hits" if reused else "misses"] += 1
+
+			try:
+				writer.write(payload)
+				await writer.drain()
+				status, responseHeaders, body, keepAlive = await self.readResponse(reader)
+			except (ConnectionError, asyncio.IncompleteReadError):
+				writer.close()
+				# the server dropped an idle keep-alive connection; retry on a fresh one
+				if reused:
+					continue
+				raise
+			except BaseException:
+				writer.close()
+				raise
+
+			if keepAlive:
+				self.release(key, reader, writer)
+			else:
+				writer.close()
+
+			return status, responseHeaders, body
+
+	async def fetch(self, url, headers):
+
+		for _ in range(AsyncHttpPool.maxRedirects + 1):
+			status, responseHeaders, body = await asyncio.wait_for(self.request(url, headers), self.timeout)
+
+			if status in (301, 302, 303, 307, 308) and "location" in responseHeaders:
+				url = urljoin(url, responseHeaders["location"])
+				continue
+
+			return status, responseHeaders, body
+
+		return status, responseHeaders, body
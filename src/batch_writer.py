@@ -0,0 +1,153 @@
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from sqlite_pool import SqlitePool
+
+class BatchWriter:
+	"""Commits queued rows in batches on a background thread.
+
+	insertQuery is an SQL statement run with executemany, or a function
+	(connection, rows) for layouts that spread one tile across several tables.
+	"""
+
+	batchSize = 500
+	flushInterval = 0.25
+	queueSize = 10000
+
+	registry = {}
+	registryLock = threading.Lock()
+
+	def __init__(self, filePath, insertQuery):
+		self.filePath = filePath
+		self.insertQuery = insertQuery
+		self.queue = queue.Queue(maxsize=BatchWriter.queueSize)
+		self.errors = 0
+		self.thread = threading.Thread(target=self.run, name="BatchWriter " + os.path.basename(filePath), daemon=True)
+		self.thread.start()
+
+	def put(self, row):
+		# blocks while the queue is full, which throttles the download threads
+		self.queue.put(row)
+
+	def run(self):
+
+		stopping = False
+
+		while not stopping:
+			row = self.queue.get()
+			if row is None:
+				self.queue.task_done()
+				break
+
+			rows = [row]
+			deadline = time.monotonic() + BatchWriter.flushInterval
+
+			while len(rows) < BatchWriter.batchSize:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+
+				try:
+					row = self.queue.get(timeout=remaining)
+				except queue.Empty:
+					break
+
+				if row is None:
+					stopping = True
+					self.queue.task_done()
+					break
+
+				rows.append(row)
+
+			try:
+				self.commit(rows)
+			finally:
+				# flush() waits on these; a writer thread that died here would hang it forever
+				for _ in rows:
+					self.queue.task_done()
+
+	def commit(self, rows):
+
+		database = SqlitePool.get(self.filePath)
+		database.lock.acquire()
+		connection = None
+		try:
+			connection = database.writeConnection()
+			if callable(self.insertQuery):
+				self.insertQuery(connection, rows)
+			else:
+				connection.executemany(self.insertQuery, rows)
+			connection.commit()
+		except Exception as exc:
+			self.errors += len(rows)
+			print(f"Failed to write {len(rows)} tiles to {self.filePath}: {exc}")
+			if connection is not None:
+				try:
+					connection.rollback()
+				except sqlite3.Error:
+					pass
+		finally:
+			database.lock.release()
+
+	def flush(self):
+		"""Wait for the queued rows; returns the number of rows dropped by failed batches so far."""
+		self.queue.join()
+		return self.errors
+
+	def stop(self):
+		self.queue.put(None)
+		self.thread.join()
+		return self.errors
+
+	@staticmethod
+	def get(filePath, insertQuery):
+
+		# one writer per table of a file, so side tables batch independently
+		key = (os.path.abspath(filePath), insertQuery)
+
+		with BatchWriter.registryLock:
+			writer = BatchWriter.registry.get(key)
+			if writer is None:
+				writer = BatchWriter(filePath, insertQuery)
+				BatchWriter.registry[key] = writer
+
+		return writer
+
+	@staticmethod
+	def writersFor(filePath, remove=False):
+
+		path = os.path.abspath(filePath)
+
+		with BatchWriter.registryLock:
+			keys = [key for key in BatchWriter.registry if key[0] == path]
+			if remove:
+				return [BatchWriter.registry.pop(key) for key in keys]
+			return [BatchWriter.registry[key] for key in keys]
+
+	@staticmethod
+	def flushFile(filePath):
+		return sum(writer.flush() for writer in BatchWriter.writersFor(filePath))
+
+	@staticmethod
+	def close(filePath):
+		return sum(writer.stop() for writer in BatchWriter.writersFor(filePath, remove=True))
+
+	@staticmethod
+	def errorCount(filePath):
+		return sum(writer.errors for writer in BatchWriter.writersFor(filePath))
+
+	@staticmethod
+	def closeAll():
+
+		with BatchWriter.registryLock:
+			writers = list(BatchWriter.registry.values())
+			BatchWriter.registry.clear()
+
+		return sum(writer.stop() for writer in writers)
+
+
+atexit.register(BatchWriter.closeAll)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Compare resume_cli download engines against the local fake tile server.
+
+Example:
+    python bench/bench_engines.py --zoom 16 --latency 50 --threads 32 --in-flight 500
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_tile_server import FakeTileServer
+from file_writer import FileWriter
+from mbtiles_writer import MbtilesWriter
+import resume_cli
+
+
+def prepare_output(output_dir, output_type, bounds, zoom):
+	lock = threading.Lock()
+	center = [(bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2, zoom]
+
+	if output_type == "mbtiles":
+		MbtilesWriter.addMetadata(lock, output_dir, os.path.join(output_dir, "tiles.mbtiles"), "bench", "bench", "png", bounds, center, zoom, zoom)
+		return "tiles.mbtiles"
+
+	FileWriter.addMetadata(lock, output_dir, None, "bench", "bench", "png", bounds, center, zoom, zoom)
+	return "{z}/{x}/{y}.png"
+
+
+def run_engine(engine, server, args):
+	output_dir = tempfile.mkdtemp(prefix=f"bench-{engine}-")
+	try:
+		output_file = prepare_output(output_dir, args.output_type, args.bounds, args.zoom)
+
+		cli_args = resume_cli.build_parser().parse_args([
+			"--output-dir", output_dir,
+			"--source", server.url,
+			"--engine", engine,
+			"--threads", str(args.threads),
+			"--in-flight", str(args.in_flight),
+			"--output-type", args.output_type,
+			"--output-file", output_file,
+			"--min-zoom", str(args.zoom),
+			"--max-zoom", str(args.zoom),
+		])
+
+		before = server.requests
+		started = time.perf_counter()
+		resume_cli.download_tiles(cli_args)
+		elapsed = time.perf_counter() - started
+
+		tiles = server.requests - before
+		print(f"{engine:>6}: {tiles:,} tiles in {elapsed:.2f}s = {tiles / elapsed:,.0f} tiles/s")
+	finally:
+		shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark thread vs async download engines offline.")
+	parser.add_argument("--zoom", type=int, default=16)
+	parser.add_argument("--bounds", type=lambda value: list(map(float, value.split(","))), default=[-74.05, 40.68, -73.9, 40.82], help="min_lon,min_lat,max_lon,max_lat")
+	parser.add_argument("--latency", type=float, default=50, help="Fake server delay per tile in milliseconds")
+	parser.add_argument("--threads", type=int, default=32)
+	parser.add_argument("--in-flight", type=int, default=500)
+	parser.add_argument("--output-type", choices=["directory", "mbtiles"], default="mbtiles")
+	parser.add_argument("--engines", default="thread,async")
+	args = parser.parse_args()
+
+	server = FakeTileServer(latency=args.latency / 1000.0).start()
+	try:
+		for engine in args.engines.split(","):
+			run_engine(engine, server, args)
+	finally:
+		server.stop()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Compare sequential and parallel child fetching for scaled output tiles.
+
+Example:
+    python bench/bench_scaled.py --latency 50 --tiles 20 --scales 2,4
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_tile_server import FakeTileServer
+from utils import Utils
+
+
+def download_sequential(url, x, y, z, scale):
+	# the old code path: one child after another, then composite
+	child_data = []
+	for child_x, child_y, child_z in Utils.getChildGrid(x, y, z, scale):
+		code, data = Utils.downloadTile(url, child_x, child_y, child_z)
+		if code != 200:
+			return (code, None)
+		child_data.append(data)
+
+	return (200, Utils.mergeTileGridData(child_data, scale))
+
+
+def run(name, download, server, scale, tiles):
+	started = time.perf_counter()
+	for index in range(tiles):
+		code, data = download(server.url, index, 0, 10, scale)
+		if code != 200:
+			raise RuntimeError(f"{name} failed with {code}")
+	elapsed = time.perf_counter() - started
+
+	print(f"{name:>10} {scale}x: {tiles} tiles in {elapsed:.2f}s = {elapsed / tiles * 1000:.1f} ms/tile")
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark scaled tile downloads offline.")
+	parser.add_argument("--latency", type=float, default=50, help="Fake server delay per tile in milliseconds")
+	parser.add_argument("--tiles", type=int, default=20)
+	parser.add_argument("--scales", default="2,4")
+	args = parser.parse_args()
+
+	server = FakeTileServer(latency=args.latency / 1000.0).start()
+	try:
+		for scale in map(int, args.scales.split(",")):
+			run("sequential", download_sequential, server, scale, args.tiles)
+			run("parallel", Utils.downloadTileScaled, server, scale, args.tiles)
+	finally:
+		server.stop()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Compare the old str.replace URL/path formatting against compiled templates.
+
+Example:
+    python bench/bench_templates.py --zoom 18 --tiles 200000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tile_template import TileTemplate
+
+
+def legacy_quad_key(tile_x, tile_y, level):
+	quadkey = ""
+	for i in range(level):
+		bit = level - i
+		digit = ord('0')
+		mask = 1 << (bit - 1)
+		if (tile_x & mask) != 0:
+			digit += 1
+		if (tile_y & mask) != 0:
+			digit += 2
+		quadkey += chr(digit)
+	return quadkey
+
+
+def legacy_qualify(url, x, y, z):
+	replace_map = {
+		"x": str(x),
+		"y": str(y),
+		"z": str(z),
+		"scale:22": str(23 - (z * 2)),
+		"quad": legacy_quad_key(x, y, z),
+	}
+
+	for key, value in replace_map.items():
+		url = url.replace("{" + key + "}", value)
+
+	return url
+
+
+def timed(name, count, function):
+	started = time.perf_counter()
+	function()
+	elapsed = time.perf_counter() - started
+	print(f"{name:>28}: {elapsed:.3f}s = {count / elapsed:,.0f} tiles/s")
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark URL and path templates.")
+	parser.add_argument("--zoom", type=int, default=18)
+	parser.add_argument("--tiles", type=int, default=200000)
+	args = parser.parse_args()
+
+	z = args.zoom
+	y = 2 ** (z - 1)
+	xs = list(range(args.tiles))
+
+	for pattern in ("https://tile.openstreetmap.org/{z}/{x}/{y}.png", "http://ecn.t0.tiles.virtualearth.net/tiles/a{quad}.jpeg?g=129"):
+		print(pattern)
+		template = TileTemplate.compile(pattern)
+		timed("str.replace", len(xs), lambda: [legacy_qualify(pattern, x, y, z) for x in xs])
+		timed("compiled template", len(xs), lambda: [template.render(x, y, z) for x in xs])
+		timed("compiled template, row batch", len(xs), lambda: template.renderMany(xs, [y] * len(xs), z))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Local tile server that answers every /{z}/{x}/{y}.png request with the same
+PNG (and its ETag, honouring If-None-Match) after an artificial delay, for benchmarking the download engines offline.
+
+Example:
+    python bench/fake_tile_server.py --port 8090 --latency 50
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import threading
+
+from PIL import Image
+
+
+def make_tile(size=256, color=(46, 134, 222)):
+	output = io.BytesIO()
+	Image.new("RGB", (size, size), color).save(output, "PNG")
+	return output.getvalue()
+
+
+class FakeTileServer:
+
+	def __init__(self, host="127.0.0.1", port=0, latency=0.0, tile=None):
+		self.host = host
+		self.port = port
+		self.latency = latency
+		self.tile = tile or make_tile()
+		self.etag = b'"' + hashlib.md5(self.tile).hexdigest().encode() + b'"'
+		self.requests = 0
+		self.notModified = 0
+		self.loop = None
+		self.server = None
+		self.thread = None
+
+	async def handle(self, reader, writer):
+		try:
+			while True:
+				requestLine = await reader.readline()
+				if not requestLine:
+					break
+
+				ifNoneMatch = None
+				while True:
+					line = await reader.readline()
+					if line in (b"\r\n", b"\n", b""):
+						break
+					name, _, value = line.partition(b":")
+					if name.strip().lower() == b"if-none-match":
+						ifNoneMatch = value.strip()
+
+				self.requests += 1
+				if self.latency:
+					await asyncio.sleep(self.latency)
+
+				if ifNoneMatch == self.etag:
+					self.notModified += 1
+					writer.write(b"HTTP/1.1 304 Not Modified\r\nETag: " + self.etag + b"\r\nContent-Length: 0\r\n\r\n")
+				else:
+					writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: image/png\r\nETag: " + self.etag + b"\r\nContent-Length: " + str(len(self.tile)).encode() + b"\r\n\r\n" + self.tile)
+				await writer.drain()
+		except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+			pass
+		finally:
+			writer.close()
+
+	def start(self):
+		started = threading.Event()
+
+		def run():
+			self.loop = asyncio.new_event_loop()
+			self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port, backlog=4096))
+			self.port = self.server.sockets[0].getsockname()[1]
+			started.set()
+			self.loop.run_forever()
+
+			tasks = asyncio.all_tasks(self.loop)
+			for task in tasks:
+				task.cancel()
+			self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+			self.loop.close()
+
+		self.thread = threading.Thread(target=run, daemon=True)
+		self.thread.start()
+		started.wait()
+
+		return self
+
+	def stop(self):
+		self.loop.call_soon_threadsafe(self.server.close)
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+
+	@property
+	def url(self):
+		return f"http://{self.host}:{self.port}/{{z}}/{{x}}/{{y}}.png"
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Serve identical fake tiles for benchmarking.")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8090)
+	parser.add_argument("--latency", type=float, default=50, help="Delay per tile in milliseconds")
+	args = parser.parse_args()
+
+	server = FakeTileServer(args.host, args.port, args.latency / 1000.0).start()
+	print(f"Serving fake tiles at {server.url}")
+
+	try:
+		server.thread.join()
+	except KeyboardInterrupt:
+		server.stop()
+
+
+if __name__ == "__main__":
+	main()
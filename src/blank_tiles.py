@@ -0,0 +1,140 @@
+import collections
+import io
+import json
+import threading
+from urllib.parse import urlparse
+
+import numpy as np
+from PIL import Image
+
+from tile_validators import TileValidators
+from transcoder import Transcoder
+
+class BlankTiles:
+	"""Detects uniform-color tiles and known "no imagery" placeholders.
+
+	A solid 256px tile compresses to a few hundred bytes, so anything larger
+	than candidateSize is rejected without decoding. Candidates are hashed,
+	and only hashes not seen before are decoded and checked with NumPy.
+	"""
+
+	policies = ("keep", "drop", "reference")
+
+	candidateSize = 4096
+
+	# per-channel spread still counted as one color; JPEG smears flat areas a little
+	tolerance = {"png": 0, "webp": 2, "jpg": 3}
+
+	knownColors = collections.OrderedDict()
+	knownColorsSize = 4096
+	knownColorsLock = threading.Lock()
+
+	references = {}
+
+	# host -> content hashes of tiles the source serves for missing imagery; "*" matches any host
+	placeholders = {}
+
+	@staticmethod
+	def addPlaceholders(hosts, hashes):
+		for host in hosts:
+			BlankTiles.placeholders.setdefault(host, set()).update(hash.lower() for hash in hashes)
+
+	@staticmethod
+	def loadPlaceholders(path):
+		"""Read {"host": ["hash", ...]} from a JSON file."""
+
+		with open(path, "r", encoding="utf-8") as jsonFile:
+			for host, hashes in json.load(jsonFile).items():
+				BlankTiles.addPlaceholders([host], hashes)
+
+	@staticmethod
+	def isPlaceholder(url, tileData):
+
+		if not BlankTiles.placeholders or tileData is None:
+			return False
+
+		hashes = BlankTiles.placeholders.get(urlparse(url).netloc) or BlankTiles.placeholders.get("*")
+		return bool(hashes) and TileValidators.contentHash(tileData) in hashes
+
+	@staticmethod
+	def solidColor(tileData):
+		"""Return the RGBA color of a uniform tile, or None."""
+
+		if tileData is None or len(tileData) > BlankTiles.candidateSize:
+			return None
+
+		key = TileValidators.contentHash(tileData)
+
+		with BlankTiles.knownColorsLock:
+			if key in BlankTiles.knownColors:
+				BlankTiles.knownColors.move_to_end(key)
+				return BlankTiles.knownColors[key]
+
+		color = BlankTiles.decodeSolidColor(tileData)
+
+		with BlankTiles.knownColorsLock:
+			BlankTiles.knownColors[key] = color
+			if len(BlankTiles.knownColors) > BlankTiles.knownColorsSize:
+				BlankTiles.knownColors.popitem(last=False)
+
+		return color
+
+	@staticmethod
+	def decodeSolidColor(tileData):
+
+		try:
+			image = Image.open(io.BytesIO(tileData))
+			pixels = np.asarray(image.convert("RGBA"))
+		except Exception:
+			return None
+
+		alpha = pixels[..., 3]
+		# fully transparent tiles count as empty, whatever their color channels hold
+		if not alpha.any():
+			return (0, 0, 0, 0)
+
+		flat = pixels.reshape(-1, 4)
+		spread = int((flat.max(axis=0).astype(np.int16) - flat.min(axis=0)).max())
+		if spread > BlankTiles.tolerance.get(Transcoder.detectFormat(tileData), 0):
+			return None
+
+		return tuple(int(channel) for channel in flat[0])
+
+	@staticmethod
+	def reference(color, size, format):
+		"""The one encoding stored for every tile of this color, size and format."""
+
+		key = (color, size, format)
+		tileData = BlankTiles.references.get(key)
+
+		if tileData is None:
+			if format == "jpg":
+				image, pillowFormat, options = Image.new("RGB", size, color[:3]), "JPEG", {"quality": 90}
+			elif format == "webp":
+				image, pillowFormat, options = Image.new("RGBA", size, color), "WEBP", {"lossless": True}
+			else:
+				image, pillowFormat, options = Image.new("RGBA" if color[3] < 255 else "RGB", size, color if color[3] < 255 else color[:3]), "PNG", {"optimize": True}
+
+			output = io.BytesIO()
+			image.save(output, pillowFormat, **options)
+			tileData = output.getvalue()
+			BlankTiles.references[key] = tileData
+
+		return tileData
+
+	@staticmethod
+	def apply(tileData, policy):
+		"""Return the bytes to store under policy, or None to store nothing."""
+
+		if policy == "keep" or tileData is None:
+			return tileData
+
+		color = BlankTiles.solidColor(tileData)
+		if color is None:
+			return tileData
+
+		if policy == "drop":
+			return None
+
+		size = Image.open(io.BytesIO(tileData)).size
+		return BlankTiles.reference(color, size, Transcoder.detectFormat(tileData) or "png")
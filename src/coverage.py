@@ -0,0 +1,188 @@
+import math
+
+import numpy as np
+
+class TileCoverage:
+
+	@staticmethod
+	def lat2tile(lat, zoom):
+		lat = np.radians(np.clip(lat, -85.0511287798, 85.0511287798))
+		return (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / math.pi) / 2 * (2 ** zoom)
+
+	@staticmethod
+	def long2tile(lon, zoom):
+		return (np.asarray(lon, dtype=np.float64) + 180.0) / 360.0 * (2 ** zoom)
+
+	@staticmethod
+	def polygonsFromGeoJSON(geojson):
+		"""Return a list of polygons, each a list of (N, 2) lon/lat ring arrays, from a parsed GeoJSON object."""
+
+		if not isinstance(geojson, dict):
+			raise ValueError("GeoJSON must be an object")
+
+		kind = geojson.get("type")
+
+		if kind == "FeatureCollection":
+			polygons = []
+			for feature in geojson["features"]:
+				polygons.extend(TileCoverage.polygonsFromGeoJSON(feature))
+			return polygons
+
+		if kind == "Feature":
+			return TileCoverage.polygonsFromGeoJSON(geojson["geometry"])
+
+		if kind == "Polygon":
+			return [TileCoverage.polygon(geojson["coordinates"])]
+
+		if kind == "MultiPolygon":
+			return [TileCoverage.polygon(polygon) for polygon in geojson["coordinates"]]
+
+		raise ValueError(f"Unsupported GeoJSON type: {kind}")
+
+	@staticmethod
+	def polygon(rings):
+
+		if not rings:
+			raise ValueError("Polygon without rings")
+
+		return [TileCoverage.ring(ring) for ring in rings]
+
+	@staticmethod
+	def ring(coordinates):
+
+		ring = np.asarray(coordinates, dtype=np.float64)
+		if ring.ndim != 2 or ring.shape[0] < 3 or ring.shape[1] < 2:
+			raise ValueError("Polygon rings need at least 3 [lon, lat] positions")
+
+		return ring[:, :2]
+
+	@staticmethod
+	def polygonsFromBounds(bounds):
+		minLon, minLat, maxLon, maxLat = bounds
+		ring = np.array([[minLon, maxLat], [maxLon, maxLat], [maxLon, minLat], [minLon, minLat], [minLon, maxLat]], dtype=np.float64)
+		return [[ring]]
+
+	@staticmethod
+	def bounds(polygons):
+		points = np.concatenate([ring for polygon in polygons for ring in polygon])
+		return [float(points[:, 0].min()), float(points[:, 1].min()), float(points[:, 0].max()), float(points[:, 1].max())]
+
+	@staticmethod
+	def edges(polygons, zoom):
+		"""All ring edges as (x0, y0, x1, y1) arrays in fractional tile coordinates."""
+
+		starts = []
+		ends = []
+
+		for polygon in polygons:
+			for ring in polygon:
+				points = np.column_stack((TileCoverage.long2tile(ring[:, 0], zoom), TileCoverage.lat2tile(ring[:, 1], zoom)))
+				starts.append(points)
+				# close the ring whether or not the GeoJSON repeated the first point
+				ends.append(np.roll(points, -1, axis=0))
+
+		starts = np.concatenate(starts)
+		ends = np.concatenate(ends)
+
+		return starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1]
+
+	@staticmethod
+	def columns(polygons, zoom, columnRange=None):
+		"""Scanline-rasterize the polygons at a zoom level.
+
+		Returns a list of (x, yStart, yEnd) column spans, inclusive, covering every
+		tile that intersects the polygons. With columnRange (first, last) only those
+		columns are scanned, against the edges that reach them.
+		"""
+
+		n = 2 ** zoom
+		x0, y0, x1, y1 = TileCoverage.edges(polygons, zoom)
+
+		if columnRange is not None:
+			# edges outside the range neither cross its columns nor their center lines
+			reaching = (np.maximum(x0, x1) >= columnRange[0]) & (np.minimum(x0, x1) < columnRange[1] + 1)
+			if not reaching.any():
+				return []
+			x0, y0, x1, y1 = x0[reaching], y0[reaching], x1[reaching], y1[reaching]
+
+		edgeMinX = np.minimum(x0, x1)
+		edgeMaxX = np.maximum(x0, x1)
+		dx = x1 - x0
+		vertical = dx == 0
+		safeDx = np.where(vertical, 1.0, dx)
+
+		firstColumn = max(0, int(math.floor(edgeMinX.min())))
+		lastColumn = min(n - 1, int(math.floor(edgeMaxX.max())))
+		if columnRange is not None:
+			firstColumn = max(firstColumn, columnRange[0])
+			lastColumn = min(lastColumn, columnRange[1])
+
+		spans = []
+
+		for column in range(firstColumn, lastColumn + 1):
+			left = float(column)
+			right = left + 1.0
+			intervals = []
+
+			# tiles crossed by the outline: clip every edge to the column band
+			touching = (edgeMaxX >= left) & (edgeMinX < right)
+			if touching.any():
+				ex0 = x0[touching]
+				ey0 = y0[touching]
+				ey1 = y1[touching]
+				edx = safeDx[touching]
+				slope = (ey1 - ey0) / edx
+
+				clipLeft = np.clip(left, edgeMinX[touching], edgeMaxX[touching])
+				clipRight = np.clip(right, edgeMinX[touching], edgeMaxX[touching])
+				yLeft = np.where(vertical[touching], ey0, ey0 + (clipLeft - ex0) * slope)
+				yRight = np.where(vertical[touching], ey1, ey0 + (clipRight - ex0) * slope)
+
+				yMin = np.floor(np.minimum(yLeft, yRight)).astype(np.int64)
+				yMax = np.floor(np.maximum(yLeft, yRight)).astype(np.int64)
+				intervals.extend(zip(yMin.tolist(), yMax.tolist()))
+
+			# tiles fully inside: even-odd crossings along the column's center line
+			middle = left + 0.5
+			crossing = (x0 <= middle) != (x1 <= middle)
+			if crossing.any():
+				ys = np.sort(y0[crossing] + (middle - x0[crossing]) * (y1[crossing] - y0[crossing]) / safeDx[crossing])
+				insideStart = np.floor(ys[0::2]).astype(np.int64)
+				insideEnd = np.floor(ys[1::2]).astype(np.int64)
+				intervals.extend(zip(insideStart.tolist(), insideEnd.tolist()))
+
+			if not intervals:
+				continue
+
+			intervals.sort()
+			currentStart, currentEnd = intervals[0]
+
+			for start, end in intervals[1:]:
+				if start <= currentEnd + 1:
+					currentEnd = max(currentEnd, end)
+					continue
+
+				TileCoverage.appendSpan(spans, column, currentStart, currentEnd, n)
+				currentStart, currentEnd = start, end
+
+			TileCoverage.appendSpan(spans, column, currentStart, currentEnd, n)
+
+		return spans
+
+	@staticmethod
+	def appendSpan(spans, column, yStart, yEnd, n):
+		yStart = max(0, yStart)
+		yEnd = min(n - 1, yEnd)
+		if yStart <= yEnd:
+			spans.append((column, yStart, yEnd))
+
+	@staticmethod
+	def count(polygons, minZoom, maxZoom):
+		return sum(yEnd - yStart + 1 for z in range(minZoom, maxZoom + 1) for _, yStart, yEnd in TileCoverage.columns(polygons, z))
+
+	@staticmethod
+	def iterTiles(polygons, minZoom, maxZoom):
+		for z in range(minZoom, maxZoom + 1):
+			for x, yStart, yEnd in TileCoverage.columns(polygons, z):
+				for y in range(yStart, yEnd + 1):
+					yield (x, y, z)
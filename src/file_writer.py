@@ -4,10 +4,22 @@ import multiprocessing
 import io
 import json
 import shutil
+import threading
+
+from tile_bitmap import TileBitmap
+from tile_validators import TileValidators
 
 class FileWriter:
 
 	slicer = None
+
+	# directories known to exist, so the tile hot path needs neither a stat nor the lock
+	createdDirectories = set()
+
+	# fsync written tiles every syncEvery tiles; 0 leaves durability to the OS
+	syncEvery = 0
+	pendingSync = []
+	pendingSyncLock = threading.Lock()
 	
 	def ensureDirectory(lock, directory):
 
@@ -58,22 +70,175 @@ class FileWriter:
 
 		return
 
+	@staticmethod
+	def updateMetadata(lock, path, file, values):
+
+		with lock:
+			try:
+				with open(path + "/metadata.json", 'r') as jsonFile:
+					data = json.load(jsonFile)
+			except (OSError, ValueError):
+				data = {}
+
+			data.update(values)
+
+			with open(path + "/metadata.json", 'w') as jsonFile:
+				json.dump(data, jsonFile)
+
 	@staticmethod
 	def addTile(lock, filePath, sourcePath, x, y, z, outputScale):
 
+		with open(sourcePath, "rb") as readFile:
+			tileData = readFile.read()
+
+		FileWriter.addTileData(lock, filePath, tileData, x, y, z, outputScale)
+
+		return
+
+	@staticmethod
+	def makeDirectory(directory):
+		if directory in FileWriter.createdDirectories:
+			return
+		os.makedirs(directory or ".", exist_ok=True)
+		FileWriter.createdDirectories.add(directory)
+
+	@staticmethod
+	def validatorPath(path, file):
+		# directory output keeps ETags and hashes in a sidecar SQLite index
+		return os.path.join(path, ".tile-validators.sqlite")
+
+	@staticmethod
+	def prepareDirectories(pathForTile, columns):
+		"""Create every column directory of (z, x, yStart, yEnd) spans up front."""
+
+		for z, x, yStart, yEnd in columns:
+			directory = os.path.dirname(pathForTile(x, yStart, z))
+			# patterns with {y} or {quad} in the directory are created per tile instead
+			if directory == os.path.dirname(pathForTile(x, yEnd, z)):
+				FileWriter.makeDirectory(directory)
+
+	@staticmethod
+	def addTileData(lock, filePath, tileData, x, y, z, outputScale):
+
 		fileDirectory = os.path.dirname(filePath)
-		FileWriter.ensureDirectory(lock, fileDirectory)
-		
-		shutil.copyfile(sourcePath, filePath)
+		FileWriter.makeDirectory(fileDirectory)
+
+		# readers never see a half-written tile; the temp name is unique per thread
+		tempPath = os.path.join(fileDirectory, "." + os.path.basename(filePath) + "." + str(threading.get_ident()) + ".tmp")
+
+		try:
+			with open(tempPath, "wb") as writeFile:
+				writeFile.write(tileData)
+			os.replace(tempPath, filePath)
+		except BaseException:
+			try:
+				os.remove(tempPath)
+			except OSError:
+				pass
+			raise
+
+		if FileWriter.syncEvery > 0:
+			with FileWriter.pendingSyncLock:
+				FileWriter.pendingSync.append(filePath)
+				if len(FileWriter.pendingSync) < FileWriter.syncEvery:
+					return
+				pending = FileWriter.pendingSync
+				FileWriter.pendingSync = []
+
+			FileWriter.syncFiles(pending)
 
 		return
 
+	@staticmethod
+	def syncFiles(paths):
+
+		for path in paths:
+			try:
+				descriptor = os.open(path, os.O_RDONLY)
+			except OSError:
+				continue
+			try:
+				os.fsync(descriptor)
+			finally:
+				os.close(descriptor)
+
+		# the renames themselves live in the directory entries
+		if hasattr(os, "O_DIRECTORY"):
+			for directory in set(os.path.dirname(path) for path in paths):
+				try:
+					descriptor = os.open(directory or ".", os.O_RDONLY | os.O_DIRECTORY)
+				except OSError:
+					continue
+				try:
+					os.fsync(descriptor)
+				finally:
+					os.close(descriptor)
+
+	@staticmethod
+	def sync():
+		with FileWriter.pendingSyncLock:
+			pending = FileWriter.pendingSync
+			FileWriter.pendingSync = []
+
+		FileWriter.syncFiles(pending)
+
 	@staticmethod
 	def exists(filePath, x, y, z):
 		return os.path.isfile(filePath)
 
+	@staticmethod
+	def readTile(filePath, x, y, z):
+		try:
+			with open(filePath, "rb") as readFile:
+				return readFile.read()
+		except OSError:
+			return None
+
+	@staticmethod
+	def flush(filePath):
+		# tiles are written synchronously, so failures already surfaced in addTileData
+		FileWriter.sync()
+		return 0
+
+	@staticmethod
+	def existingTiles(pathForTile, z, xStart, xEnd, yStart, yEnd):
+
+		bitmap = TileBitmap(xStart, yStart, xEnd - xStart + 1, yEnd - yStart + 1)
+		listedDirectory = None
+		names = set()
+
+		for x in range(xStart, xEnd + 1):
+			directory = os.path.dirname(pathForTile(x, yStart, z))
+
+			# the pattern puts {y} (or {quad}) in the directory part, so a listing cannot help
+			if os.path.dirname(pathForTile(x, yEnd, z)) != directory:
+				for y in range(yStart, yEnd + 1):
+					if os.path.isfile(pathForTile(x, y, z)):
+						bitmap.add(x, y)
+				continue
+
+			# {z}/{x}/{y}.png lists one directory per column, flat patterns list once
+			if directory != listedDirectory:
+				listedDirectory = directory
+				try:
+					with os.scandir(directory or ".") as entries:
+						names = set(entry.name for entry in entries)
+				except OSError:
+					names = set()
+
+			if not names:
+				continue
+
+			for y in range(yStart, yEnd + 1):
+				if os.path.basename(pathForTile(x, y, z)) in names:
+					bitmap.add(x, y)
+
+		return bitmap
+
 
 	@staticmethod
 	def close(lock, path, file, minZoom, maxZoom):
+		FileWriter.sync()
+		TileValidators.close(FileWriter.validatorPath(path, file))
 		#TODO recalculate bounds and center
-		return
+		return 0
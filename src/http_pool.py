@@ -0,0 +1,230 @@
+import http.client
+import io
+import queue
+import ssl
+import threading
+import urllib.error
+import urllib.request
+from urllib.parse import urlsplit, urljoin
+
+class PooledResponse:
+
+	def __init__(self, pool, key, connection, response, url):
+		self.pool = pool
+		self.key = key
+		self.connection = connection
+		self.response = response
+		self.url = url
+		self.headers = response.headers
+		self.status = response.status
+		self.data = None
+
+	def getcode(self):
+		return self.status
+
+	def geturl(self):
+		return self.url
+
+	def read(self):
+		if self.data is None:
+			try:
+				self.data = self.response.read()
+			except (http.client.HTTPException, OSError) as exc:
+				# a body cut short leaves the connection unusable; fail like a request error
+				self.pool.discard(self.key, self.connection)
+				self.connection = None
+				raise urllib.error.URLError(exc)
+		return self.data
+
+	def close(self):
+		if self.connection is None:
+			return
+
+		if self.data is not None and not self.response.will_close:
+			self.pool.release(self.key, self.connection)
+		else:
+			self.pool.discard(self.key, self.connection)
+
+		self.connection = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+class HttpPool:
+
+	maxPerHost = 16
+	timeout = 30
+	maxRedirects = 5
+
+	sslContext = ssl._create_unverified_context()
+
+	pools = {}
+	# caps the connections of a host in use at once; new ones are only opened when none is idle,
+	# so this bounds the open connections too
+	slots = {}
+	poolsLock = threading.Lock()
+
+	counters = {"hits": 0, "misses": 0}
+	hostCounters = {}
+	countersLock = threading.Lock()
+
+	retryErrors = (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)
+
+	@staticmethod
+	def configure(maxPerHost=None, timeout=None):
+		if maxPerHost is not None:
+			HttpPool.maxPerHost = maxPerHost
+		if timeout is not None:
+			HttpPool.timeout = timeout
+
+	@staticmethod
+	def count(name, key):
+		with HttpPool.countersLock:
+			HttpPool.counters[name] += 1
+			hostCounters = HttpPool.hostCounters.setdefault(key[1], {"hits": 0, "misses": 0})
+			hostCounters[name] += 1
+
+	@staticmethod
+	def stats():
+		with HttpPool.countersLock:
+			return dict(HttpPool.counters)
+
+	@staticmethod
+	def hostStats():
+		with HttpPool.countersLock:
+			return {host: dict(counters) for host, counters in HttpPool.hostCounters.items()}
+
+	@staticmethod
+	def idle(key):
+		with HttpPool.poolsLock:
+			idle = HttpPool.pools.get(key)
+			if idle is None:
+				idle = queue.LifoQueue()
+				HttpPool.pools[key] = idle
+		return idle
+
+	@staticmethod
+	def slot(key):
+		with HttpPool.poolsLock:
+			slot = HttpPool.slots.get(key)
+			if slot is None:
+				slot = threading.BoundedSemaphore(HttpPool.maxPerHost)
+				HttpPool.slots[key] = slot
+		return slot
+
+	@staticmethod
+	def acquire(key):
+
+		HttpPool.slot(key).acquire()
+
+		try:
+			connection = HttpPool.idle(key).get_nowait()
+			HttpPool.count("hits", key)
+			return connection, True
+		except queue.Empty:
+			pass
+
+		HttpPool.count("misses", key)
+
+		scheme, host = key
+		if scheme == "https":
+			connection = http.client.HTTPSConnection(host, timeout=HttpPool.timeout, context=HttpPool.sslContext)
+		else:
+			connection = http.client.HTTPConnection(host, timeout=HttpPool.timeout)
+
+		return connection, False
+
+	@staticmethod
+	def release(key, connection):
+
+		idle = HttpPool.idle(key)
+
+		if idle.qsize() >= HttpPool.maxPerHost:
+			connection.close()
+		else:
+			idle.put(connection)
+
+		HttpPool.slot(key).release()
+
+	@staticmethod
+	def discard(key, connection):
+		connection.close()
+		HttpPool.slot(key).release()
+
+	@staticmethod
+	def closeAll():
+
+		with HttpPool.poolsLock:
+			pools = list(HttpPool.pools.values())
+			HttpPool.pools.clear()
+
+		for idle in pools:
+			while True:
+				try:
+					idle.get_nowait().close()
+				except queue.Empty:
+					break
+
+	@staticmethod
+	def send(key, method, path, headers):
+
+		while True:
+			connection, reused = HttpPool.acquire(key)
+
+			try:
+				connection.request(method, path, headers=headers)
+				return connection, connection.getresponse()
+			except HttpPool.retryErrors:
+				HttpPool.discard(key, connection)
+				# the server dropped an idle keep-alive connection; retry on a fresh one
+				if not reused:
+					raise
+			except Exception:
+				HttpPool.discard(key, connection)
+				raise
+
+	@staticmethod
+	def open(request):
+
+		url = request.full_url
+
+		# proxies are only understood by urllib
+		if urlsplit(url).scheme in urllib.request.getproxies():
+			return urllib.request.urlopen(request, context=HttpPool.sslContext, timeout=HttpPool.timeout)
+
+		headers = dict(request.header_items())
+		headers.setdefault("Connection", "keep-alive")
+
+		for _ in range(HttpPool.maxRedirects + 1):
+			parts = urlsplit(url)
+			key = (parts.scheme, parts.netloc)
+
+			path = parts.path or "/"
+			if parts.query:
+				path += "?" + parts.query
+
+			try:
+				connection, response = HttpPool.send(key, request.get_method(), path, headers)
+			except (OSError, http.client.HTTPException) as exc:
+				raise urllib.error.URLError(exc)
+
+			pooled = PooledResponse(HttpPool, key, connection, response, url)
+
+			if response.status in (301, 302, 303, 307, 308) and response.headers.get("Location"):
+				pooled.read()
+				pooled.close()
+				url = urljoin(url, response.headers["Location"])
+				continue
+
+			if response.status >= 400:
+				body = pooled.read()
+				pooled.close()
+				raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+
+			return pooled
+
+		raise urllib.error.HTTPError(url, response.status, "Too many redirects", response.headers, None)
@@ -0,0 +1,359 @@
+import collections
+import os
+import threading
+import time
+import uuid
+
+from blank_tiles import BlankTiles
+from coverage import TileCoverage
+from file_writer import FileWriter
+from mbtiles_writer import MbtilesWriter
+from rate_limiter import RateLimiter
+from repo_writer import RepoWriter
+from tile_template import TileTemplate
+from tile_validators import TileValidators
+from transcoder import Transcoder
+from utils import Utils
+import resume_cli
+
+class DownloadJob:
+
+	thumbnailInterval = 1.0
+	eventInterval = 0.5
+
+	writers = {
+		"mbtiles": MbtilesWriter,
+		"repo": RepoWriter,
+		"directory": FileWriter,
+	}
+
+	def __init__(self, jobId, params, lock):
+
+		self.id = jobId
+		self.lock = lock
+
+		self.source = str(params["source"])
+		self.outputType = str(params.get("outputType", "directory"))
+		self.outputScale = int(params.get("outputScale", 1))
+		self.minZoom = int(params["minZoom"])
+		self.maxZoom = int(params["maxZoom"])
+		self.threads = max(1, int(params.get("threads", 4)))
+		self.retries = max(1, int(params.get("retries", 1)))
+		self.timestamp = str(params.get("timestamp", int(time.time() * 1000)))
+		self.overviewFromMaxZoom = bool(params.get("overviewFromMaxZoom", False))
+		self.deduplicate = bool(params.get("deduplicate", False))
+		self.storeValidators = bool(params.get("storeValidators", False))
+		self.overviewProcesses = int(params["overviewProcesses"]) if params.get("overviewProcesses") else None
+		self.transcodeProcesses = int(params["transcodeProcesses"]) if params.get("transcodeProcesses") else None
+
+		if params.get("transcodeFormat"):
+			self.transcoder = Transcoder(params["transcodeFormat"], int(params["transcodeQuality"]) if params.get("transcodeQuality") else None, int(params["transcodeColors"]) if params.get("transcodeColors") else None, bool(params.get("transcodeLossless", False)))
+		else:
+			self.transcoder = None
+		self.transcodeExecutor = None
+
+		self.blankTiles = str(params.get("blankTiles", "keep"))
+		if self.blankTiles not in BlankTiles.policies:
+			raise ValueError("Unknown blank tile policy " + self.blankTiles)
+
+		if self.outputType not in DownloadJob.writers:
+			raise ValueError("Unknown output type " + self.outputType)
+
+		if self.deduplicate and self.outputType != "mbtiles":
+			raise ValueError("Deduplication needs mbtiles output")
+
+		if not Utils.isValidScale(self.outputScale):
+			raise ValueError("Output scale must be a power of two")
+
+		if self.minZoom > self.maxZoom:
+			self.minZoom, self.maxZoom = self.maxZoom, self.minZoom
+
+		geometry = params.get("geometry")
+		if geometry and not isinstance(geometry, dict):
+			raise ValueError("geometry must be a GeoJSON object")
+		self.polygons = TileCoverage.polygonsFromGeoJSON(geometry) if geometry else None
+
+		if params.get("bounds"):
+			self.bounds = resume_cli.parse_bounds(params["bounds"])
+		elif self.polygons:
+			self.bounds = TileCoverage.bounds(self.polygons)
+		else:
+			self.bounds = None
+
+		if not self.bounds:
+			raise ValueError("Job needs bounds or a geometry")
+
+		if params.get("placeholderHashes"):
+			BlankTiles.addPlaceholders(Utils.sourceHosts(self.source), params["placeholderHashes"])
+
+		center = params.get("center")
+		if isinstance(center, str):
+			center = center.split(",")
+
+		if center:
+			self.center = list(map(float, center))
+		else:
+			self.center = [(self.bounds[0] + self.bounds[2]) / 2, (self.bounds[1] + self.bounds[3]) / 2, self.maxZoom]
+
+		outputDirectory = str(params.get("outputDirectory", "{timestamp}")).replace("{timestamp}", self.timestamp)
+		self.outputFile = str(params.get("outputFile", "{z}/{x}/{y}.png")).replace("{timestamp}", self.timestamp)
+		self.outputDirectory = os.path.join("output", outputDirectory)
+		self.outputTemplate = TileTemplate.compile(self.outputFile)
+		self.validatorPath = DownloadJob.writers[self.outputType].validatorPath(self.outputDirectory, os.path.join(self.outputDirectory, self.outputFile))
+
+		self.writer = DownloadJob.writers[self.outputType]
+		self.hosts = set(Utils.sourceHosts(self.source))
+		self.state = "queued"
+		self.message = None
+		self.total = 0
+		self.progress = None
+		self.started = None
+		self.finished = None
+		self.cancelled = threading.Event()
+		self.messages = collections.deque(maxlen=500)
+		self.messagesLock = threading.Lock()
+		self.messageCount = 0
+		self.thread = None
+
+		self.bytes = 0
+		self.thumbnail = None
+		self.thumbnailCount = 0
+		self.lastThumbnail = 0
+		self.statsLock = threading.Lock()
+
+	def log(self, text):
+		with self.messagesLock:
+			self.messageCount += 1
+			self.messages.append((self.messageCount, text))
+
+	def pathForTile(self, x, y, z):
+		return os.path.join(self.outputDirectory, self.outputTemplate.render(x, y, z))
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name="DownloadJob " + self.id, daemon=True)
+		self.thread.start()
+
+	def cancel(self):
+		self.cancelled.set()
+
+	def worker(self, x, y, z):
+
+		targetPath = self.pathForTile(x, y, z)
+
+		for attempt in range(1, self.retries + 1):
+			# ETags are kept for 1x tiles, if asked for, so resume_cli --refresh can revalidate them later
+			if self.outputScale == 1:
+				code, tileData, validators = Utils.downloadTileConditional(self.source, x, y, z)
+			else:
+				code, tileData = Utils.downloadTileScaled(self.source, x, y, z, self.outputScale)
+				validators = None
+
+			if code == 204:
+				return (x, y, z, "blank")
+
+			if code == 200:
+				if validators is not None and self.storeValidators:
+					TileValidators.put(self.validatorPath, x, y, z, validators, TileValidators.contentHash(tileData))
+				tileData = BlankTiles.apply(tileData, self.blankTiles)
+				if tileData is None:
+					return (x, y, z, "blank")
+				if self.transcoder is not None:
+					tileData = self.transcodeExecutor.submit(self.transcoder.encode, tileData).result()
+				self.writer.addTileData(self.lock, targetPath, tileData, x, y, z, self.outputScale)
+				self.recordTile(tileData)
+				return (x, y, z, "ok")
+
+			if attempt == self.retries:
+				if code == 403 and "google.com" in self.source:
+					self.log(f"{x},{y},{z} : Google returned 403 (automated tile requests are blocked)")
+				else:
+					self.log(f"{x},{y},{z} : {code} Error downloading tile")
+				return (x, y, z, f"error {code}")
+
+	def recordTile(self, tileData):
+
+		with self.statsLock:
+			self.bytes += len(tileData)
+
+			now = time.monotonic()
+			if now - self.lastThumbnail < DownloadJob.thumbnailInterval:
+				return
+			self.lastThumbnail = now
+
+		# only a sampled tile per interval is decoded for the UI
+		thumbnail = Utils.makeThumbnail(tileData)
+		if thumbnail is not None:
+			with self.statsLock:
+				self.thumbnailCount += 1
+				self.thumbnail = (self.thumbnailCount, thumbnail)
+
+	def run(self):
+
+		self.state = "running"
+		self.started = time.time()
+
+		filePath = os.path.join(self.outputDirectory, self.outputFile)
+
+		try:
+			writeErrors = 0
+			closeError = None
+			try:
+				extraMetadata = {
+					"source": self.source,
+					"output_type": self.outputType,
+					"output_file": self.outputFile,
+					"output_scale": self.outputScale,
+					"timestamp": self.timestamp,
+				}
+
+				# only the mbtiles writer knows the deduplicated layout
+				options = {"deduplicate": True} if self.deduplicate else {}
+
+				self.writer.addMetadata(self.lock, self.outputDirectory, filePath, self.outputFile, "Map Tiles Downloader via AliFlux", Transcoder.outputFormat(self.source, self.outputScale, self.transcoder), self.bounds, self.center, self.minZoom, self.maxZoom, "mercator", 256 * self.outputScale, extraMetadata, **options)
+
+				self.total = resume_cli.count_tiles(self.bounds, self.minZoom, self.maxZoom, self.polygons)
+				self.progress = resume_cli.Progress(self.total)
+
+				downloadMinZoom = self.maxZoom if self.overviewFromMaxZoom else self.minZoom
+				self.writer.prepareDirectories(self.pathForTile, resume_cli.iter_columns(self.bounds, downloadMinZoom, self.maxZoom, self.polygons))
+
+				if self.transcoder is not None:
+					self.transcodeExecutor = resume_cli.overview_executor(self.transcodeProcesses or os.cpu_count() or 1)
+
+				tiles = resume_cli.iter_missing_tiles(self.bounds, downloadMinZoom, self.maxZoom, self.writer, self.pathForTile, self.progress, self.polygons)
+				try:
+					resume_cli.run_thread_engine(tiles, self.worker, self.threads, self.progress, self.cancelled)
+				finally:
+					if self.transcodeExecutor is not None:
+						self.transcodeExecutor.shutdown()
+
+				if self.overviewFromMaxZoom and self.minZoom < self.maxZoom and not self.cancelled.is_set():
+					self.log(f"Building zoom {self.minZoom}-{self.maxZoom - 1} from zoom {self.maxZoom}")
+					resume_cli.build_overviews(self.bounds, self.minZoom, self.maxZoom, self.writer, self.lock, self.pathForTile, self.progress, self.outputScale, self.polygons, self.overviewProcesses, True, self.cancelled, resume_cli.overview_transcoder(self.source, self.outputScale, self.transcoder), self.blankTiles)
+			finally:
+				# flushes queued inserts and records the downloaded bounds, like /end-download;
+				# a failed job must still stop its batch thread and close its pooled connections
+				try:
+					writeErrors = self.writer.close(self.lock, self.outputDirectory, filePath, self.minZoom, self.maxZoom)
+				except Exception as exc:
+					closeError = exc
+
+			if closeError is not None:
+				raise closeError
+			if writeErrors:
+				raise IOError(f"{writeErrors} tiles failed to write to {filePath}")
+
+			self.state = "cancelled" if self.cancelled.is_set() else "done"
+		except Exception as exc:
+			self.state = "failed"
+			self.message = str(exc)
+			self.log("Job failed: " + str(exc))
+
+		self.finished = time.time()
+		self.log("All requests are done" if self.state == "done" else "Job " + self.state)
+
+	def status(self, since=0):
+
+		results = self.progress.results if self.progress else {}
+		done = sum(results.values())
+
+		end = self.finished or time.time()
+		elapsed = end - self.started if self.started else 0
+
+		with self.messagesLock:
+			messages = [text for number, text in self.messages if number > since]
+			lastMessage = self.messageCount
+
+		return {
+			"id": self.id,
+			"state": self.state,
+			"message": self.message,
+			"total": self.total,
+			"done": done,
+			"ok": results.get("ok", 0),
+			"skip": results.get("skip", 0),
+			"error": results.get("error", 0),
+			"blank": results.get("blank", 0),
+			"elapsed": elapsed,
+			"tilesPerSecond": done / elapsed if elapsed > 0 else 0,
+			"outputDirectory": self.outputDirectory,
+			"outputFile": self.outputFile,
+			"outputType": self.outputType,
+			"log": messages,
+			"logIndex": lastMessage,
+			"hosts": {host: stats for host, stats in RateLimiter.stats().items() if host in self.hosts},
+		}
+
+
+	def events(self, since=0):
+		"""Yield (event, data) pairs for an SSE stream until the job has finished."""
+
+		lastTime = None
+		lastDone = 0
+		lastBytes = 0
+		logIndex = since
+		thumbnailIndex = 0
+
+		while True:
+			finished = self.state not in ("queued", "running")
+
+			status = self.status(logIndex)
+			logIndex = status["logIndex"]
+
+			now = time.monotonic()
+
+			with self.statsLock:
+				totalBytes = self.bytes
+				thumbnail = self.thumbnail
+
+			status["bytes"] = totalBytes
+
+			# rates cover the last interval; the first event reports the job average
+			if lastTime is None:
+				status["bytesPerSecond"] = totalBytes / status["elapsed"] if status["elapsed"] > 0 else 0
+			else:
+				elapsed = max(now - lastTime, 1e-6)
+				status["tilesPerSecond"] = (status["done"] - lastDone) / elapsed
+				status["bytesPerSecond"] = (totalBytes - lastBytes) / elapsed
+
+			lastTime, lastDone, lastBytes = now, status["done"], totalBytes
+
+			yield ("progress", status)
+
+			if thumbnail is not None and thumbnail[0] != thumbnailIndex:
+				thumbnailIndex = thumbnail[0]
+				yield ("thumbnail", {"image": thumbnail[1]})
+
+			if finished:
+				yield ("end", {"state": self.state})
+				return
+
+			time.sleep(DownloadJob.eventInterval)
+
+
+class JobManager:
+
+	jobs = {}
+	jobsLock = threading.Lock()
+
+	@staticmethod
+	def create(params, lock):
+
+		job = DownloadJob(uuid.uuid4().hex[:12], params, lock)
+
+		with JobManager.jobsLock:
+			JobManager.jobs[job.id] = job
+
+		job.start()
+
+		return job
+
+	@staticmethod
+	def get(jobId):
+		with JobManager.jobsLock:
+			return JobManager.jobs.get(jobId)
+
+	@staticmethod
+	def all():
+		with JobManager.jobsLock:
+			return list(JobManager.jobs.values())
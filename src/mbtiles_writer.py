@@ -5,10 +5,25 @@ from os.path import isfile, join
 import multiprocessing
 from PIL import Image
 import io
+import threading
+import collections
 from utils import Utils
+from sqlite_pool import SqlitePool
+from batch_writer import BatchWriter
+from tile_bitmap import TileBitmap
+from tile_validators import TileValidators
 
 class MbtilesWriter:
-	
+
+	insertQuery = "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?);"
+
+	# the deduplicated layout keeps coordinates in map and unique blobs in images
+	imageCacheSize = 100000
+	imageCaches = {}
+	imageWriters = {}
+	layouts = {}
+	layoutsLock = threading.Lock()
+
 	def ensureDirectory(lock, directory):
 
 		lock.acquire()
@@ -29,83 +44,207 @@ class MbtilesWriter:
 
 
 	@staticmethod
-	def addMetadata(lock, path, file, name, description, format, bounds, center, minZoom, maxZoom, profile="mercator", tileSize=256, extraMetadata=None):
+	def addMetadata(lock, path, file, name, description, format, bounds, center, minZoom, maxZoom, profile="mercator", tileSize=256, extraMetadata=None, deduplicate=False):
 
 		MbtilesWriter.ensureDirectory(lock, path)
 
 		extraMetadata = extraMetadata or {}
 
-		connection = sqlite3.connect(file, check_same_thread=False)
-		c = connection.cursor()
-		c.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text);")
-		c.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);")
-		
+		database = SqlitePool.get(file)
+		database.lock.acquire()
 		try:
-			c.execute("CREATE UNIQUE INDEX tile_index on tiles (zoom_level, tile_column, tile_row);")
-		except:
-			pass
+			connection = database.writeConnection()
+			c = connection.cursor()
+			c.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text);")
+
+			# an existing file keeps whichever layout it was created with
+			c.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'tiles'")
+			if deduplicate and c.fetchone()[0] == 0:
+				c.execute("CREATE TABLE IF NOT EXISTS map (zoom_level integer, tile_column integer, tile_row integer, tile_id text);")
+				c.execute("CREATE TABLE IF NOT EXISTS images (tile_data blob, tile_id text);")
+				c.execute("CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row);")
+				c.execute("CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id);")
+				c.execute("CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id;")
+			else:
+				c.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);")
+
+			try:
+				c.execute("CREATE UNIQUE INDEX tile_index on tiles (zoom_level, tile_column, tile_row);")
+			except:
+				pass
+
+			try:
+				c.execute("CREATE UNIQUE INDEX metadata_name ON metadata (name);")
+			except:
+				pass
 
-		try:
-			c.execute("CREATE UNIQUE INDEX metadata_name ON metadata (name);")
-		except:
-			pass
-		
-		connection.commit()
-		
-		try:
-			metadata_rows = [
-				("name", name),
-				("description", description),
-				("format", format), 
-				("bounds", ','.join(map(str, bounds))), 
-				("center", ','.join(map(str, center))), 
-				("minzoom", minZoom), 
-				("maxzoom", maxZoom), 
-				("profile", profile), 
-				("tilesize", str(tileSize)), 
-				("scheme", "tms"), 
-				("generator", "Map Tiles Downloader via AliFlux"),
-				("type", "overlay"),
-				("attribution", "Map Tiles Downloader via AliFlux"),
-			]
-
-			for key, value in extraMetadata.items():
-				metadata_rows.append((key, str(value)))
-
-			c.executemany("INSERT INTO metadata (name, value) VALUES (?, ?);", metadata_rows)
+			connection.commit()
+
+			try:
+				metadata_rows = [
+					("name", name),
+					("description", description),
+					("format", format), 
+					("bounds", ','.join(map(str, bounds))), 
+					("center", ','.join(map(str, center))), 
+					("minzoom", minZoom), 
+					("maxzoom", maxZoom), 
+					("profile", profile), 
+					("tilesize", str(tileSize)), 
+					("scheme", "tms"), 
+					("generator", "Map Tiles Downloader via AliFlux"),
+					("type", "overlay"),
+					("attribution", "Map Tiles Downloader via AliFlux"),
+				]
+
+				for key, value in extraMetadata.items():
+					metadata_rows.append((key, str(value)))
+
+				c.executemany("INSERT INTO metadata (name, value) VALUES (?, ?);", metadata_rows)
+
+				connection.commit()
+			except:
+				pass
+		finally:
+			database.lock.release()
 
+		with MbtilesWriter.layoutsLock:
+			MbtilesWriter.layouts.pop(os.path.abspath(file), None)
+
+
+	@staticmethod
+	def updateMetadata(lock, path, file, values):
+
+		database = SqlitePool.get(file)
+		database.lock.acquire()
+		try:
+			connection = database.writeConnection()
+			connection.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?);", [(key, str(value)) for key, value in values.items()])
 			connection.commit()
-		except:
-			pass
+		finally:
+			database.lock.release()
+
+	@staticmethod
+	def isDeduplicated(filePath):
+
+		key = os.path.abspath(filePath)
+
+		with MbtilesWriter.layoutsLock:
+			if key in MbtilesWriter.layouts:
+				return MbtilesWriter.layouts[key]
 
-		
+		if not os.path.exists(filePath):
+			return False
+
+		c = SqlitePool.get(filePath).readConnection().cursor()
+		c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'map'")
+		deduplicated = c.fetchone()[0] > 0
+
+		with MbtilesWriter.layoutsLock:
+			MbtilesWriter.layouts[key] = deduplicated
+
+		return deduplicated
 
 	@staticmethod
-	def addTile(lock, filePath, sourcePath, x, y, z, outputScale):
+	def tileTable(filePath):
+		# coordinate-only queries skip the images join
+		return "map" if MbtilesWriter.isDeduplicated(filePath) else "tiles"
 
-		fileDirectory = os.path.dirname(filePath)
-		MbtilesWriter.ensureDirectory(lock, fileDirectory)
+	@staticmethod
+	def tileHash(tileData):
+		return TileValidators.contentHash(tileData)
 
-		invertedY = (2 ** z) - y - 1
+	@staticmethod
+	def imageCache(filePath):
+
+		key = os.path.abspath(filePath)
+
+		cache = MbtilesWriter.imageCaches.get(key)
+		if cache is None:
+			cache = MbtilesWriter.imageCaches[key] = collections.OrderedDict()
+
+		return cache
+
+	@staticmethod
+	def isImageStored(filePath, tileId):
+		"""True if tileId is known to be committed to this file's images table."""
+
+		with MbtilesWriter.layoutsLock:
+			cache = MbtilesWriter.imageCache(filePath)
+
+			if tileId in cache:
+				cache.move_to_end(tileId)
+				return True
+
+		return False
+
+	@staticmethod
+	def rememberImages(filePath, tileIds):
+
+		with MbtilesWriter.layoutsLock:
+			cache = MbtilesWriter.imageCache(filePath)
+
+			for tileId in tileIds:
+				cache[tileId] = True
+				cache.move_to_end(tileId)
+
+			while len(cache) > MbtilesWriter.imageCacheSize:
+				cache.popitem(last=False)
+
+	@staticmethod
+	def writeDeduplicated(connection, rows):
+		# rows are (z, x, invertedY, tileId, tileData), tileData is None for known images
+		connection.executemany("INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?);", [(row[4], row[3]) for row in rows if row[4] is not None])
+		connection.executemany("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?);", [row[:4] for row in rows])
+
+	@staticmethod
+	def deduplicatedWriter(filePath):
+		"""The BatchWriter callable of one deduplicated file, created once so it keys a single writer."""
+
+		key = os.path.abspath(filePath)
+
+		with MbtilesWriter.layoutsLock:
+			write = MbtilesWriter.imageWriters.get(key)
+			if write is None:
+
+				def write(connection, rows):
+					MbtilesWriter.writeDeduplicated(connection, rows)
+					connection.commit()
+					# later tiles may only leave out the bytes of images that are really stored
+					MbtilesWriter.rememberImages(key, [row[3] for row in rows if row[4] is not None])
+
+				MbtilesWriter.imageWriters[key] = write
+
+		return write
+
+
+	@staticmethod
+	def addTile(lock, filePath, sourcePath, x, y, z, outputScale):
 
-		tileData = []
 		with open(sourcePath, "rb") as readFile:
 			tileData = readFile.read()
-		
-		lock.acquire()
-		try:
 
-			connection = sqlite3.connect(filePath, check_same_thread=False)
-			c = connection.cursor()
-			c.execute("INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?);", [
-				z, x, invertedY, tileData
-			])
+		MbtilesWriter.addTileData(lock, filePath, tileData, x, y, z, outputScale)
 
-			connection.commit()
+		return
 
-		finally:
-			lock.release()
+	@staticmethod
+	def addTileData(lock, filePath, tileData, x, y, z, outputScale):
+
+		fileDirectory = os.path.dirname(filePath)
+		MbtilesWriter.ensureDirectory(lock, fileDirectory)
+
+		invertedY = (2 ** z) - y - 1
 
+		if MbtilesWriter.isDeduplicated(filePath):
+			tileId = MbtilesWriter.tileHash(tileData)
+			if MbtilesWriter.isImageStored(filePath, tileId):
+				tileData = None
+
+			BatchWriter.get(filePath, MbtilesWriter.deduplicatedWriter(filePath)).put((z, x, invertedY, tileId, tileData))
+			return
+
+		BatchWriter.get(filePath, MbtilesWriter.insertQuery).put((z, x, invertedY, tileData))
 
 		return
 
@@ -115,10 +254,10 @@ class MbtilesWriter:
 
 		if(os.path.exists(filePath)):
 			
-			connection = sqlite3.connect(filePath, check_same_thread=False)
+			connection = SqlitePool.get(filePath).readConnection()
 			c = connection.cursor()
 
-			c.execute("SELECT COUNT(*) FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ? LIMIT 1", (z, x, invertedY))
+			c.execute("SELECT COUNT(*) FROM " + MbtilesWriter.tileTable(filePath) + " WHERE zoom_level = ? AND tile_column = ? AND tile_row = ? LIMIT 1", (z, x, invertedY))
 
 			result = c.fetchone()
 
@@ -128,22 +267,113 @@ class MbtilesWriter:
 		return False
 
 
+	@staticmethod
+	def readTile(filePath, x, y, z):
+		invertedY = (2 ** z) - y - 1
+
+		if not os.path.exists(filePath):
+			return None
+
+		connection = SqlitePool.get(filePath).readConnection()
+		c = connection.cursor()
+		c.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (z, x, invertedY))
+
+		row = c.fetchone()
+		return bytes(row[0]) if row and row[0] is not None else None
+
+	@staticmethod
+	def prepareDirectories(pathForTile, columns):
+		return
+
+	@staticmethod
+	def validatorPath(path, file):
+		return file
+
+	@staticmethod
+	def flush(filePath):
+		# queued inserts are invisible to readTile until their batch commits;
+		# returns the tiles failed batches dropped
+		return BatchWriter.flushFile(filePath)
+
+	@staticmethod
+	def existingTiles(pathForTile, z, xStart, xEnd, yStart, yEnd):
+
+		filePath = pathForTile(xStart, yStart, z)
+		bitmap = TileBitmap(xStart, yStart, xEnd - xStart + 1, yEnd - yStart + 1)
+
+		if not os.path.exists(filePath):
+			return bitmap
+
+		maxRow = (2 ** z) - 1
+
+		connection = SqlitePool.get(filePath).readConnection()
+		c = connection.cursor()
+		c.execute("SELECT tile_column, tile_row FROM " + MbtilesWriter.tileTable(filePath) + " WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?", (z, xStart, xEnd, maxRow - yEnd, maxRow - yStart))
+
+		for x, invertedY in c:
+			bitmap.add(x, maxRow - invertedY)
+
+		return bitmap
+
 	@staticmethod
 	def close(lock, path, file, minZoom, maxZoom):
 
-		connection = sqlite3.connect(file, check_same_thread=False)
+		errors = BatchWriter.close(file)
+
+		table = MbtilesWriter.tileTable(file)
+
+		database = SqlitePool.get(file)
+		database.lock.acquire()
+		try:
+			connection = database.writeConnection()
+			if table == "map":
+				# replaced tiles can leave images nothing points at
+				connection.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map);")
+				connection.commit()
+			MbtilesWriter.updateBounds(connection, maxZoom, table)
+		finally:
+			database.lock.release()
+			SqlitePool.close(file)
+
+		with MbtilesWriter.layoutsLock:
+			MbtilesWriter.layouts.pop(os.path.abspath(file), None)
+			MbtilesWriter.imageCaches.pop(os.path.abspath(file), None)
+			MbtilesWriter.imageWriters.pop(os.path.abspath(file), None)
+
+		TileValidators.close(file)
+
+		return errors
+
+	@staticmethod
+	def tileBounds(connection, zoom, table="tiles"):
+		"""Return [minLon, minLat, maxLon, maxLat] of the tiles stored for zoom, or None."""
+
 		c = connection.cursor()
 
-		c.execute("SELECT min(tile_row), max(tile_row), min(tile_column), max(tile_column) from tiles WHERE zoom_level = ?", [maxZoom])
+		c.execute("SELECT min(tile_row), max(tile_row), min(tile_column), max(tile_column) from " + table + " WHERE zoom_level = ?", [zoom])
 
 		minY, maxY, minX, maxX = c.fetchone()
-		minY = (2 ** maxZoom) - minY - 1
-		maxY = (2 ** maxZoom) - maxY - 1
+		if minY is None:
+			return None
+
+		minY = (2 ** zoom) - minY - 1
+		maxY = (2 ** zoom) - maxY - 1
+
+		minLat, minLon = Utils.num2deg(minX, minY, zoom)
+		maxLat, maxLon = Utils.num2deg(maxX+1, maxY+1, zoom)
+
+		return [minLon, minLat, maxLon, maxLat]
+
+	@staticmethod
+	def updateBounds(connection, maxZoom, table="tiles"):
+
+		c = connection.cursor()
 
-		minLat, minLon = Utils.num2deg(minX, minY, maxZoom)
-		maxLat, maxLon = Utils.num2deg(maxX+1, maxY+1, maxZoom)
+		bounds = MbtilesWriter.tileBounds(connection, maxZoom, table)
+		if bounds is None:
+			return
 
-		bounds = [minLon, minLat, maxLon, maxLat]
+		minLon, minLat, maxLon, maxLat = bounds
 		boundsString = ','.join(map(str, bounds))
 
 		center = [(minLon + maxLon)/2, (minLat + maxLat)/2, maxZoom]
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+CLI to merge MBTiles/repo outputs of separate runs into one file.
+
+Example:
+    python merge_cli.py --output output/merged.mbtiles output/1763826004296 output/1763826011020/tiles.mbtiles --vacuum
+"""
+import argparse
+import os
+import time
+
+from tile_merge import TileMerge
+
+
+def source_file(path):
+	"""Accept a tileset file or an output directory holding one."""
+	if os.path.isdir(path):
+		files = sorted(f for f in os.listdir(path) if f.endswith((".mbtiles", ".repo")))
+		if not files:
+			raise SystemExit(f"No .mbtiles or .repo file in {path}")
+		return os.path.join(path, files[0])
+
+	if not os.path.isfile(path):
+		raise SystemExit(f"No such file: {path}")
+	return path
+
+
+def merge(args):
+	sources = [source_file(path) for path in args.sources]
+
+	if not os.path.exists(args.output):
+		TileMerge.create(args.output, sources[0], args.deduplicate)
+		print(f"Created {args.output} with the metadata of {sources[0]}")
+	elif args.deduplicate:
+		print("Warning: --deduplicate only applies to a new output file; keeping the existing layout")
+
+	try:
+		merger = TileMerge(args.output, args.conflict)
+	except ValueError as exc:
+		raise SystemExit(str(exc))
+
+	try:
+		for source in sources:
+			started = time.monotonic()
+			size = os.path.getsize(source)
+
+			try:
+				written = merger.mergeFile(source)
+			except ValueError as exc:
+				raise SystemExit(str(exc))
+
+			elapsed = max(time.monotonic() - started, 1e-6)
+			print(f"{source}: {written:,} tiles written in {elapsed:.1f}s ({size / elapsed / 1e6:,.0f} MB/s)")
+
+		if len(merger.formats) > 1:
+			print(f"Warning: the sources hold different tile formats ({', '.join(sorted(merger.formats))}); the output metadata names only one")
+
+		merger.updateBounds()
+
+		if args.vacuum or args.analyze:
+			started = time.monotonic()
+			merger.compact(args.vacuum, args.analyze)
+			print(f"Compacted in {time.monotonic() - started:.1f}s")
+	finally:
+		merger.close()
+
+	print(f"Done. {args.output}: {os.path.getsize(args.output) / 1e6:,.1f} MB")
+
+
+def build_parser():
+	parser = argparse.ArgumentParser(description="Merge MBTiles/repo files of separate runs (zoom ranges, regions or workers) into one file.")
+	parser.add_argument("sources", nargs="+", help="Source .mbtiles/.repo files, or output directories holding one")
+	parser.add_argument("--output", required=True, help="Target file; created with the first source's metadata if missing. A .repo name makes a repo file")
+	parser.add_argument("--conflict", choices=TileMerge.conflicts, default="last-wins", help="Which tile is kept when several files have it: the one merged last, or the one already there")
+	parser.add_argument("--deduplicate", action="store_true", help="Create a new MBTiles output in the deduplicated map/images layout")
+	parser.add_argument("--vacuum", action="store_true", help="VACUUM the output afterwards to drop free pages")
+	parser.add_argument("--analyze", action="store_true", help="ANALYZE the output afterwards for the query planner")
+	return parser
+
+
+def main():
+	args = build_parser().parse_args()
+
+	merge(args)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,237 @@
+import asyncio
+import email.utils
+import threading
+import time
+from urllib.parse import urlsplit
+
+class HostLimiter:
+	"""Token bucket plus AIMD concurrency window for one tile host.
+
+	Concurrency starts at the configured thread/in-flight count and is cut once
+	the host pushes back (403, 429, 5xx, connection errors or a latency spike).
+	Healthy responses grow it again by about one request per round trip, up to
+	the ceiling. A rate limit, if configured or learned from throttling, is
+	enforced with a token bucket; a learned one grows back no further than the
+	rate the host last throttled at.
+	"""
+
+	minConcurrency = 1
+	minRate = 0.5
+	maxRetryAfter = 300
+	spikeFactor = 4.0
+	spikeFloor = 1.0
+
+	def __init__(self, host, rate=None, maxConcurrency=1024, concurrency=None):
+		self.host = host
+		self.rate = rate
+		self.maxRate = rate
+		# rate the host was served at when it last pushed back
+		self.throttledRate = None
+		self.maxConcurrency = maxConcurrency
+		self.limit = float(min(concurrency or maxConcurrency, maxConcurrency))
+		self.inFlight = 0
+		self.tokens = 1.0
+		self.refilled = time.monotonic()
+		self.blockedUntil = 0
+		self.lastDecrease = 0
+		self.latency = None
+		self.baseline = None
+		self.condition = threading.Condition()
+		# (loop, future) of coroutines waiting for a release
+		self.waiters = []
+		self.counters = {"requests": 0, "throttled": 0, "spikes": 0}
+
+	def reserve(self):
+		"""Take a slot if possible; otherwise return seconds to wait, or None to wait for a release."""
+
+		now = time.monotonic()
+
+		if now < self.blockedUntil:
+			return self.blockedUntil - now
+
+		if self.inFlight >= int(self.limit):
+			return None
+
+		if self.rate is not None:
+			self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.refilled) * self.rate)
+			self.refilled = now
+			if self.tokens < 1:
+				return (1 - self.tokens) / self.rate
+			self.tokens -= 1
+
+		self.inFlight += 1
+		return 0
+
+	def acquire(self):
+		with self.condition:
+			while True:
+				delay = self.reserve()
+				if delay == 0:
+					return time.monotonic()
+				self.condition.wait(delay)
+
+	async def acquireAsync(self):
+		loop = asyncio.get_running_loop()
+
+		while True:
+			waiter = None
+			with self.condition:
+				delay = self.reserve()
+				if delay is None:
+					waiter = loop.create_future()
+					self.waiters.append((loop, waiter))
+
+			if delay == 0:
+				return time.monotonic()
+
+			if waiter is None:
+				await asyncio.sleep(delay)
+				continue
+
+			try:
+				await waiter
+			except asyncio.CancelledError:
+				with self.condition:
+					if (loop, waiter) in self.waiters:
+						self.waiters.remove((loop, waiter))
+						waiters = []
+					else:
+						# the release that woke this waiter goes to the next one
+						waiters = self.takeWaiters()
+				HostLimiter.wake(waiters)
+				raise
+
+	def release(self, started, status, retryAfter=None):
+
+		now = time.monotonic()
+		latency = now - started
+
+		with self.condition:
+			self.inFlight -= 1
+			self.counters["requests"] += 1
+
+			if status in (403, 429) or status >= 500 or status < 0:
+				self.counters["throttled"] += 1
+				if retryAfter:
+					self.blockedUntil = max(self.blockedUntil, now + min(retryAfter, HostLimiter.maxRetryAfter))
+				self.decrease(now, 0.5)
+
+			elif status > 0:
+				self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+				self.baseline = latency if self.baseline is None else min(latency, 0.99 * self.baseline + 0.01 * latency)
+
+				if latency > max(HostLimiter.spikeFloor, HostLimiter.spikeFactor * self.baseline):
+					self.counters["spikes"] += 1
+					self.decrease(now, 0.8)
+				else:
+					self.increase()
+
+			self.condition.notify_all()
+			waiters = self.takeWaiters()
+
+		HostLimiter.wake(waiters)
+
+	def takeWaiters(self):
+		# a release frees about one slot; waking every waiter would send the rest straight back
+		count = max(1, int(self.limit) - self.inFlight)
+		waiters, self.waiters = self.waiters[:count], self.waiters[count:]
+		return waiters
+
+	@staticmethod
+	def wake(waiters):
+
+		# release runs on request threads as well as on event loops
+		for loop, waiter in waiters:
+			try:
+				loop.call_soon_threadsafe(HostLimiter.resolve, waiter)
+			except RuntimeError:
+				# the waiter's loop is closed
+				pass
+
+	@staticmethod
+	def resolve(waiter):
+		if not waiter.done():
+			waiter.set_result(None)
+
+	def increase(self):
+		self.limit = min(self.maxConcurrency, self.limit + 1 / self.limit)
+
+		if self.rate is not None:
+			self.rate += 1 / max(self.rate, 1.0)
+			ceiling = self.maxRate if self.maxRate is not None else self.throttledRate
+			if ceiling is not None:
+				self.rate = min(self.rate, ceiling)
+
+	def decrease(self, now, factor):
+
+		# requests already in flight when the host pushed back count as one event
+		if now - self.lastDecrease < (self.latency or 1.0):
+			return
+		self.lastDecrease = now
+
+		self.limit = max(HostLimiter.minConcurrency, min(self.limit, self.inFlight + 1) * factor)
+
+		# without a configured rate, start from what the host was actually serving
+		current = self.rate if self.rate is not None else (self.inFlight + 1) / max(self.latency or 1.0, 1e-3)
+		self.throttledRate = current
+		self.rate = max(HostLimiter.minRate, current * factor)
+		self.tokens = min(self.tokens, 1.0)
+
+	def stats(self):
+		with self.condition:
+			return dict(self.counters, concurrency=int(self.limit), rate=self.rate)
+
+
+class RateLimiter:
+
+	rate = None
+	maxConcurrency = 1024
+	# starting concurrency window; the download's thread or in-flight count
+	concurrency = None
+
+	limiters = {}
+	limitersLock = threading.Lock()
+
+	@staticmethod
+	def configure(rate=None, maxConcurrency=None, concurrency=None):
+		if rate is not None:
+			RateLimiter.rate = rate
+		if maxConcurrency is not None:
+			RateLimiter.maxConcurrency = maxConcurrency
+		if concurrency is not None:
+			RateLimiter.concurrency = concurrency
+
+	@staticmethod
+	def forUrl(url):
+
+		host = urlsplit(url).netloc
+
+		with RateLimiter.limitersLock:
+			limiter = RateLimiter.limiters.get(host)
+			if limiter is None:
+				limiter = HostLimiter(host, RateLimiter.rate, RateLimiter.maxConcurrency, RateLimiter.concurrency)
+				RateLimiter.limiters[host] = limiter
+
+		return limiter
+
+	@staticmethod
+	def parseRetryAfter(value):
+
+		if not value:
+			return None
+
+		try:
+			return max(0.0, float(value))
+		except ValueError:
+			pass
+
+		try:
+			return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+		except (TypeError, ValueError):
+			return None
+
+	@staticmethod
+	def stats():
+		with RateLimiter.limitersLock:
+			limiters = list(RateLimiter.limiters.values())
+		return {limiter.host: limiter.stats() for limiter in limiters}
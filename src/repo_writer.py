@@ -8,9 +8,13 @@ import io
 from utils import Utils
 
 from mbtiles_writer import MbtilesWriter
+from sqlite_pool import SqlitePool
+from batch_writer import BatchWriter
 
 class RepoWriter(MbtilesWriter):
 
+	insertQuery = "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, tile_cropped_data, pixel_left, pixel_top, pixel_right, pixel_bottom, has_alpha) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"
+
 	@staticmethod
 	def addMetadata(lock, path, file, name, description, format, bounds, center, minZoom, maxZoom, profile="mercator", tileSize=256, extraMetadata=None):
 
@@ -18,77 +22,89 @@ class RepoWriter(MbtilesWriter):
 
 		extraMetadata = extraMetadata or {}
 
-		connection = sqlite3.connect(file, check_same_thread=False)
-		c = connection.cursor()
-		c.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text);")
-		c.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob, tile_cropped_data blob, pixel_left real, pixel_top real, pixel_right real, pixel_bottom real, has_alpha INTEGER);")
-		
+		database = SqlitePool.get(file)
+		database.lock.acquire()
 		try:
-			c.execute("CREATE UNIQUE INDEX tile_index on tiles (zoom_level, tile_column, tile_row);")
-		except:
-			pass
+			connection = database.writeConnection()
+			c = connection.cursor()
+			c.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text);")
+			c.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob, tile_cropped_data blob, pixel_left real, pixel_top real, pixel_right real, pixel_bottom real, has_alpha INTEGER);")
 
-		try:
-			c.execute("CREATE UNIQUE INDEX metadata_name ON metadata (name);")
-		except:
-			pass
-		
-		connection.commit()
-		
-		c = connection.cursor()
+			try:
+				c.execute("CREATE UNIQUE INDEX tile_index on tiles (zoom_level, tile_column, tile_row);")
+			except:
+				pass
 
-		
-		try:
-			metadata_rows = [
-				("name", name),
-				("description", description),
-				("format", format), 
-				("bounds", ','.join(map(str, bounds))), 
-				("center", ','.join(map(str, center))), 
-				("minzoom", minZoom), 
-				("maxzoom", maxZoom), 
-				("profile", profile), 
-				("tilesize", str(tileSize)), 
-				("scheme", "tms"), 
-				("generator", "Map Tiles Downloader via AliFlux"),
-				("type", "overlay"),
-				("attribution", "Map Tiles Downloader via AliFlux"),
-			]
-
-			for key, value in extraMetadata.items():
-				metadata_rows.append((key, str(value)))
-
-			c.executemany("INSERT INTO metadata (name, value) VALUES (?, ?);", metadata_rows)
+			try:
+				c.execute("CREATE UNIQUE INDEX metadata_name ON metadata (name);")
+			except:
+				pass
 
 			connection.commit()
-		except:
-			pass
+
+			c = connection.cursor()
+
+
+			try:
+				metadata_rows = [
+					("name", name),
+					("description", description),
+					("format", format), 
+					("bounds", ','.join(map(str, bounds))), 
+					("center", ','.join(map(str, center))), 
+					("minzoom", minZoom), 
+					("maxzoom", maxZoom), 
+					("profile", profile), 
+					("tilesize", str(tileSize)), 
+					("scheme", "tms"), 
+					("generator", "Map Tiles Downloader via AliFlux"),
+					("type", "overlay"),
+					("attribution", "Map Tiles Downloader via AliFlux"),
+				]
+
+				for key, value in extraMetadata.items():
+					metadata_rows.append((key, str(value)))
+
+				c.executemany("INSERT INTO metadata (name, value) VALUES (?, ?);", metadata_rows)
+
+				connection.commit()
+			except:
+				pass
+		finally:
+			database.lock.release()
 
 	@staticmethod
 	def addTile(lock, filePath, sourcePath, x, y, z, outputScale):
 
+		with open(sourcePath, "rb") as readFile:
+			tileData = readFile.read()
+
+		RepoWriter.addTileData(lock, filePath, tileData, x, y, z, outputScale)
+
+		return
+
+	@staticmethod
+	def addTileData(lock, filePath, tileData, x, y, z, outputScale):
+
 		fileDirectory = os.path.dirname(filePath)
 		RepoWriter.ensureDirectory(lock, fileDirectory)
 
 		invertedY = (2 ** z) - y - 1
 
-		tileData = []
-		with open(sourcePath, "rb") as readFile:
-			tileData = readFile.read()
-		
-		lock.acquire()
-		try:
+		BatchWriter.get(filePath, RepoWriter.insertQuery).put((z, x, invertedY, None, tileData, 0, 0, 256 * outputScale, 256 * outputScale, 0))
 
-			connection = sqlite3.connect(filePath, check_same_thread=False)
-			c = connection.cursor()
-			c.execute("INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data, tile_cropped_data, pixel_left, pixel_top, pixel_right, pixel_bottom, has_alpha) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", [
-				z, x, invertedY, None, tileData, 0, 0, 256 * outputScale, 256 * outputScale, 0
-			])
+		return
 
-			connection.commit()
+	@staticmethod
+	def readTile(filePath, x, y, z):
+		invertedY = (2 ** z) - y - 1
 
-		finally:
-			lock.release()
+		if not os.path.exists(filePath):
+			return None
 
+		connection = SqlitePool.get(filePath).readConnection()
+		c = connection.cursor()
+		c.execute("SELECT tile_cropped_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (z, x, invertedY))
 
-		return
+		row = c.fetchone()
+		return bytes(row[0]) if row and row[0] is not None else None
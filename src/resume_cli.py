@@ -3,22 +3,46 @@
 CLI helper to resume tile downloads without the browser UI.
 
 Example:
-    python resume_cli.py --output-dir output/1763826004296 --source "http://ecn.t0.tiles.virtualearth.net/tiles/a{quad}.jpeg?g=129&mkt=en&stl=H" --threads 4 --resume
+    python resume_cli.py --output-dir output/1763826004296 --source "http://ecn.t{switch:0,1,2,3}.tiles.virtualearth.net/tiles/a{quad}.jpeg?g=129&mkt=en&stl=H" --threads 4 --resume
 """
 import argparse
+import asyncio
+import functools
 import json
 import math
+import multiprocessing
 import os
+import shutil
+import socket
 import sqlite3
 import threading
-import uuid
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 
+from async_http import AsyncHttpPool
+from batch_writer import BatchWriter
+from blank_tiles import BlankTiles
+from coverage import TileCoverage
 from file_writer import FileWriter
+from http_pool import HttpPool
 from mbtiles_writer import MbtilesWriter
+from rate_limiter import RateLimiter
 from repo_writer import RepoWriter
+from shard_queue import ShardQueue
+from sqlite_pool import SqlitePool
+from tile_cache import TileCache
+from tile_journal import TileJournal
+from tile_merge import TileMerge
+from tile_template import TileTemplate
+from tile_validators import TileValidators
+from transcoder import Transcoder
 from utils import Utils
 
+PRESCAN_BITS = 1 << 26
+
+# a shard work unit is the quadtree cell this many levels above its tiles: 64x64 tiles at most
+SHARD_UNIT_SHIFT = 6
+
 
 def writer_by_type(output_type: str):
 	if output_type == "mbtiles":
@@ -120,8 +144,8 @@ def load_metadata(base_dir: str):
 	return meta
 
 
-def build_tile_list(bounds, min_zoom, max_zoom):
-	tiles = []
+def tile_ranges(bounds, min_zoom, max_zoom):
+	"""Yield (z, x_start, x_end, y_start, y_end) for every zoom level, inclusive."""
 	min_lon, min_lat, max_lon, max_lat = bounds
 
 	for z in range(min_zoom, max_zoom + 1):
@@ -130,30 +154,397 @@ def build_tile_list(bounds, min_zoom, max_zoom):
 		y_start = lat2tile(max_lat, z)
 		y_end = lat2tile(min_lat, z)
 
+		yield (z, x_start, x_end, y_start, y_end)
+
+
+def parse_cell(cell):
+	"""Parse "z/x/y" into a quadtree cell tuple."""
+	try:
+		z, x, y = map(int, cell.split("/"))
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"expected Z/X/Y, got {cell!r}")
+	if z < 0 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+		raise argparse.ArgumentTypeError(f"no tile {cell} exists")
+	return (z, x, y)
+
+
+def cell_range(cell, z):
+	"""Return the (x_start, x_end, y_start, y_end) tiles of zoom z inside cell."""
+	cell_z, cell_x, cell_y = cell
+	if z < cell_z:
+		# above the cell only its ancestor tile overlaps it
+		shift = cell_z - z
+		return (cell_x >> shift, cell_x >> shift, cell_y >> shift, cell_y >> shift)
+
+	shift = z - cell_z
+	return (cell_x << shift, ((cell_x + 1) << shift) - 1, cell_y << shift, ((cell_y + 1) << shift) - 1)
+
+
+def iter_columns(bounds, min_zoom, max_zoom, polygons=None, cell=None):
+	"""Yield (z, x, y_start, y_end) column spans covering the bounds or polygons, clipped to cell."""
+	if polygons:
+		for z in range(min_zoom, max_zoom + 1):
+			cell_x_start, cell_x_end, cell_y_start, cell_y_end = cell_range(cell, z) if cell else (0, 2 ** z - 1, 0, 2 ** z - 1)
+			# only the cell's columns are rasterized, so a work unit does not scan its whole zoom level
+			for x, y_start, y_end in TileCoverage.columns(polygons, z, (cell_x_start, cell_x_end) if cell else None):
+				y_start, y_end = max(y_start, cell_y_start), min(y_end, cell_y_end)
+				if y_start <= y_end:
+					yield (z, x, y_start, y_end)
+		return
+
+	for z, x_start, x_end, y_start, y_end in tile_ranges(bounds, min_zoom, max_zoom):
+		if cell:
+			cell_x_start, cell_x_end, cell_y_start, cell_y_end = cell_range(cell, z)
+			x_start, x_end = max(x_start, cell_x_start), min(x_end, cell_x_end)
+			y_start, y_end = max(y_start, cell_y_start), min(y_end, cell_y_end)
+			if y_start > y_end:
+				continue
 		for x in range(x_start, x_end + 1):
-			for y in range(y_start, y_end + 1):
-				tiles.append((x, y, z))
+			yield (z, x, y_start, y_end)
 
-	return tiles
 
+def count_tiles(bounds, min_zoom, max_zoom, polygons=None, cell=None):
+	if cell:
+		return sum(y_end - y_start + 1 for _, _, y_start, y_end in iter_columns(bounds, min_zoom, max_zoom, polygons, cell))
+	if polygons:
+		return TileCoverage.count(polygons, min_zoom, max_zoom)
+	return sum((x_end - x_start + 1) * (y_end - y_start + 1) for _, x_start, x_end, y_start, y_end in tile_ranges(bounds, min_zoom, max_zoom))
 
-def format_output_path(base_dir, output_file, x, y, z, quad):
-	replace_map = {
-		"{x}": str(x),
-		"{y}": str(y),
-		"{z}": str(z),
-		"{quad}": quad,
-	}
 
-	path = output_file
-	for key, value in replace_map.items():
-		path = path.replace(key, value)
+def iter_tiles(bounds, min_zoom, max_zoom, polygons=None, cell=None):
+	for z, x, y_start, y_end in iter_columns(bounds, min_zoom, max_zoom, polygons, cell):
+		for y in range(y_start, y_end + 1):
+			yield (x, y, z)
 
-	return os.path.join(base_dir, path)
 
+def iter_missing_tiles(bounds, min_zoom, max_zoom, writer, path_for_tile, progress, polygons=None, cell=None):
+	"""Yield only tiles the writer does not have yet, recording the rest as skipped.
 
-def download_tiles(args):
-	lock = threading.Lock()
+	Existing tiles are loaded with writer.existingTiles for stripes of adjacent
+	columns, so that a single bitmap never exceeds PRESCAN_BITS tiles.
+	"""
+	def scan(stripe):
+		z = stripe[0][0]
+		y_start = min(column[2] for column in stripe)
+		y_end = max(column[3] for column in stripe)
+		existing = writer.existingTiles(path_for_tile, z, stripe[0][1], stripe[-1][1], y_start, y_end)
+
+		skipped = 0
+		for _, x, column_start, column_end in stripe:
+			for y in range(column_start, column_end + 1):
+				if (x, y) in existing:
+					skipped += 1
+				else:
+					yield (x, y, z)
+
+		if skipped:
+			progress.record("skip", skipped)
+
+	stripe = []
+	for column in iter_columns(bounds, min_zoom, max_zoom, polygons, cell):
+		z, x, y_start, y_end = column
+
+		if stripe:
+			stripe_start = min(stripe_start, y_start)
+			stripe_end = max(stripe_end, y_end)
+			if z != stripe[0][0] or (x - stripe[0][1] + 1) * (stripe_end - stripe_start + 1) > PRESCAN_BITS:
+				yield from scan(stripe)
+				stripe = []
+
+		if not stripe:
+			stripe_start, stripe_end = y_start, y_end
+
+		stripe.append(column)
+
+	if stripe:
+		yield from scan(stripe)
+
+
+def build_tile_list(bounds, min_zoom, max_zoom):
+	return list(iter_tiles(bounds, min_zoom, max_zoom))
+
+
+def format_output_path(base_dir, output_file, x, y, z, quad=None):
+	return os.path.join(base_dir, TileTemplate.compile(output_file).render(x, y, z, quad))
+
+
+def output_path_builder(base_dir, output_file):
+	"""Return path_for_tile(x, y, z) with the pattern parsed once and quadkeys only when used."""
+	template = TileTemplate.compile(output_file)
+
+	def path_for_tile(x, y, z):
+		return os.path.join(base_dir, template.render(x, y, z))
+
+	return path_for_tile
+
+
+class Progress:
+	"""ok/skip/error counters that print a progress line every few seconds."""
+
+	def __init__(self, total, interval=5.0):
+		self.total = total
+		self.interval = interval
+		self.results = {"ok": 0, "skip": 0, "error": 0}
+		self.started = time.monotonic()
+		self.last_report = self.started
+
+	@property
+	def done(self):
+		return sum(self.results.values())
+
+	def record(self, status, count=1):
+		# "error 404" and friends are all counted as errors
+		key = status.split(" ", 1)[0]
+		self.results[key] = self.results.get(key, 0) + count
+
+		now = time.monotonic()
+		if now - self.last_report >= self.interval:
+			self.last_report = now
+			self.report()
+
+	def report(self):
+		done = self.done
+		elapsed = max(time.monotonic() - self.started, 1e-6)
+		percent = 100.0 * done / self.total if self.total else 100.0
+		unchanged = f"unchanged={self.results['unchanged']:,}, " if "unchanged" in self.results else ""
+		blank = f"blank={self.results['blank']:,}, " if "blank" in self.results else ""
+		print(f"Progress: {done:,}/{self.total:,} ({percent:.1f}%) ok={self.results.get('ok',0):,}, {unchanged}{blank}skipped={self.results.get('skip',0):,}, errors={self.results.get('error',0):,}, {done / elapsed:,.0f} tiles/s")
+
+
+def run_thread_engine(tiles, worker, threads, progress, cancelled=None):
+	"""Run worker(x, y, z) -> (x, y, z, status) for every tile on a thread pool.
+
+	Only a bounded window of futures is kept so memory does not grow with the
+	region. Stops scheduling new tiles once the optional cancelled event is set.
+	"""
+	window = threads * 4
+	future_map = {}
+
+	def collect(futures):
+		for future in futures:
+			x, y, z = future_map.pop(future)
+			try:
+				_, _, _, status = future.result()
+				progress.record(status)
+			except Exception as exc:
+				print(f"[{x},{y},{z}] failed: {exc}")
+				progress.record("error")
+
+	with ThreadPoolExecutor(max_workers=threads) as executor:
+		for x, y, z in tiles:
+			if cancelled is not None and cancelled.is_set():
+				break
+			if len(future_map) >= window:
+				done, _ = wait(future_map, return_when=FIRST_COMPLETED)
+				collect(done)
+			future_map[executor.submit(worker, x, y, z)] = (x, y, z)
+
+		collect(list(as_completed(future_map)))
+
+
+def overview_executor(processes):
+	# the server calls this from request threads, where forking can copy held locks;
+	# forkserver and spawn children start from a fresh interpreter instead
+	method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+	return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context(method))
+
+
+def overview_transcoder(source, output_scale, transcoder=None):
+	"""Encoder for overview tiles, so they match the format of downloaded ones."""
+	if transcoder is not None:
+		return transcoder
+
+	output_format = Transcoder.outputFormat(source, output_scale)
+	return Transcoder(output_format) if output_format != "png" else None
+
+
+def downsample_tile(child_data, transcoder=None):
+	# one process-pool task per overview tile: resample, then encode
+	tile_data = Utils.downsampleTileData(child_data)
+	if tile_data is not None and transcoder is not None:
+		tile_data = transcoder.encode(tile_data)
+	return tile_data
+
+
+def build_overviews(bounds, min_zoom, max_zoom, writer, lock, path_for_tile, progress, output_scale, polygons=None, processes=None, resume=False, cancelled=None, transcoder=None, blank_policy="keep"):
+	"""Build zoom levels min_zoom..max_zoom-1 by downsampling the level below.
+
+	Levels are processed bottom-up, each one flushed before the next reads it.
+	Reading and writing tiles happens on threads; PIL resampling (and encoding
+	with transcoder, if given) runs on a process pool. Empty subtrees are
+	skipped, and with a blank_policy other than "keep" uniform ones are carried
+	up without resampling.
+	"""
+	processes = processes or os.cpu_count() or 1
+	executor = overview_executor(processes)
+	threads = processes * 2
+
+	def worker(x, y, z):
+		children = Utils.getChildGrid(x, y, z, 2)
+		child_data = [writer.readTile(path_for_tile(cx, cy, cz), cx, cy, cz) for cx, cy, cz in children]
+
+		# an empty subtree (dropped blanks, placeholders) has nothing to build from
+		if all(data is None for data in child_data):
+			return (x, y, z, "blank")
+
+		# four copies of one solid tile downsample to that same tile
+		if blank_policy != "keep" and child_data.count(child_data[0]) == 4 and BlankTiles.solidColor(child_data[0]) is not None:
+			writer.addTileData(lock, path_for_tile(x, y, z), child_data[0], x, y, z, output_scale)
+			return (x, y, z, "ok")
+
+		tile_data = executor.submit(downsample_tile, child_data, transcoder).result()
+		if tile_data is None:
+			return (x, y, z, "error missing children")
+
+		writer.addTileData(lock, path_for_tile(x, y, z), tile_data, x, y, z, output_scale)
+		return (x, y, z, "ok")
+
+	try:
+		for z in range(max_zoom - 1, min_zoom - 1, -1):
+			if cancelled is not None and cancelled.is_set():
+				break
+
+			writer.flush(path_for_tile(0, 0, z + 1))
+			writer.prepareDirectories(path_for_tile, iter_columns(bounds, z, z, polygons))
+
+			if resume:
+				tiles = iter_missing_tiles(bounds, z, z, writer, path_for_tile, progress, polygons)
+			else:
+				tiles = iter_tiles(bounds, z, z, polygons)
+
+			run_thread_engine(tiles, worker, threads, progress, cancelled)
+
+		writer.flush(path_for_tile(0, 0, min_zoom))
+	finally:
+		executor.shutdown()
+
+
+async def download_tiles_async(args, tiles, progress, writer, lock, source, output_file, output_scale, validator_path, transcoder=None, transcode_executor=None, journal=None):
+	"""Download tiles on an event loop, keeping up to --in-flight tiles outstanding."""
+	loop = asyncio.get_running_loop()
+	pool = AsyncHttpPool(maxPerHost=args.in_flight, timeout=HttpPool.timeout)
+	# writers and PIL block, so they run off the loop
+	io_executor = ThreadPoolExecutor(max_workers=args.threads)
+	semaphore = asyncio.Semaphore(args.in_flight)
+	pending = set()
+	source_template = TileTemplate.compile(source)
+	path_for_tile = output_path_builder(args.output_dir, output_file)
+
+	async def fetch(x, y, z):
+		url = source_template.render(x, y, z)
+
+		if TileCache.enabled:
+			cached = await loop.run_in_executor(io_executor, TileCache.get, url)
+			if cached is not None:
+				if BlankTiles.isPlaceholder(url, cached["data"]):
+					return (204, None, cached["validators"])
+				return (200, cached["data"], cached["validators"])
+
+		limiter = RateLimiter.forUrl(url)
+		started = await limiter.acquireAsync()
+
+		try:
+			status, headers, body = await pool.fetch(url, Utils.build_headers(url))
+		except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as exc:
+			print(exc)
+			limiter.release(started, -1)
+			return (-1, None, None)
+
+		limiter.release(started, status, RateLimiter.parseRetryAfter(headers.get("retry-after")))
+
+		validators = {"etag": headers.get("etag"), "lastModified": headers.get("last-modified")}
+
+		if status != 200:
+			return (status, None, validators)
+
+		if BlankTiles.isPlaceholder(url, body):
+			return (204, None, validators)
+
+		return (status, body, validators)
+
+	async def fetch_scaled(x, y, z):
+		if output_scale == 1:
+			return await fetch(x, y, z)
+
+		if not Utils.isValidScale(output_scale):
+			return (0, None, None)
+
+		# composed tiles have no single upstream validator
+		children = await asyncio.gather(*(fetch(cx, cy, cz) for cx, cy, cz in Utils.getChildGrid(x, y, z, output_scale)))
+		for code, _, _ in children:
+			if code not in (200, 204):
+				return (code, None, None)
+
+		# placeholder children are empty cells; only an all-placeholder grid is blank
+		if all(code == 204 for code, _, _ in children):
+			return (204, None, None)
+
+		tile_data = await loop.run_in_executor(io_executor, Utils.mergeTileGridData, [data for _, data, _ in children], output_scale)
+		return (200, tile_data, None)
+
+	async def worker(x, y, z):
+		target_path = path_for_tile(x, y, z)
+
+		for attempt in range(1, args.retries + 1):
+			code, tile_data, validators = await fetch_scaled(x, y, z)
+			if code == 204:
+				return "blank", attempt
+			if code == 200:
+				# validators describe the upstream bytes, so hash before transcoding
+				if validators is not None and args.store_validators:
+					await loop.run_in_executor(io_executor, TileValidators.put, validator_path, x, y, z, validators, TileValidators.contentHash(tile_data))
+				if args.blank_tiles != "keep":
+					tile_data = await loop.run_in_executor(io_executor, BlankTiles.apply, tile_data, args.blank_tiles)
+					if tile_data is None:
+						return "blank", attempt
+				if transcoder is not None:
+					tile_data = await loop.run_in_executor(transcode_executor, transcoder.encode, tile_data)
+				await loop.run_in_executor(io_executor, writer.addTileData, lock, target_path, tile_data, x, y, z, output_scale)
+				return "ok", attempt
+			if attempt == args.retries:
+				return f"error {code}", attempt
+
+	async def run(x, y, z):
+		try:
+			status, attempts = await worker(x, y, z)
+		except Exception as exc:
+			print(f"[{x},{y},{z}] failed: {exc}")
+			status, attempts = "error", None
+		finally:
+			semaphore.release()
+
+		progress.record(status)
+		if journal is not None:
+			# a checkpoint flushes the writer, so keep it off the loop
+			await loop.run_in_executor(io_executor, journal.record, x, y, z, status, attempts)
+
+	for x, y, z in tiles:
+		await semaphore.acquire()
+		task = asyncio.ensure_future(run(x, y, z))
+		pending.add(task)
+		task.add_done_callback(pending.discard)
+
+	if pending:
+		await asyncio.wait(pending)
+
+	await pool.close()
+	io_executor.shutdown()
+
+	return dict(pool.stats(), hosts=pool.hostStats())
+
+
+@functools.lru_cache(maxsize=None)
+def load_polygons(path):
+	# shard workers resolve the job once per work unit; the GeoJSON is parsed once per process
+	try:
+		with open(path, "r", encoding="utf-8") as f:
+			return TileCoverage.polygonsFromGeoJSON(json.load(f))
+	except (OSError, ValueError, KeyError, TypeError) as exc:
+		raise SystemExit(f"Cannot read polygons from {path}: {exc}")
+
+
+def resolve_job(args):
+	"""Combine the output directory's metadata with the command line overrides."""
 	meta = load_metadata(args.output_dir)
 
 	output_type = args.output_type or meta["outputType"]
@@ -163,75 +554,532 @@ def download_tiles(args):
 	max_zoom = args.max_zoom if args.max_zoom is not None else meta["maxZoom"]
 	source = args.source or meta["source"]
 
-	if min_zoom is None or max_zoom is None or not meta["bounds"]:
+	polygons = load_polygons(args.polygon) if args.polygon else None
+	bounds = meta["bounds"] or (TileCoverage.bounds(polygons) if polygons else None)
+
+	if min_zoom is None or max_zoom is None or not bounds:
 		raise SystemExit("Missing bounds or zoom levels in metadata. Please provide --min-zoom, --max-zoom, and ensure metadata has bounds.")
 
 	if not source:
 		raise SystemExit("Tile source URL is required. Provide --source.")
 
-	tiles = build_tile_list(meta["bounds"], min_zoom, max_zoom)
+	return output_type, output_file, output_scale, min_zoom, max_zoom, source, polygons, bounds
+
+
+def download_tiles(args, shard=False, validator_path=None):
+	"""Download the tiles of the job; shard=True runs one work unit of a sharded download quietly.
+
+	validator_path overrides where ETags and content hashes are stored.
+	"""
+	lock = threading.Lock()
+	output_type, output_file, output_scale, min_zoom, max_zoom, source, polygons, bounds = resolve_job(args)
+
+	if args.cell and args.overview_from_max_zoom:
+		raise SystemExit("--cell limits the download to one quadtree cell; overviews need the whole region. Drop --overview-from-max-zoom.")
+
+	if args.refresh and (args.resume or args.engine != "thread" or output_scale != 1):
+		raise SystemExit("--refresh revisits every tile with the thread engine at output scale 1; drop --resume/--engine async/--output-scale.")
+
+	use_journal = args.journal or args.retry_failed
+	if args.refresh and use_journal:
+		raise SystemExit("--refresh revisits every tile; it cannot be combined with --journal/--retry-failed.")
+	if args.resume and use_journal:
+		raise SystemExit("--journal skips the tiles it recorded as finished instead of scanning the output; drop --resume.")
+
+	try:
+		transcoder = Transcoder(args.transcode, args.quality, args.colors, args.lossless) if args.transcode else None
+	except ValueError as exc:
+		raise SystemExit(str(exc))
+
+	if args.placeholders:
+		BlankTiles.loadPlaceholders(args.placeholders)
+	if args.placeholder_hash:
+		BlankTiles.addPlaceholders(Utils.sourceHosts(source), args.placeholder_hash)
+
+	HttpPool.configure(maxPerHost=max(args.pool_size, args.threads))
+	RateLimiter.configure(rate=args.rate_limit, concurrency=args.in_flight if args.engine == "async" else args.threads)
+	# --refresh has to ask the source, not the cache
+	if args.tile_cache and not args.refresh:
+		TileCache.configure(directory=args.tile_cache)
+	BatchWriter.batchSize = args.batch_size
+	BatchWriter.flushInterval = args.batch_interval / 1000.0
+	FileWriter.syncEvery = args.fsync_every
+
+	total = count_tiles(bounds, min_zoom, max_zoom, polygons, args.cell)
+	progress = Progress(total)
 	writer = writer_by_type(output_type)
 
-	print(f"Found {len(tiles):,} tiles to consider across zoom {min_zoom}-{max_zoom}")
-	print(f"Output type: {output_type}, scale: {output_scale}, file pattern: {output_file}")
-	print(f"Resume mode: {'on' if args.resume else 'off'}; Threads: {args.threads}")
+	path_for_tile = output_path_builder(args.output_dir, output_file)
 
-	def worker(x, y, z):
-		quad = Utils.makeQuadKey(x, y, z)
-		target_path = format_output_path(args.output_dir, output_file, x, y, z, quad)
+	# with overviews only the max zoom comes from the tile source
+	download_min_zoom = max_zoom if args.overview_from_max_zoom else min_zoom
+
+	journal = None
+
+	if use_journal:
+		signature = {
+			"bounds": bounds,
+			"minZoom": download_min_zoom,
+			"maxZoom": max_zoom,
+			"polygons": TileValidators.contentHash(json.dumps(polygons).encode("utf-8")) if polygons else None,
+		}
+		if args.cell:
+			signature["cell"] = args.cell
+		journal = TileJournal(os.path.join(args.output_dir, ".tile-journal.sqlite"), signature, args.retries, lambda: writer.flush(path_for_tile(0, 0, max_zoom)))
+		finished, failed = journal.skipped()
+
+		if args.retry_failed:
+			print(f"Journal: retrying {failed:,} failed tiles")
+			progress.record("skip", count_tiles(bounds, download_min_zoom, max_zoom, polygons, args.cell) - failed)
+			tiles = journal.failedTiles()
+		else:
+			print(f"Journal: {finished:,} tiles already finished, {failed:,} failed")
+			progress.record("skip", finished + failed)
+			tiles = journal.tiles(iter_columns(bounds, download_min_zoom, max_zoom, polygons, args.cell))
+	elif args.resume:
+		tiles = iter_missing_tiles(bounds, download_min_zoom, max_zoom, writer, path_for_tile, progress, polygons, args.cell)
+	else:
+		tiles = iter_tiles(bounds, download_min_zoom, max_zoom, polygons, args.cell)
 
-		if args.resume and writer.exists(target_path, x, y, z):
-			return (x, y, z, "skip")
+	writer.prepareDirectories(path_for_tile, iter_columns(bounds, download_min_zoom, max_zoom, polygons, args.cell))
 
-		temp_file = os.path.join("temp", f"{uuid.uuid4().hex}.png")
+	if not shard:
+		print(f"Found {total:,} tiles to consider across zoom {min_zoom}-{max_zoom}")
+		if args.overview_from_max_zoom:
+			print(f"Downloading zoom {max_zoom} only; lower zooms are built from it")
+		print(f"Output type: {output_type}, scale: {output_scale}, file pattern: {output_file}")
+		if args.refresh:
+			print(f"Refresh mode: conditional requests for every tile; Threads: {args.threads}")
+		elif args.engine == "async":
+			print(f"Resume mode: {'on' if args.resume else 'off'}; Engine: async, in-flight: {args.in_flight}")
+		else:
+			print(f"Resume mode: {'on' if args.resume else 'off'}; Threads: {args.threads}")
+
+		if transcoder is not None:
+			print(f"Transcoding tiles to {transcoder.format}")
+
+	validator_path = validator_path or writer.validatorPath(args.output_dir, os.path.join(args.output_dir, output_file))
+	# hashing and storing validators only pays off for a later --refresh
+	store_validators = args.refresh or args.store_validators
+	transcode_executor = overview_executor(args.transcode_processes or os.cpu_count() or 1) if transcoder is not None else None
+
+	def download(x, y, z):
+		"""Return the worker result and the number of attempts it took."""
+		target_path = path_for_tile(x, y, z)
+
+		stored = TileValidators.get(validator_path, x, y, z) if args.refresh else None
+		etag, last_modified, stored_hash = stored or (None, None, None)
 
 		for attempt in range(1, args.retries + 1):
-			code = Utils.downloadFileScaled(source, temp_file, x, y, z, output_scale)
+			# composed 2x+ tiles have no single upstream validator
+			if output_scale == 1:
+				code, tile_data, validators = Utils.downloadTileConditional(source, x, y, z, etag, last_modified)
+			else:
+				code, tile_data = Utils.downloadTileScaled(source, x, y, z, output_scale)
+				validators = None
+
+			if code == 304:
+				return (x, y, z, "unchanged"), attempt
+
+			if code == 204:
+				return (x, y, z, "blank"), attempt
+
 			if code == 200:
-				writer.addTile(lock, target_path, temp_file, x, y, z, output_scale)
-				try:
-					os.remove(temp_file)
-				except OSError:
-					pass
-				return (x, y, z, "ok")
+				if validators is not None and store_validators:
+					content_hash = TileValidators.contentHash(tile_data)
+					TileValidators.put(validator_path, x, y, z, validators, content_hash)
+					# the host ignored the conditional headers, but the bytes did not change
+					if content_hash == stored_hash:
+						return (x, y, z, "unchanged"), attempt
+
+				tile_data = BlankTiles.apply(tile_data, args.blank_tiles)
+				if tile_data is None:
+					return (x, y, z, "blank"), attempt
+
+				if transcoder is not None:
+					tile_data = transcode_executor.submit(transcoder.encode, tile_data).result()
+
+				writer.addTileData(lock, target_path, tile_data, x, y, z, output_scale)
+				return (x, y, z, "ok"), attempt
+
 			if attempt == args.retries:
-				try:
-					os.remove(temp_file)
-				except OSError:
-					pass
-				return (x, y, z, f"error {code}")
-
-	results = {"ok": 0, "skip": 0, "error": 0}
-
-	with ThreadPoolExecutor(max_workers=args.threads) as executor:
-		future_map = {executor.submit(worker, x, y, z): (x, y, z) for x, y, z in tiles}
-		for future in as_completed(future_map):
-			x, y, z = future_map[future]
+				return (x, y, z, f"error {code}"), attempt
+
+	def worker(x, y, z):
+		return download(x, y, z)[0]
+
+	def journaled_worker(x, y, z):
+		try:
+			result, attempts = download(x, y, z)
+		except Exception:
+			journal.record(x, y, z, "error")
+			raise
+
+		journal.record(*result, attempts=attempts)
+		return result
+
+	try:
+		if args.engine == "async":
+			pool_stats = asyncio.run(download_tiles_async(args, tiles, progress, writer, lock, source, output_file, output_scale, validator_path, transcoder, transcode_executor, journal))
+		else:
+			run_thread_engine(tiles, journaled_worker if journal is not None else worker, args.threads, progress)
+			pool_stats = dict(HttpPool.stats(), hosts=HttpPool.hostStats())
+	finally:
+		if transcode_executor is not None:
+			transcode_executor.shutdown()
+		if journal is not None:
+			journal.close()
+
+	if journal is not None and journal.failed:
+		print(f"Journal: {len(journal.failed):,} tiles failed; rerun with --retry-failed to retry only those")
+
+	if args.overview_from_max_zoom and min_zoom < max_zoom:
+		build_overviews(bounds, min_zoom, max_zoom, writer, lock, path_for_tile, progress, output_scale, polygons, args.overview_processes, args.resume, transcoder=overview_transcoder(source, output_scale, transcoder), blank_policy=args.blank_tiles)
+
+	# a sharded download updates the final file's metadata once, in the coordinator
+	if transcoder is not None and not shard:
+		writer.updateMetadata(lock, args.output_dir, os.path.join(args.output_dir, output_file), {"format": transcoder.format})
+
+	# flush queued MBTiles/repo inserts and pending fsyncs; writer.close would also
+	# snap the stored bounds outwards to tile edges, which grows the range on every resume
+	write_errors = writer.flush(path_for_tile(0, 0, min_zoom))
+	# validators inside the MBTiles/repo file were flushed with it; a sidecar is flushed on its own
+	if os.path.abspath(validator_path) != os.path.abspath(path_for_tile(0, 0, min_zoom)):
+		write_errors += TileValidators.flush(validator_path)
+	BatchWriter.closeAll()
+	SqlitePool.closeAll()
+
+	if write_errors:
+		# these tiles were counted when they were queued
+		progress.results["ok"] = max(0, progress.results.get("ok", 0) - write_errors)
+		progress.record("error", write_errors)
+		print(f"Failed to write {write_errors:,} tiles to the output; rerun with --resume to download them again")
+
+	results = progress.results
+	if shard:
+		return results
+
+	print(f"Done. ok={results.get('ok',0)}, unchanged={results.get('unchanged',0)}, blank={results.get('blank',0)}, skipped={results.get('skip',0)}, errors={results.get('error',0)}")
+	print(f"HTTP connections: reused={pool_stats['hits']:,}, opened={pool_stats['misses']:,}")
+	# one line per host, so {s}/{switch:...} shards show how load was spread
+	for host, stats in RateLimiter.stats().items():
+		rate = f"{stats['rate']:.1f}/s" if stats["rate"] is not None else "unlimited"
+		connections = pool_stats["hosts"].get(host, {"hits": 0, "misses": 0})
+		print(f"{host}: requests={stats['requests']:,}, connections opened={connections['misses']:,}, throttled={stats['throttled']:,}, latency spikes={stats['spikes']:,}, concurrency={stats['concurrency']}, rate={rate}")
+
+	return results
+
+
+def shard_units(bounds, min_zoom, max_zoom, polygons=None):
+	"""Yield (z, cell_z, cell_x, cell_y) work units, in quadkey order within each zoom."""
+	for z in range(min_zoom, max_zoom + 1):
+		cell_z = max(0, z - SHARD_UNIT_SHIFT)
+		shift = z - cell_z
+
+		cells = set()
+		for _, x, y_start, y_end in iter_columns(bounds, z, z, polygons):
+			for cell_y in range(y_start >> shift, (y_end >> shift) + 1):
+				cells.add((x >> shift, cell_y))
+
+		# neighbouring cells in quadkey order share parents, which keeps a worker's shard file compact
+		for cell_x, cell_y in sorted(cells, key=lambda cell: quadkey_order(cell[0], cell[1], cell_z)):
+			yield (z, cell_z, cell_x, cell_y)
+
+
+def quadkey_order(x, y, z):
+	# the quadkey digits read as one base-4 number
+	order = 0
+	for bit in range(z - 1, -1, -1):
+		order = (order << 2) | (((y >> bit) & 1) << 1) | ((x >> bit) & 1)
+	return order
+
+
+def shard_queue_path(output_dir):
+	return os.path.join(output_dir, ".shards", "queue.sqlite")
+
+
+def shard_worker(args):
+	"""Claim work units from the output directory's shard queue until none are left.
+
+	MBTiles tiles go to a shard file of this worker under .shards, so workers
+	never wait on each other's write lock; directory output is written in place,
+	with the validators sidecar under .shards like a shard file.
+	"""
+	queue_path = shard_queue_path(args.output_dir)
+	if not os.path.isfile(queue_path):
+		raise SystemExit(f"No shard queue at {queue_path}; start the download with --shards first.")
+
+	output_type, output_file, _, _, _, _, _, _ = resolve_job(args)
+	worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+	unit_args = argparse.Namespace(**vars(args))
+	unit_args.overview_from_max_zoom = False
+
+	shard_dir = os.path.join(args.output_dir, ".shards", worker_id)
+	validator_path = None
+
+	if output_type == "mbtiles":
+		create_shard_file(args.output_dir, shard_dir, output_file)
+		unit_args.output_dir = shard_dir
+	else:
+		validator_path = FileWriter.validatorPath(shard_dir, None)
+
+	queue = ShardQueue(queue_path)
+	done = 0
+
+	try:
+		while True:
+			unit = queue.claim(worker_id)
+			if unit is None:
+				break
+
+			unit_id, z, cell_z, cell_x, cell_y = unit
+			unit_args.min_zoom = unit_args.max_zoom = z
+			unit_args.cell = (cell_z, cell_x, cell_y)
+
+			# renew the lease while the unit runs, so it is not handed out twice
+			running = threading.Event()
+			heartbeat = threading.Thread(target=renew_lease, args=(queue, unit_id, worker_id, running), daemon=True)
+			heartbeat.start()
 			try:
-				_, _, _, status = future.result()
-				results[status] = results.get(status, 0) + 1
-			except Exception as exc:
-				print(f"[{x},{y},{z}] failed: {exc}")
-				results["error"] = results.get("error", 0) + 1
+				results = download_tiles(unit_args, shard=True, validator_path=validator_path)
+			finally:
+				running.set()
+				heartbeat.join()
 
-	print(f"Done. ok={results.get('ok',0)}, skipped={results.get('skip',0)}, errors={results.get('error',0)}")
+			queue.finish(unit_id, worker_id, results.get("ok", 0) + results.get("unchanged", 0) + results.get("blank", 0) + results.get("skip", 0), results.get("error", 0))
+			done += 1
+	finally:
+		queue.close()
 
+	print(f"Worker {worker_id}: finished {done:,} units")
 
-def main():
+
+def release_dead_units(queue):
+	"""Free units leased to workers of this host that no longer run, instead of waiting out their lease."""
+	hostname = socket.gethostname()
+	for unit_id, worker_id in queue.running().items():
+		host, _, pid = worker_id.rpartition("-")
+		if host != hostname or not pid.isdigit():
+			continue
+		try:
+			os.kill(int(pid), 0)
+		except ProcessLookupError:
+			queue.release(unit_id, worker_id)
+		except PermissionError:
+			pass
+
+
+def renew_lease(queue, unit_id, worker_id, stopped):
+	while not stopped.wait(ShardQueue.lease / 4):
+		queue.renew(unit_id, worker_id)
+
+
+def create_shard_file(output_dir, shard_dir, output_file):
+	"""Create a worker's shard MBTiles with the final file's metadata, so resolve_job reads the same job from it."""
+	shard_file = os.path.join(shard_dir, output_file)
+	if os.path.exists(shard_file):
+		return
+
+	connection = sqlite3.connect(os.path.join(output_dir, output_file))
+	try:
+		metadata = dict(connection.execute("SELECT name, value FROM metadata").fetchall())
+	finally:
+		connection.close()
+
+	lock = threading.Lock()
+	# always the plain layout, which merges with a single INSERT ... SELECT
+	MbtilesWriter.addMetadata(lock, shard_dir, shard_file, metadata.get("name", ""), metadata.get("description", ""), metadata.get("format", "png"), parse_bounds(metadata.get("bounds")) or [], parse_bounds(metadata.get("center")) or [], metadata.get("minzoom"), metadata.get("maxzoom"))
+	MbtilesWriter.updateMetadata(lock, shard_dir, shard_file, metadata)
+	SqlitePool.close(shard_file)
+
+
+def merge_shards(output_dir, output_file):
+	"""Copy every worker's shard MBTiles into the final file, then delete them."""
+	shards_dir = os.path.join(output_dir, ".shards")
+	merger = TileMerge(os.path.join(output_dir, output_file))
+
+	merged = 0
+	try:
+		for entry in sorted(os.scandir(shards_dir), key=lambda entry: entry.name):
+			shard_file = os.path.join(entry.path, output_file)
+			if not entry.is_dir() or not os.path.isfile(shard_file):
+				continue
+
+			merger.mergeFile(shard_file)
+			shutil.rmtree(entry.path)
+			merged += 1
+	finally:
+		merger.close()
+
+	return merged
+
+
+def merge_shard_validators(output_dir):
+	"""Copy every worker's validators sidecar into the directory output's one."""
+	shards_dir = os.path.join(output_dir, ".shards")
+	target = FileWriter.validatorPath(output_dir, None)
+
+	merged = 0
+	for entry in sorted(os.scandir(shards_dir), key=lambda entry: entry.name):
+		shard_validators = FileWriter.validatorPath(entry.path, None)
+		if not entry.is_dir() or not os.path.isfile(shard_validators):
+			continue
+
+		TileValidators.merge(target, shard_validators)
+		shutil.rmtree(entry.path)
+		merged += 1
+
+	TileValidators.close(target)
+	return merged
+
+
+def download_sharded(args):
+	"""Split the job into work units, run them on args.shards local worker processes and merge the results."""
+	output_type, output_file, output_scale, min_zoom, max_zoom, source, polygons, bounds = resolve_job(args)
+
+	if output_type == "repo":
+		raise SystemExit("--shards writes MBTiles or directory output; repo output is not supported.")
+	if args.refresh or args.journal or args.retry_failed or args.cell:
+		raise SystemExit("--shards tracks progress in its own queue; drop --refresh/--journal/--retry-failed/--cell.")
+
+	download_min_zoom = max_zoom if args.overview_from_max_zoom else min_zoom
+	queue_path = shard_queue_path(args.output_dir)
+	os.makedirs(os.path.dirname(queue_path), exist_ok=True)
+
+	signature = {
+		"bounds": bounds,
+		"minZoom": download_min_zoom,
+		"maxZoom": max_zoom,
+		"polygons": TileValidators.contentHash(json.dumps(polygons).encode("utf-8")) if polygons else None,
+		"unitShift": SHARD_UNIT_SHIFT,
+	}
+
+	queue = ShardQueue(queue_path, signature)
+	if not queue.matches():
+		queue.fill(shard_units(bounds, download_min_zoom, max_zoom, polygons))
+	else:
+		release_dead_units(queue)
+
+	counts = queue.counts()
+	queue.close()
+
+	print(f"Shard queue: {counts['pending'] + counts['running'] + counts['done']:,} units, {counts['done']:,} already done")
+	print(f"Starting {args.shards} worker processes; more hosts can join with --shard-worker --output-dir {args.output_dir}")
+
+	# pooled connections must not be shared with forked children
+	BatchWriter.closeAll()
+	SqlitePool.closeAll()
+
+	# --rate-limit is per process; the local workers share it
+	worker_args = argparse.Namespace(**vars(args))
+	if args.rate_limit:
+		worker_args.rate_limit = args.rate_limit / args.shards
+
+	context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else multiprocessing
+	workers = [context.Process(target=shard_worker, args=(worker_args,)) for _ in range(args.shards)]
+	for process in workers:
+		process.start()
+	for process in workers:
+		process.join()
+
+	queue = ShardQueue(queue_path, signature)
+	try:
+		# units of crashed workers come back once their lease runs out; remote workers may still be busy
+		while True:
+			counts = queue.counts()
+			if counts["claimable"]:
+				shard_worker(args)
+			elif counts["pending"] or counts["running"]:
+				time.sleep(5)
+				release_dead_units(queue)
+			else:
+				break
+	finally:
+		queue.close()
+
+	lock = threading.Lock()
+	writer = writer_by_type(output_type)
+	path_for_tile = output_path_builder(args.output_dir, output_file)
+
+	if output_type == "mbtiles":
+		merged = merge_shards(args.output_dir, output_file)
+		print(f"Merged {merged:,} shard files into {output_file}")
+	else:
+		merge_shard_validators(args.output_dir)
+
+	if os.path.isfile(queue_path):
+		os.remove(queue_path)
+	shutil.rmtree(os.path.dirname(queue_path), ignore_errors=True)
+
+	if args.overview_from_max_zoom and min_zoom < max_zoom:
+		progress = Progress(count_tiles(bounds, min_zoom, max_zoom - 1, polygons))
+		transcoder = Transcoder(args.transcode, args.quality, args.colors, args.lossless) if args.transcode else None
+		build_overviews(bounds, min_zoom, max_zoom, writer, lock, path_for_tile, progress, output_scale, polygons, args.overview_processes, args.resume, transcoder=overview_transcoder(source, output_scale, transcoder), blank_policy=args.blank_tiles)
+
+	if args.transcode:
+		writer.updateMetadata(lock, args.output_dir, os.path.join(args.output_dir, output_file), {"format": args.transcode})
+
+	write_errors = writer.flush(path_for_tile(0, 0, min_zoom))
+	BatchWriter.closeAll()
+	SqlitePool.closeAll()
+
+	if write_errors:
+		print(f"Failed to write {write_errors:,} overview tiles to the output")
+
+	print(f"Done. ok={counts['ok']:,}, errors={counts['errors'] + write_errors:,}")
+
+
+def build_parser():
 	parser = argparse.ArgumentParser(description="Resume tile download from an existing output directory.")
 	parser.add_argument("--output-dir", required=True, help="Path to existing output directory (e.g. output/1763826004296)")
-	parser.add_argument("--source", help="Tile URL template (required if not stored in metadata)")
+	parser.add_argument("--source", help="Tile URL template (required if not stored in metadata); {s} or {switch:a,b,c} spreads tiles across hosts")
 	parser.add_argument("--threads", type=int, default=4, help="Parallel download threads")
+	parser.add_argument("--engine", choices=["thread", "async"], default="thread", help="Download engine: a thread pool or an asyncio event loop")
+	parser.add_argument("--in-flight", type=int, default=500, help="Concurrent tile requests for --engine async")
 	parser.add_argument("--resume", action="store_true", help="Skip tiles that already exist")
+	parser.add_argument("--journal", action="store_true", help="Record per-tile progress in a journal in the output directory; a rerun continues from its last checkpoint")
+	parser.add_argument("--retry-failed", action="store_true", help="Only download the tiles the journal recorded as failed (implies --journal)")
+	parser.add_argument("--shards", type=int, help="Split the download into quadtree work units and run them on this many worker processes; MBTiles shards are merged at the end")
+	parser.add_argument("--shard-worker", action="store_true", help="Join a running --shards download from another host; the output directory must be on a shared filesystem")
+	parser.add_argument("--cell", type=parse_cell, help="Only download tiles inside this quadtree cell, given as Z/X/Y")
+	parser.add_argument("--refresh", action="store_true", help="Re-request every tile with If-None-Match/If-Modified-Since and only rewrite tiles that changed")
+	parser.add_argument("--store-validators", action="store_true", help="Keep the ETag, Last-Modified and content hash of downloaded tiles, so a later --refresh can revalidate them")
 	parser.add_argument("--retries", type=int, default=3, help="Retries per tile when a download fails")
+	parser.add_argument("--pool-size", type=int, default=HttpPool.maxPerHost, help="Idle keep-alive connections kept per tile host")
+	parser.add_argument("--rate-limit", type=float, help="Max requests per second per tile host; backs off further when the host throttles")
+	parser.add_argument("--tile-cache", help="Tile cache directory of the server's /tile-proxy (e.g. temp/tile-cache); previewed tiles are reused instead of downloaded")
+	parser.add_argument("--batch-size", type=int, default=500, help="Tiles per SQLite transaction for mbtiles/repo output")
+	parser.add_argument("--batch-interval", type=int, default=250, help="Max milliseconds a tile waits before its batch is committed")
+	parser.add_argument("--fsync-every", type=int, default=0, help="For directory output, fsync written tiles in batches of this many (0 = never)")
+	parser.add_argument("--polygon", help="GeoJSON file; only tiles intersecting its polygons are downloaded")
+	parser.add_argument("--overview-from-max-zoom", action="store_true", help="Download only the max zoom and build lower zooms from it")
+	parser.add_argument("--overview-processes", type=int, help="Processes used to resample overview tiles (default: CPU count)")
+	parser.add_argument("--transcode", choices=Transcoder.formats, help="Re-encode tiles to this format before writing them")
+	parser.add_argument("--quality", type=int, help="JPEG/WebP quality for --transcode (1-100)")
+	parser.add_argument("--colors", type=int, help="For --transcode png, quantize to a palette of this many colors (2-256)")
+	parser.add_argument("--lossless", action="store_true", help="For --transcode webp, use lossless WebP")
+	parser.add_argument("--transcode-processes", type=int, help="Processes used to encode tiles (default: CPU count)")
+	parser.add_argument("--blank-tiles", choices=BlankTiles.policies, default="keep", help="Uniform-color tiles: keep them as downloaded, drop them, or store one shared encoding per color")
+	parser.add_argument("--placeholder-hash", action="append", help="Content hash (as in tile_validators.content_hash) of a \"no imagery\" tile the source serves; such tiles count as missing. Repeatable")
+	parser.add_argument("--placeholders", help="JSON file of placeholder hashes per host: {\"host\": [\"hash\", ...]}, \"*\" for any host")
 	parser.add_argument("--min-zoom", type=int, help="Override min zoom")
 	parser.add_argument("--max-zoom", type=int, help="Override max zoom")
 	parser.add_argument("--output-type", choices=["directory", "mbtiles", "repo"], help="Override output type")
 	parser.add_argument("--output-file", help="Override output file pattern/name (e.g. {z}/{x}/{y}.png or tiles.mbtiles)")
-	parser.add_argument("--output-scale", type=int, help="Override output scale (1 or 2)")
-	args = parser.parse_args()
+	parser.add_argument("--output-scale", type=int, help="Override output scale (1, 2, 4 or 8)")
+	return parser
+
+
+def main():
+	args = build_parser().parse_args()
 
-	download_tiles(args)
+	if args.shard_worker:
+		shard_worker(args)
+	elif args.shards:
+		download_sharded(args)
+	else:
+		download_tiles(args)
 
 
 if __name__ == "__main__":
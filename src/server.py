@@ -24,15 +24,29 @@ import glob
 import os
 import base64
 import mimetypes 
+import sqlite3
 
+from batch_writer import BatchWriter
+from coverage import TileCoverage
 from file_writer import FileWriter
+from http_pool import HttpPool
+from job_runner import JobManager
 from mbtiles_writer import MbtilesWriter
+from rate_limiter import RateLimiter
+from tile_cache import TileCache
 from repo_writer import RepoWriter
+from tile_template import TileTemplate
+from tilesets import Tilesets
+from transcoder import Transcoder
 from utils import Utils
 
 lock = threading.Lock()
 
 class serverHandler(BaseHTTPRequestHandler):
+
+	coverageMaxZoom = 22
+	# zoom levels per /coverage request that may return their columns; counts cover any range
+	coverageColumnZooms = 4
 		
 	def randomString(self):
 		return uuid.uuid4().hex.upper()[0:6]
@@ -45,8 +59,147 @@ class serverHandler(BaseHTTPRequestHandler):
 		elif(type == "directory"):
 			return FileWriter
 
+	def readJSON(self):
+		content_len = int(self.headers.get('Content-length', 0))
+		return json.loads(self.rfile.read(content_len) or b"{}")
+
+	def sendJSON(self, result, status=200):
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.end_headers()
+		self.wfile.write(json.dumps(result).encode('utf-8'))
+
+	def handleCoverage(self, query):
+
+		countOnly = query.get("count", ["0"])[0] not in ("", "0")
+
+		try:
+			body = self.readJSON()
+			geometry = body["geometry"]
+			# a string would be taken for a file path
+			if not isinstance(geometry, dict):
+				raise ValueError("geometry must be a GeoJSON object")
+			polygons = TileCoverage.polygonsFromGeoJSON(geometry)
+			minZoom = int(body["minZoom"])
+			maxZoom = int(body["maxZoom"])
+		except (ValueError, KeyError, TypeError) as exc:
+			self.sendJSON({"code": 400, "message": "Invalid coverage request: " + str(exc)}, 400)
+			return
+
+		if not 0 <= minZoom <= maxZoom <= serverHandler.coverageMaxZoom:
+			self.sendJSON({"code": 400, "message": f"Invalid coverage request: zoom levels must be within 0-{serverHandler.coverageMaxZoom}, minZoom first"}, 400)
+			return
+
+		if countOnly:
+			self.sendJSON({"code": 200, "count": TileCoverage.count(polygons, minZoom, maxZoom)})
+			return
+
+		if maxZoom - minZoom >= serverHandler.coverageColumnZooms:
+			self.sendJSON({"code": 400, "message": f"Invalid coverage request: columns are returned for at most {serverHandler.coverageColumnZooms} zoom levels; use ?count=1 for the tile count"}, 400)
+			return
+
+		zooms = {}
+		count = 0
+
+		for z in range(minZoom, maxZoom + 1):
+			columns = TileCoverage.columns(polygons, z)
+			zooms[str(z)] = columns
+			count += sum(yEnd - yStart + 1 for _, yStart, yEnd in columns)
+
+		self.sendJSON({"code": 200, "count": count, "zooms": zooms})
+
+	def handleTiles(self, path):
+
+		# /tiles/<job>.json is the TileJSON, /tiles/<job>/{z}/{x}/{y}.<ext> a tile
+		if "/" not in path and path.endswith(".json"):
+			tileset = Tilesets.get(path[:-len(".json")])
+			if tileset is None:
+				self.sendJSON({"code": 404, "message": "Tileset not found"}, 404)
+				return
+
+			body = json.dumps(Tilesets.tileJSON(tileset, "http://" + (self.headers.get("Host") or "localhost"))).encode("utf-8")
+			self.send_response(200)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Content-Length", str(len(body)))
+			self.send_header("Access-Control-Allow-Origin", "*")
+			self.end_headers()
+			self.wfile.write(body)
+			return
+
+		segments = path.split("/")
+
+		try:
+			name, z, x, y = segments[0], int(segments[1]), int(segments[2]), int(segments[3].split(".")[0])
+		except (IndexError, ValueError):
+			self.send_error(400, "Expected /tiles/<job>/{z}/{x}/{y}.<ext>")
+			return
+
+		tileset = Tilesets.get(name)
+		if tileset is None:
+			self.send_error(404, "Tileset not found")
+			return
+
+		try:
+			tileData = Tilesets.readTile(tileset, x, y, z)
+		except sqlite3.Error as exc:
+			print(f"Tile read failed for {name}/{z}/{x}/{y}: {exc}")
+			self.send_error(503, "Tileset is not readable right now")
+			return
+
+		if tileData is None:
+			self.send_error(404, "Tile not found")
+			return
+
+		etag = Tilesets.etag(tileData)
+
+		if self.headers.get("If-None-Match") == etag:
+			self.send_response(304)
+			self.send_header("ETag", etag)
+			self.send_header("Access-Control-Allow-Origin", "*")
+			self.end_headers()
+			return
+
+		self.send_response(200)
+		self.send_header("Content-Type", Tilesets.contentType(tileData, tileset["metadata"].get("format")))
+		self.send_header("Content-Length", str(len(tileData)))
+		self.send_header("ETag", etag)
+		# a running job may still rewrite tiles, so clients revalidate instead of caching blindly
+		self.send_header("Cache-Control", "no-cache")
+		self.send_header("Access-Control-Allow-Origin", "*")
+		self.end_headers()
+		self.wfile.write(tileData)
+
+	def handleCreateJob(self):
+
+		try:
+			job = JobManager.create(self.readJSON(), lock)
+		except (OSError, ValueError, KeyError, TypeError) as exc:
+			self.sendJSON({"code": 400, "message": "Invalid job: " + str(exc)}, 400)
+			return
+
+		self.sendJSON({"code": 200, "job": job.status()})
+
 	def do_POST(self):
 
+		parts = urlparse(self.path)
+		if parts.path == '/coverage':
+			self.handleCoverage(parse_qs(parts.query))
+			return
+
+		if parts.path == '/jobs':
+			self.handleCreateJob()
+			return
+
+		if parts.path.startswith('/jobs/') and parts.path.endswith('/cancel'):
+			job = JobManager.get(parts.path.split('/')[2])
+			if job is None:
+				self.sendJSON({"code": 404, "message": "Job not found"}, 404)
+				return
+
+			job.cancel()
+			self.sendJSON({"code": 200, "job": job.status()})
+			return
+
 		ctype, pdict = cgi.parse_header(self.headers.get('Content-Type'))
 		#ctype, pdict = cgi.parse_header(self.headers['content-type'])
 		pdict['boundary'] = bytes(pdict['boundary'], "utf-8")
@@ -56,7 +209,6 @@ class serverHandler(BaseHTTPRequestHandler):
 
 		postvars = cgi.parse_multipart(self.rfile, pdict)
 
-		parts = urlparse(self.path)
 		if parts.path == '/download-tile':
 
 			x = int(postvars['x'][0])
@@ -70,18 +222,8 @@ class serverHandler(BaseHTTPRequestHandler):
 			outputScale = int(postvars['outputScale'][0])
 			source = str(postvars['source'][0])
 
-			replaceMap = {
-				"x": str(x),
-				"y": str(y),
-				"z": str(z),
-				"quad": quad,
-				"timestamp": str(timestamp),
-			}
-
-			for key, value in replaceMap.items():
-				newKey = str("{" + str(key) + "}")
-				outputDirectory = outputDirectory.replace(newKey, value)
-				outputFile = outputFile.replace(newKey, value)
+			outputDirectory = TileTemplate.compile(outputDirectory).render(x, y, z, quad, timestamp=str(timestamp))
+			outputFile = TileTemplate.compile(outputFile).render(x, y, z, quad, timestamp=str(timestamp))
 
 			result = {}
 
@@ -97,22 +239,21 @@ class serverHandler(BaseHTTPRequestHandler):
 
 			else:
 
-				tempFile = self.randomString() + ".png"
-				tempFilePath = os.path.join("temp", tempFile)
-
-				result["code"] = Utils.downloadFileScaled(source, tempFilePath, x, y, z, outputScale)
+				result["code"], tileData = Utils.downloadTileScaled(source, x, y, z, outputScale)
 
 				print("HIT: " + source + "\n" + "RETURN: " + str(result["code"]))
 
-				if os.path.isfile(tempFilePath):
-					self.writerByType(outputType).addTile(lock, filePath, tempFilePath, x, y, z, outputScale)
+				if tileData is not None:
+					self.writerByType(outputType).addTileData(lock, filePath, tileData, x, y, z, outputScale)
 
-					with open(tempFilePath, "rb") as image_file:
-						result["image"] = base64.b64encode(image_file.read()).decode("utf-8")
+					result["image"] = base64.b64encode(tileData).decode("utf-8")
 
-					os.remove(tempFilePath)
-
-					result["message"] = 'Tile Downloaded'
+					# batched writes commit later; report batches of this file that already failed
+					if BatchWriter.errorCount(filePath):
+						result["code"] = 500
+						result["message"] = 'Writing tiles to ' + outputFile + ' failed'
+					else:
+						result["message"] = 'Tile Downloaded'
 					print("SAVE: " + filePath)
 
 				else:
@@ -142,18 +283,13 @@ class serverHandler(BaseHTTPRequestHandler):
 			center = str(postvars['center'][0])
 			centerArray = map(float, center.split(","))
 
-			replaceMap = {
-				"timestamp": str(timestamp),
-			}
-
-			for key, value in replaceMap.items():
-				newKey = str("{" + str(key) + "}")
-				outputDirectory = outputDirectory.replace(newKey, value)
-				outputFile = outputFile.replace(newKey, value)
+			outputDirectory = TileTemplate.compile(outputDirectory).render(timestamp=str(timestamp))
+			outputFile = TileTemplate.compile(outputFile).render(timestamp=str(timestamp))
 
 			filePath = os.path.join("output", outputDirectory, outputFile)
+			source = str(postvars['source'][0]) if 'source' in postvars else None
 
-			self.writerByType(outputType).addMetadata(lock, os.path.join("output", outputDirectory), filePath, outputFile, "Map Tiles Downloader via AliFlux", "png", boundsArray, centerArray, minZoom, maxZoom, "mercator", 256 * outputScale)
+			self.writerByType(outputType).addMetadata(lock, os.path.join("output", outputDirectory), filePath, outputFile, "Map Tiles Downloader via AliFlux", Transcoder.outputFormat(source, outputScale), boundsArray, centerArray, minZoom, maxZoom, "mercator", 256 * outputScale)
 
 			result = {}
 			result["code"] = 200
@@ -179,22 +315,20 @@ class serverHandler(BaseHTTPRequestHandler):
 			center = str(postvars['center'][0])
 			centerArray = map(float, center.split(","))
 
-			replaceMap = {
-				"timestamp": str(timestamp),
-			}
-
-			for key, value in replaceMap.items():
-				newKey = str("{" + str(key) + "}")
-				outputDirectory = outputDirectory.replace(newKey, value)
-				outputFile = outputFile.replace(newKey, value)
+			outputDirectory = TileTemplate.compile(outputDirectory).render(timestamp=str(timestamp))
+			outputFile = TileTemplate.compile(outputFile).render(timestamp=str(timestamp))
 
 			filePath = os.path.join("output", outputDirectory, outputFile)
 
-			self.writerByType(outputType).close(lock, os.path.join("output", outputDirectory), filePath, minZoom, maxZoom)
+			writeErrors = self.writerByType(outputType).close(lock, os.path.join("output", outputDirectory), filePath, minZoom, maxZoom)
 
 			result = {}
-			result["code"] = 200
-			result["message"] = 'Downloaded ended'
+			if writeErrors:
+				result["code"] = 500
+				result["message"] = str(writeErrors) + ' tiles failed to write'
+			else:
+				result["code"] = 200
+				result["message"] = 'Downloaded ended'
 
 			self.send_response(200)
 			# self.send_header("Access-Control-Allow-Origin", "*")
@@ -208,6 +342,54 @@ class serverHandler(BaseHTTPRequestHandler):
 
 		parts = urlparse(self.path)
 
+		if parts.path == "/jobs":
+			self.sendJSON({"code": 200, "jobs": [job.status() for job in JobManager.all()]})
+			return
+
+		if parts.path.startswith("/jobs/") and parts.path.endswith("/events"):
+			job = JobManager.get(parts.path.split('/')[2])
+			if job is None:
+				self.sendJSON({"code": 404, "message": "Job not found"}, 404)
+				return
+
+			query = parse_qs(parts.query)
+			try:
+				since = int(query.get('since', [0])[0])
+			except ValueError:
+				since = 0
+
+			self.send_response(200)
+			self.send_header("Content-Type", "text/event-stream")
+			self.send_header("Cache-Control", "no-cache")
+			self.end_headers()
+
+			try:
+				for event, data in job.events(since):
+					self.wfile.write(("event: " + event + "\ndata: " + json.dumps(data) + "\n\n").encode('utf-8'))
+					self.wfile.flush()
+			except (BrokenPipeError, ConnectionResetError):
+				pass
+			return
+
+		if parts.path.startswith("/jobs/"):
+			job = JobManager.get(parts.path.split('/')[2])
+			if job is None:
+				self.sendJSON({"code": 404, "message": "Job not found"}, 404)
+				return
+
+			query = parse_qs(parts.query)
+			try:
+				since = int(query.get('since', [0])[0])
+			except ValueError:
+				since = 0
+
+			self.sendJSON({"code": 200, "job": job.status(since)})
+			return
+
+		if parts.path.startswith("/tiles/"):
+			self.handleTiles(parts.path[len("/tiles/"):])
+			return
+
 		if parts.path == "/tile-proxy":
 			query = parse_qs(parts.query)
 			base_url = query.get('url', [None])[0]
@@ -227,19 +409,28 @@ class serverHandler(BaseHTTPRequestHandler):
 			tile_url = Utils.qualifyURL(base_url, x, y, z)
 
 			try:
-				with Utils.open_url(tile_url) as response:
-					content = response.read()
-					content_type = response.headers.get_content_type() or "image/png"
+				tile = Utils.proxyTile(tile_url)
 			except Exception as exc:
 				print(f"Proxy error for {tile_url}: {exc}")
 				self.send_error(502, "Failed to fetch tile from source")
 				return
 
+			if tile["etag"] is not None and self.headers.get("If-None-Match") == tile["etag"]:
+				self.send_response(304)
+				self.send_header("ETag", tile["etag"])
+				self.send_header("Access-Control-Allow-Origin", "*")
+				self.end_headers()
+				return
+
 			self.send_response(200)
-			self.send_header("Content-Type", content_type)
+			self.send_header("Content-Type", tile["contentType"])
+			self.send_header("Content-Length", str(len(tile["data"])))
 			self.send_header("Access-Control-Allow-Origin", "*")
+			if tile["etag"] is not None:
+				self.send_header("ETag", tile["etag"])
+				self.send_header("Cache-Control", "public, max-age=" + str(int(TileCache.ttl)))
 			self.end_headers()
-			self.wfile.write(content)
+			self.wfile.write(tile["data"])
 			return
 
 		path = parts.path.strip('/')
@@ -270,12 +461,30 @@ class serverHandler(BaseHTTPRequestHandler):
 class serverThreadedHandler(ThreadingMixIn, HTTPServer):
 	"""Handle requests in a separate thread."""
 
+	# event streams stay open for the whole job; do not block shutdown on them
+	daemon_threads = True
+
+	# the default backlog of 5 drops connections when a map opens many tiles at once
+	request_queue_size = 256
+
 def run():
 	parser = argparse.ArgumentParser(description="Map Tiles Downloader")
 	parser.add_argument("--host", default="127.0.0.1", help="Host/interface to bind the server to")
 	parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8080)), help="Port to bind the server to")
+	parser.add_argument("--pool-size", type=int, default=HttpPool.maxPerHost, help="Idle keep-alive connections kept per tile host")
+	parser.add_argument("--rate-limit", type=float, help="Max requests per second per tile host; backs off further when the host throttles")
+	parser.add_argument("--cache-dir", default=TileCache.directory, help="Directory for the /tile-proxy tile cache, also used by downloads")
+	parser.add_argument("--cache-memory-mb", type=float, default=TileCache.memoryLimit / (1024 * 1024), help="In-memory tile cache size in MB")
+	parser.add_argument("--cache-disk-mb", type=float, default=TileCache.diskLimit / (1024 * 1024), help="On-disk tile cache size in MB; 0 disables the cache")
+	parser.add_argument("--cache-ttl", type=float, default=TileCache.ttl, help="Seconds a cached tile stays fresh")
 	args = parser.parse_args()
 
+	HttpPool.configure(maxPerHost=args.pool_size)
+	# jobs and the tile proxy share a host's pooled connections
+	RateLimiter.configure(rate=args.rate_limit, concurrency=args.pool_size)
+	if args.cache_disk_mb > 0:
+		TileCache.configure(directory=args.cache_dir, memoryMB=args.cache_memory_mb, diskMB=args.cache_disk_mb, ttl=args.cache_ttl)
+
 	print('Starting Server...')
 	try:
 		httpd = serverThreadedHandler((args.host, args.port), serverHandler)
@@ -289,4 +498,5 @@ def run():
 
 	httpd.serve_forever()
  
-run()
+if __name__ == "__main__":
+	run()
@@ -0,0 +1,120 @@
+import json
+import sqlite3
+import threading
+import time
+
+class ShardQueue:
+	"""Work units of a sharded download, in a SQLite file every worker can reach.
+
+	A unit is one quadtree cell (z, x, y) of a download zoom level. Workers
+	claim a unit with a lease; a unit whose lease ran out (its worker died) is
+	handed out again. Local workers share the file on disk; workers on other
+	hosts need the output directory on a shared filesystem with working locks.
+	"""
+
+	lease = 600.0
+
+	def __init__(self, path, signature=None):
+		self.path = path
+		self.signature = json.dumps(signature, sort_keys=True) if signature is not None else None
+		self.lock = threading.Lock()
+
+		# not pooled: the pool's connections use WAL, which needs shared memory
+		# that workers on other hosts do not have
+		self.database = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+		self.database.execute("PRAGMA journal_mode=DELETE;")
+
+		self.prepare()
+
+	def connection(self):
+		return self.database
+
+	def prepare(self):
+
+		with self.lock:
+			connection = self.connection()
+			connection.execute("CREATE TABLE IF NOT EXISTS units (id integer primary key, zoom_level integer, cell_zoom integer, cell_x integer, cell_y integer, state text, worker text, lease_until real, ok integer, errors integer);")
+			connection.execute("CREATE TABLE IF NOT EXISTS settings (name text primary key, value text);")
+
+	def matches(self):
+		"""True if the queue was built for this signature (workers pass none and always match)."""
+
+		if self.signature is None:
+			return True
+
+		with self.lock:
+			row = self.connection().execute("SELECT value FROM settings WHERE name = 'signature'").fetchone()
+		return row is not None and row[0] == self.signature
+
+	def fill(self, units):
+		"""Replace the queue with (zoom_level, cell_zoom, cell_x, cell_y) units."""
+
+		with self.lock:
+			connection = self.connection()
+			connection.execute("BEGIN IMMEDIATE;")
+			connection.execute("DELETE FROM units;")
+			connection.executemany("INSERT INTO units (zoom_level, cell_zoom, cell_x, cell_y, state, ok, errors) VALUES (?, ?, ?, ?, 'pending', 0, 0);", units)
+			connection.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('signature', ?);", (self.signature,))
+			connection.commit()
+
+	def claim(self, worker):
+		"""Return (id, zoom_level, cell_zoom, cell_x, cell_y) leased to worker, or None."""
+
+		now = time.time()
+
+		with self.lock:
+			connection = self.connection()
+			# IMMEDIATE takes the write lock up front, so two processes cannot claim the same unit
+			connection.execute("BEGIN IMMEDIATE;")
+			try:
+				row = connection.execute("SELECT id, zoom_level, cell_zoom, cell_x, cell_y FROM units WHERE state = 'pending' OR (state = 'running' AND lease_until < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+				if row is not None:
+					connection.execute("UPDATE units SET state = 'running', worker = ?, lease_until = ? WHERE id = ?", (worker, now + ShardQueue.lease, row[0]))
+				connection.commit()
+			except Exception:
+				connection.rollback()
+				raise
+
+		return row
+
+	def renew(self, unitId, worker):
+
+		with self.lock:
+			connection = self.connection()
+			connection.execute("UPDATE units SET lease_until = ? WHERE id = ? AND worker = ?", (time.time() + ShardQueue.lease, unitId, worker))
+
+	def finish(self, unitId, worker, ok, errors):
+
+		with self.lock:
+			connection = self.connection()
+			connection.execute("UPDATE units SET state = 'done', ok = ?, errors = ? WHERE id = ? AND worker = ?", (ok, errors, unitId, worker))
+
+	def running(self):
+		"""Return the {unitId: worker} of units currently leased."""
+
+		with self.lock:
+			return dict(self.connection().execute("SELECT id, worker FROM units WHERE state = 'running'").fetchall())
+
+	def release(self, unitId, worker):
+		"""Hand a unit out again before its lease runs out, e.g. because its worker is known to be dead."""
+
+		with self.lock:
+			self.connection().execute("UPDATE units SET state = 'pending', worker = NULL, lease_until = NULL WHERE id = ? AND worker = ? AND state = 'running'", (unitId, worker))
+
+	def counts(self):
+		"""Return {"pending": n, "running": n, "done": n, "claimable": n, "ok": n, "errors": n}."""
+
+		counts = {"pending": 0, "running": 0, "done": 0}
+
+		with self.lock:
+			connection = self.connection()
+			for state, count in connection.execute("SELECT state, COUNT(*) FROM units GROUP BY state"):
+				counts[state] = count
+
+			counts["claimable"] = connection.execute("SELECT COUNT(*) FROM units WHERE state = 'pending' OR (state = 'running' AND lease_until < ?)", (time.time(),)).fetchone()[0]
+			counts["ok"], counts["errors"] = connection.execute("SELECT COALESCE(SUM(ok), 0), COALESCE(SUM(errors), 0) FROM units WHERE state = 'done'").fetchone()
+
+		return counts
+
+	def close(self):
+		self.database.close()
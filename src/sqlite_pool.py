@@ -0,0 +1,146 @@
+import contextlib
+import sqlite3
+import os
+import threading
+
+class PooledDatabase:
+
+	def __init__(self, filePath):
+		self.filePath = filePath
+		self.lock = threading.Lock()
+		self.writer = None
+		self.readers = []
+		self.idleReaders = []
+		self.local = threading.local()
+
+	def writeConnection(self):
+
+		if self.writer is None:
+			connection = sqlite3.connect(self.filePath, check_same_thread=False)
+			connection.execute("PRAGMA journal_mode=WAL;")
+			connection.execute("PRAGMA synchronous=NORMAL;")
+			connection.execute("PRAGMA cache_size=-65536;")
+			connection.execute("PRAGMA temp_store=MEMORY;")
+			self.writer = connection
+
+		return self.writer
+
+	def readConnection(self):
+
+		connection = getattr(self.local, "connection", None)
+
+		if connection is None:
+			connection = self.openReader()
+			self.local.connection = connection
+
+		return connection
+
+	def openReader(self):
+
+		uri = "file:" + os.path.abspath(self.filePath) + "?mode=ro"
+		connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+		connection.execute("PRAGMA cache_size=-16384;")
+
+		with self.lock:
+			self.readers.append(connection)
+
+		return connection
+
+	@contextlib.contextmanager
+	def reader(self):
+		"""Borrow a read-only connection for one query.
+
+		Unlike readConnection this does not pin a connection to the thread, so
+		short-lived request threads share a handful of connections.
+		"""
+
+		with self.lock:
+			connection = self.idleReaders.pop() if self.idleReaders else None
+
+		if connection is None:
+			connection = self.openReader()
+
+		try:
+			yield connection
+		finally:
+			with self.lock:
+				if connection in self.readers:
+					self.idleReaders.append(connection)
+
+	def close(self):
+
+		with self.lock:
+			# readers go first so the writer is the last connection and
+			# checkpoints the WAL back into the database file
+			for connection in self.readers:
+				try:
+					connection.close()
+				except sqlite3.Error:
+					pass
+
+			# read-only connections cannot remove the WAL, so a reader-only
+			# session still closes through a read-write connection; files not
+			# in WAL mode are left alone, and read-only files are skipped
+			if self.readers and self.writer is None and os.path.exists(self.filePath):
+				try:
+					connection = sqlite3.connect(self.filePath)
+					try:
+						if connection.execute("PRAGMA journal_mode;").fetchone()[0] == "wal":
+							connection.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+					finally:
+						connection.close()
+				except sqlite3.Error:
+					pass
+
+			self.readers = []
+			self.idleReaders = []
+
+			if self.writer is not None:
+				try:
+					self.writer.commit()
+					self.writer.close()
+				except sqlite3.Error:
+					pass
+				self.writer = None
+
+			self.local = threading.local()
+
+
+class SqlitePool:
+
+	registry = {}
+	registryLock = threading.Lock()
+
+	@staticmethod
+	def get(filePath):
+
+		key = os.path.abspath(filePath)
+
+		with SqlitePool.registryLock:
+			database = SqlitePool.registry.get(key)
+			if database is None:
+				database = PooledDatabase(filePath)
+				SqlitePool.registry[key] = database
+
+		return database
+
+	@staticmethod
+	def close(filePath):
+
+		key = os.path.abspath(filePath)
+
+		with SqlitePool.registryLock:
+			database = SqlitePool.registry.pop(key, None)
+
+		if database is not None:
+			database.close()
+
+	@staticmethod
+	def closeAll():
+
+		with SqlitePool.registryLock:
+			databases = list(SqlitePool.registry.values())
+			SqlitePool.registry.clear()
+
+		for database in databases:
+			database.close()
@@ -0,0 +1,36 @@
+class TileBitmap:
+	"""One bit per tile of a (width x height) block starting at (xStart, yStart)."""
+
+	def __init__(self, xStart, yStart, width, height):
+		self.xStart = xStart
+		self.yStart = yStart
+		self.width = width
+		self.height = height
+		self.bits = bytearray((width * height + 7) // 8)
+		self.count = 0
+
+	def index(self, x, y):
+		column = x - self.xStart
+		row = y - self.yStart
+		if column < 0 or row < 0 or column >= self.width or row >= self.height:
+			return None
+		return column * self.height + row
+
+	def add(self, x, y):
+		index = self.index(x, y)
+		if index is None:
+			return
+
+		mask = 1 << (index & 7)
+		if not self.bits[index >> 3] & mask:
+			self.bits[index >> 3] |= mask
+			self.count += 1
+
+	def __contains__(self, tile):
+		index = self.index(tile[0], tile[1])
+		if index is None:
+			return False
+		return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+	def __len__(self):
+		return self.count
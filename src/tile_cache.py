@@ -0,0 +1,205 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+class TileCache:
+	"""Bounded in-memory + on-disk LRU of upstream tiles, keyed by qualified URL.
+
+	/tile-proxy fills it while the map is previewed, and downloads read from it
+	so a previewed area is not fetched twice. Entries older than ttl seconds are
+	treated as missing.
+	"""
+
+	enabled = False
+	directory = os.path.join("temp", "tile-cache")
+	memoryLimit = 64 * 1024 * 1024
+	diskLimit = 512 * 1024 * 1024
+	ttl = 24 * 3600
+
+	memory = collections.OrderedDict()
+	memoryBytes = 0
+	disk = None
+	diskBytes = 0
+	lock = threading.Lock()
+
+	counters = {"memoryHits": 0, "diskHits": 0, "misses": 0}
+
+	@staticmethod
+	def configure(directory=None, memoryMB=None, diskMB=None, ttl=None):
+
+		with TileCache.lock:
+			if directory is not None:
+				TileCache.directory = directory
+				TileCache.disk = None
+			if memoryMB is not None:
+				TileCache.memoryLimit = int(memoryMB * 1024 * 1024)
+			if diskMB is not None:
+				TileCache.diskLimit = int(diskMB * 1024 * 1024)
+			if ttl is not None:
+				TileCache.ttl = ttl
+
+			TileCache.enabled = True
+
+	@staticmethod
+	def key(url):
+		return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+	@staticmethod
+	def stats():
+		with TileCache.lock:
+			return dict(TileCache.counters, memoryBytes=TileCache.memoryBytes, diskBytes=TileCache.diskBytes)
+
+	@staticmethod
+	def loadIndex():
+		# called with the lock held; oldest files are evicted first across restarts
+
+		entries = []
+		os.makedirs(TileCache.directory, exist_ok=True)
+
+		with os.scandir(TileCache.directory) as listing:
+			for entry in listing:
+				if entry.name.endswith(".tile"):
+					stat = entry.stat()
+					entries.append((stat.st_mtime, entry.name[:-len(".tile")], stat.st_size))
+
+		entries.sort()
+
+		TileCache.disk = collections.OrderedDict((name, size) for _, name, size in entries)
+		TileCache.diskBytes = sum(size for _, _, size in entries)
+
+	@staticmethod
+	def get(url):
+		"""Return a dict with data, contentType, etag and validators, or None."""
+
+		if not TileCache.enabled:
+			return None
+
+		key = TileCache.key(url)
+		now = time.time()
+
+		with TileCache.lock:
+			entry = TileCache.memory.get(key)
+			if entry is not None:
+				if now - entry["stored"] <= TileCache.ttl:
+					TileCache.memory.move_to_end(key)
+					TileCache.counters["memoryHits"] += 1
+					return entry
+				TileCache.forgetMemory(key)
+
+			if TileCache.disk is None:
+				TileCache.loadIndex()
+
+			onDisk = key in TileCache.disk
+
+		entry = TileCache.readFile(key, url) if onDisk else None
+
+		with TileCache.lock:
+			if entry is None or now - entry["stored"] > TileCache.ttl:
+				if onDisk:
+					TileCache.forgetDisk(key)
+				TileCache.counters["misses"] += 1
+				return None
+
+			if key in TileCache.disk:
+				TileCache.disk.move_to_end(key)
+			TileCache.counters["diskHits"] += 1
+			TileCache.remember(key, entry)
+
+		return entry
+
+	@staticmethod
+	def put(url, data, contentType, validators=None):
+
+		if not TileCache.enabled or data is None:
+			return None
+
+		key = TileCache.key(url)
+		entry = {
+			"url": url,
+			"data": data,
+			"contentType": contentType,
+			"etag": '"' + hashlib.blake2b(data, digest_size=16).hexdigest() + '"',
+			"validators": validators or {},
+			"stored": time.time(),
+		}
+
+		header = dict(entry)
+		del header["data"]
+		payload = json.dumps(header).encode("utf-8") + b"\n" + data
+
+		path = os.path.join(TileCache.directory, key + ".tile")
+		tempPath = path + "." + str(threading.get_ident()) + ".tmp"
+
+		with TileCache.lock:
+			if TileCache.disk is None:
+				TileCache.loadIndex()
+
+		try:
+			with open(tempPath, "wb") as cacheFile:
+				cacheFile.write(payload)
+			os.replace(tempPath, path)
+		except OSError as exc:
+			print(f"Tile cache write failed for {url}: {exc}")
+			return entry
+
+		with TileCache.lock:
+			TileCache.remember(key, entry)
+
+			TileCache.diskBytes -= TileCache.disk.pop(key, 0)
+			TileCache.disk[key] = len(payload)
+			TileCache.diskBytes += len(payload)
+
+			while TileCache.diskBytes > TileCache.diskLimit and len(TileCache.disk) > 1:
+				oldest = next(iter(TileCache.disk))
+				TileCache.forgetDisk(oldest)
+
+		return entry
+
+	@staticmethod
+	def readFile(key, url):
+
+		try:
+			with open(os.path.join(TileCache.directory, key + ".tile"), "rb") as cacheFile:
+				header = json.loads(cacheFile.readline().decode("utf-8"))
+				data = cacheFile.read()
+		except (OSError, ValueError):
+			return None
+
+		# a hash collision would otherwise serve another URL's tile
+		if header.get("url") != url:
+			return None
+
+		header["data"] = data
+		return header
+
+	@staticmethod
+	def remember(key, entry):
+		# called with the lock held
+
+		if len(entry["data"]) > TileCache.memoryLimit:
+			return
+
+		TileCache.forgetMemory(key)
+		TileCache.memory[key] = entry
+		TileCache.memoryBytes += len(entry["data"])
+
+		while TileCache.memoryBytes > TileCache.memoryLimit:
+			_, oldest = TileCache.memory.popitem(last=False)
+			TileCache.memoryBytes -= len(oldest["data"])
+
+	@staticmethod
+	def forgetMemory(key):
+		entry = TileCache.memory.pop(key, None)
+		if entry is not None:
+			TileCache.memoryBytes -= len(entry["data"])
+
+	@staticmethod
+	def forgetDisk(key):
+		TileCache.diskBytes -= TileCache.disk.pop(key, 0)
+		try:
+			os.remove(os.path.join(TileCache.directory, key + ".tile"))
+		except OSError:
+			pass
@@ -0,0 +1,202 @@
+import collections
+import json
+import threading
+import time
+
+from batch_writer import BatchWriter
+from sqlite_pool import SqlitePool
+
+class TileJournal:
+	"""Crash-safe record of a download run, kept in a SQLite file next to the output.
+
+	Every tile gets a sequence number in the order iter_columns produces it. A
+	checkpoint stores the watermark: the highest sequence number below which
+	every tile is finished and written. Tiles finished past the watermark, and
+	all failures, are journal rows. A restart skips whole columns up to the
+	watermark and only looks at the few rows past it, and --retry-failed
+	schedules just the failed rows.
+	"""
+
+	insertQuery = "INSERT OR REPLACE INTO journal (seq, zoom_level, tile_x, tile_y, state, code, attempts) VALUES (?, ?, ?, ?, ?, ?, ?);"
+
+	checkpointInterval = 5.0
+
+	def __init__(self, path, signature, retries, flush=None):
+		self.path = path
+		self.signature = json.dumps(signature, sort_keys=True)
+		self.retries = retries
+		# makes the tiles up to a new watermark durable before it is stored;
+		# returns how many tiles the output writer failed to store so far
+		self.flushOutput = flush
+		self.outputErrors = 0
+		self.outputFailed = False
+
+		self.lock = threading.Lock()
+		self.checkpointLock = threading.Lock()
+		self.lastCheckpoint = time.monotonic()
+
+		self.watermark = -1
+		self.finished = set()
+		self.failed = {}
+		self.issued = collections.OrderedDict()
+		self.sequence = {}
+		self.lastIssued = -1
+		self.advancing = True
+
+		self.open()
+
+	def open(self):
+
+		database = SqlitePool.get(self.path)
+		with database.lock:
+			connection = database.writeConnection()
+			connection.execute("CREATE TABLE IF NOT EXISTS journal (seq integer primary key, zoom_level integer, tile_x integer, tile_y integer, state text, code integer, attempts integer);")
+			connection.execute("CREATE TABLE IF NOT EXISTS checkpoint (name text primary key, value text);")
+
+			rows = dict(connection.execute("SELECT name, value FROM checkpoint").fetchall())
+
+			# a journal of another region or zoom range says nothing about this one
+			if rows.get("signature") != self.signature:
+				if rows:
+					print("Journal belongs to a different tile range; starting a new one")
+				connection.execute("DELETE FROM journal;")
+				connection.execute("DELETE FROM checkpoint;")
+				connection.executemany("INSERT INTO checkpoint (name, value) VALUES (?, ?);", [("signature", self.signature), ("watermark", "-1")])
+				rows = {"watermark": "-1"}
+
+			connection.commit()
+
+			self.watermark = int(rows["watermark"])
+
+			for seq, z, x, y, state, code, attempts in connection.execute("SELECT seq, zoom_level, tile_x, tile_y, state, code, attempts FROM journal"):
+				if state == "failed":
+					self.failed[seq] = (x, y, z, code, attempts)
+				elif seq > self.watermark:
+					self.finished.add(seq)
+
+		self.lastIssued = self.watermark
+		self.storedWatermark = self.watermark
+
+	def tiles(self, columns):
+		"""Yield the (x, y, z) tiles not finished yet, skipping whole columns below the watermark."""
+
+		seq = 0
+		for z, x, yStart, yEnd in columns:
+			count = yEnd - yStart + 1
+
+			if seq + count - 1 <= self.watermark:
+				seq += count
+				continue
+
+			for y in range(yStart, yEnd + 1):
+				if seq > self.watermark and seq not in self.finished and seq not in self.failed:
+					self.issue(seq, x, y, z)
+					yield (x, y, z)
+				seq += 1
+
+	def failedTiles(self):
+		"""Yield only the failed tiles, for --retry-failed."""
+
+		# old sequence numbers come out of order, so the watermark stays put
+		self.advancing = False
+
+		for seq in sorted(self.failed):
+			x, y, z, _, _ = self.failed[seq]
+			self.issue(seq, x, y, z)
+			yield (x, y, z)
+
+	def skipped(self):
+		"""Tiles the journal already accounts for, as (finished, failed) counts."""
+		return (self.watermark + 1 - sum(1 for seq in self.failed if seq <= self.watermark) + len(self.finished), len(self.failed))
+
+	def issue(self, seq, x, y, z):
+		with self.lock:
+			self.sequence[(x, y, z)] = seq
+			if self.advancing:
+				self.issued[seq] = False
+				self.lastIssued = seq
+
+	def record(self, x, y, z, status, attempts=None):
+		"""Record a worker result; attempts is how many downloads it took, if the worker knows."""
+
+		state, _, detail = status.partition(" ")
+		code = 0
+
+		if state == "error":
+			state = "failed"
+			code = int(detail) if detail.lstrip("-").isdigit() else 0
+
+		with self.lock:
+			seq = self.sequence.pop((x, y, z), None)
+			if seq is None:
+				return
+
+			# a worker that raised reports no count; assume it used all its retries
+			attempts = attempts or self.retries
+			if state == "failed" and seq in self.failed:
+				attempts += self.failed[seq][4]
+
+			if state == "failed":
+				self.failed[seq] = (x, y, z, code, attempts)
+			else:
+				self.failed.pop(seq, None)
+
+			if self.advancing:
+				self.issued[seq] = True
+				while self.issued:
+					first = next(iter(self.issued))
+					if not self.issued[first]:
+						break
+					del self.issued[first]
+					self.watermark = first
+
+				# nothing in flight: everything issued so far is finished
+				if not self.issued:
+					self.watermark = self.lastIssued
+
+			# queued under the lock, so a checkpoint never stores a watermark ahead of its rows
+			BatchWriter.get(self.path, TileJournal.insertQuery).put((seq, z, x, y, state, code, attempts))
+
+		if time.monotonic() - self.lastCheckpoint >= TileJournal.checkpointInterval:
+			self.checkpoint()
+
+	def checkpoint(self):
+
+		# one checkpoint at a time; other threads just carry on
+		if not self.checkpointLock.acquire(blocking=False):
+			return
+
+		try:
+			with self.lock:
+				watermark = self.watermark
+
+			outputErrors = self.flushOutput() if self.flushOutput is not None else 0
+			BatchWriter.flushFile(self.path)
+
+			if outputErrors > self.outputErrors:
+				if not self.outputFailed:
+					print("Journal: the output failed to store some tiles; a rerun downloads everything past the last checkpoint again")
+				self.outputErrors = outputErrors
+				self.outputFailed = True
+
+			database = SqlitePool.get(self.path)
+			with database.lock:
+				connection = database.writeConnection()
+				if self.outputFailed:
+					# which tiles were lost is unknown, so nothing past the stored watermark counts as finished
+					connection.execute("DELETE FROM journal WHERE seq > ? AND state != 'failed';", (self.storedWatermark,))
+				else:
+					connection.execute("UPDATE checkpoint SET value = ? WHERE name = 'watermark';", (str(watermark),))
+					# finished tiles below the watermark are implied by it
+					connection.execute("DELETE FROM journal WHERE seq <= ? AND state != 'failed';", (watermark,))
+					self.storedWatermark = watermark
+				connection.commit()
+
+			self.lastCheckpoint = time.monotonic()
+		finally:
+			self.checkpointLock.release()
+
+	def close(self):
+		self.checkpoint()
+		BatchWriter.close(self.path)
+		SqlitePool.close(self.path)
@@ -0,0 +1,251 @@
+import os
+import sqlite3
+import threading
+
+from mbtiles_writer import MbtilesWriter
+from repo_writer import RepoWriter
+from sqlite_pool import SqlitePool
+from tile_validators import TileValidators
+
+class TileMerge:
+	"""Bulk-copies tiles from MBTiles and repo files into one target file.
+
+	Each source is attached to the target's connection and copied with
+	INSERT ... SELECT in rowid ranges of chunkRows, one transaction per range,
+	so tile blobs move inside SQLite and never pass through Python. Only a
+	deduplicated target fed from a plain source hashes tiles, in a SQL function.
+	"""
+
+	conflicts = ("last-wins", "first-wins")
+
+	conflictClauses = {
+		"last-wins": "OR REPLACE",
+		"first-wins": "OR IGNORE",
+	}
+
+	chunkRows = 20000
+
+	def __init__(self, target, conflict="last-wins"):
+
+		if conflict not in TileMerge.conflicts:
+			raise ValueError("Unknown conflict policy " + str(conflict))
+
+		self.target = target
+		self.conflict = TileMerge.conflictClauses[conflict]
+
+		# pooled connections of this process must let go of the file
+		SqlitePool.close(target)
+
+		self.connection = sqlite3.connect(target, isolation_level=None, check_same_thread=False)
+
+		# WAL writes every copied page twice, once to the log and once at the checkpoint;
+		# a rollback journal only holds the few existing pages a merge changes
+		self.journalMode = self.connection.execute("PRAGMA journal_mode;").fetchone()[0]
+		try:
+			self.connection.execute("PRAGMA journal_mode=DELETE;")
+		except sqlite3.OperationalError:
+			# another process (e.g. the server) has the file open; merge through WAL then
+			self.journalMode = None
+
+		self.connection.execute("PRAGMA synchronous=NORMAL;")
+		self.connection.execute("PRAGMA cache_size=-262144;")
+		self.connection.execute("PRAGMA temp_store=MEMORY;")
+		self.connection.create_function("tile_hash", 1, MbtilesWriter.tileHash, deterministic=True)
+
+		# validators of the sources are merged too; created here, as the pool would switch the file to WAL
+		TileValidators.createTable(self.connection)
+
+		self.layout = TileMerge.layout(self.connection, "main")
+		self.replacedImages = False
+		# formats named in the sources' metadata
+		self.formats = set()
+		self.tileSize = int(self.metadata().get("tilesize") or 256)
+
+	@staticmethod
+	def create(target, source, deduplicate=False):
+		"""Create target with the metadata of source; repo targets for .repo names, MBTiles otherwise."""
+
+		connection = sqlite3.connect(source)
+		try:
+			metadata = dict(connection.execute("SELECT name, value FROM metadata").fetchall())
+		finally:
+			connection.close()
+
+		lock = threading.Lock()
+		writer = RepoWriter if target.endswith(".repo") else MbtilesWriter
+		path = os.path.dirname(os.path.abspath(target))
+		arguments = (lock, path, target, metadata.get("name", ""), metadata.get("description", ""), metadata.get("format", "png"), [], [], metadata.get("minzoom"), metadata.get("maxzoom"))
+
+		if writer is MbtilesWriter:
+			writer.addMetadata(*arguments, deduplicate=deduplicate)
+		else:
+			writer.addMetadata(*arguments)
+
+		writer.updateMetadata(lock, path, target, metadata)
+		SqlitePool.close(target)
+
+	@staticmethod
+	def layout(connection, schema):
+		"""Return "repo", "deduplicated" or "mbtiles" for the tile tables of an attached schema."""
+
+		names = set(row[0] for row in connection.execute("SELECT name FROM " + schema + ".sqlite_master WHERE type IN ('table', 'view')"))
+		if "tiles" not in names:
+			raise ValueError("No tiles table in " + schema)
+
+		if "map" in names and "images" in names:
+			return "deduplicated"
+
+		columns = set(row[1] for row in connection.execute("PRAGMA " + schema + ".table_info(tiles)"))
+		return "repo" if "tile_cropped_data" in columns else "mbtiles"
+
+	def metadata(self):
+		return dict(self.connection.execute("SELECT name, value FROM metadata").fetchall())
+
+	def mergeFile(self, source):
+		"""Copy every tile of source into the target; returns the number of tiles written."""
+
+		if os.path.abspath(source) == os.path.abspath(self.target):
+			raise ValueError("Cannot merge " + source + " into itself")
+
+		self.connection.execute("ATTACH DATABASE ? AS source", (source,))
+		try:
+			sourceLayout = TileMerge.layout(self.connection, "source")
+
+			format = self.connection.execute("SELECT value FROM source.metadata WHERE name = 'format'").fetchone()
+			if format is not None and format[0]:
+				self.formats.add(format[0])
+
+			if sourceLayout == "deduplicated" and self.layout == "deduplicated":
+				# both sides name images by content hash, so images and map copy without rehashing
+				self.replacedImages = True
+				self.copyChunks("images", "INSERT OR IGNORE INTO images (tile_data, tile_id) SELECT tile_data, tile_id FROM source.images WHERE rowid BETWEEN ? AND ?")
+				written = self.copyChunks("map", "INSERT " + self.conflict + " INTO map (zoom_level, tile_column, tile_row, tile_id) SELECT zoom_level, tile_column, tile_row, tile_id FROM source.map WHERE rowid BETWEEN ? AND ?")
+
+			else:
+				if sourceLayout == "deduplicated":
+					table, rows = "map", "source.map JOIN source.images ON source.images.tile_id = source.map.tile_id WHERE source.map.rowid BETWEEN ? AND ?"
+					data = "source.images.tile_data"
+				elif sourceLayout == "repo" and self.layout != "repo":
+					table, rows = "tiles", "source.tiles WHERE rowid BETWEEN ? AND ?"
+					# RepoWriter keeps the full tile in tile_cropped_data
+					data = "COALESCE(tile_data, tile_cropped_data)"
+				else:
+					table, rows = "tiles", "source.tiles WHERE rowid BETWEEN ? AND ?"
+					data = "tile_data"
+
+				coordinates = "zoom_level, tile_column, tile_row" if table == "tiles" else "source.map.zoom_level, source.map.tile_column, source.map.tile_row"
+
+				if self.layout == "deduplicated":
+					self.replacedImages = True
+					# hash each chunk once into a temporary table; images and map both join it
+					self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS merge_hashes (source_rowid integer primary key, tile_id text);")
+					written = self.copyChunks(table, [
+						"DELETE FROM temp.merge_hashes;",
+						"INSERT INTO temp.merge_hashes (source_rowid, tile_id) SELECT rowid, tile_hash(" + data + ") FROM " + rows,
+						"INSERT OR IGNORE INTO images (tile_data, tile_id) SELECT " + data + ", hashes.tile_id FROM temp.merge_hashes AS hashes JOIN source.tiles ON source.tiles.rowid = hashes.source_rowid",
+						"INSERT " + self.conflict + " INTO map (zoom_level, tile_column, tile_row, tile_id) SELECT zoom_level, tile_column, tile_row, hashes.tile_id FROM temp.merge_hashes AS hashes JOIN source.tiles ON source.tiles.rowid = hashes.source_rowid",
+					])
+				elif self.layout == "repo" and sourceLayout == "repo":
+					written = self.copyChunks(table, "INSERT " + self.conflict + " INTO tiles (zoom_level, tile_column, tile_row, tile_data, tile_cropped_data, pixel_left, pixel_top, pixel_right, pixel_bottom, has_alpha) SELECT zoom_level, tile_column, tile_row, tile_data, tile_cropped_data, pixel_left, pixel_top, pixel_right, pixel_bottom, has_alpha FROM " + rows)
+				elif self.layout == "repo":
+					# the uncropped rows RepoWriter.addTileData writes
+					size = str(self.tileSize)
+					written = self.copyChunks(table, "INSERT " + self.conflict + " INTO tiles (zoom_level, tile_column, tile_row, tile_data, tile_cropped_data, pixel_left, pixel_top, pixel_right, pixel_bottom, has_alpha) SELECT " + coordinates + ", NULL, " + data + ", 0, 0, " + size + ", " + size + ", 0 FROM " + rows)
+				else:
+					written = self.copyChunks(table, "INSERT " + self.conflict + " INTO tiles (zoom_level, tile_column, tile_row, tile_data) SELECT " + coordinates + ", " + data + " FROM " + rows)
+
+			if self.connection.execute("SELECT COUNT(*) FROM source.sqlite_master WHERE name = 'tile_validators'").fetchone()[0]:
+				self.connection.execute("INSERT " + self.conflict + " INTO tile_validators (zoom_level, tile_column, tile_row, etag, last_modified, content_hash) SELECT zoom_level, tile_column, tile_row, etag, last_modified, content_hash FROM source.tile_validators;")
+
+		finally:
+			self.connection.execute("DETACH DATABASE source")
+
+		return written
+
+	def copyChunks(self, table, queries):
+		"""Run queries for consecutive rowid ranges of source.<table>, one transaction each.
+
+		Queries with placeholders get the range bounds; returns the rows the last query wrote.
+		"""
+
+		if isinstance(queries, str):
+			queries = [queries]
+
+		first, last = self.connection.execute("SELECT MIN(rowid), MAX(rowid) FROM source." + table).fetchone()
+		if first is None:
+			return 0
+
+		written = 0
+		for start in range(first, last + 1, TileMerge.chunkRows):
+			self.connection.execute("BEGIN IMMEDIATE;")
+			try:
+				for query in queries:
+					rowcount = self.connection.execute(query, (start, start + TileMerge.chunkRows - 1) if "?" in query else ()).rowcount
+				written += rowcount
+				self.connection.execute("COMMIT;")
+			except Exception:
+				self.connection.execute("ROLLBACK;")
+				raise
+
+		return written
+
+	def updateBounds(self):
+		"""Recompute minzoom, maxzoom, bounds and center from the tiles of every zoom."""
+
+		table = "map" if self.layout == "deduplicated" else "tiles"
+
+		minZoom, maxZoom = self.connection.execute("SELECT MIN(zoom_level), MAX(zoom_level) FROM " + table).fetchone()
+		if minZoom is None:
+			return
+
+		zoomBounds = [bounds for bounds in (MbtilesWriter.tileBounds(self.connection, zoom, table) for zoom in range(minZoom, maxZoom + 1)) if bounds is not None]
+
+		minLon = min(bounds[0] for bounds in zoomBounds)
+		maxLon = max(bounds[2] for bounds in zoomBounds)
+		minLat = min(min(bounds[1], bounds[3]) for bounds in zoomBounds)
+		maxLat = max(max(bounds[1], bounds[3]) for bounds in zoomBounds)
+
+		# the center at maxZoom, as MbtilesWriter.updateBounds stores it
+		self.setMetadata({
+			"minzoom": minZoom,
+			"maxzoom": maxZoom,
+			"bounds": ','.join(map(str, [minLon, minLat, maxLon, maxLat])),
+			"center": ','.join(map(str, [(minLon + maxLon)/2, (minLat + maxLat)/2, maxZoom])),
+		})
+
+	def setMetadata(self, values):
+
+		self.connection.execute("BEGIN IMMEDIATE;")
+		# files of other tools may lack the unique index INSERT OR REPLACE relies on
+		for name, value in values.items():
+			if self.connection.execute("UPDATE metadata SET value = ? WHERE name = ?", (str(value), name)).rowcount == 0:
+				self.connection.execute("INSERT INTO metadata (name, value) VALUES (?, ?)", (name, str(value)))
+		self.connection.execute("COMMIT;")
+
+	def pruneImages(self):
+
+		if self.replacedImages:
+			# replaced or ignored map rows can leave images nothing points at
+			self.connection.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map);")
+			self.replacedImages = False
+
+	def compact(self, vacuum=False, analyze=False):
+
+		self.pruneImages()
+
+		if analyze:
+			self.connection.execute("ANALYZE;")
+		if vacuum:
+			self.connection.execute("VACUUM;")
+
+	def close(self):
+
+		self.pruneImages()
+
+		if self.journalMode == "wal":
+			self.connection.execute("PRAGMA journal_mode=WAL;")
+		self.connection.close()
+
+		with MbtilesWriter.layoutsLock:
+			MbtilesWriter.layouts.pop(os.path.abspath(self.target), None)
+			MbtilesWriter.imageCaches.pop(os.path.abspath(self.target), None)
@@ -0,0 +1,148 @@
+import re
+
+import numpy as np
+
+class TileTemplate:
+	"""A URL or output path pattern parsed once into literal and field segments.
+
+	Fields: {x}, {y}, {z}, {quad}, {scale:22}, {s}, {switch:a,b,c} and any extra
+	keyword passed to render (e.g. {timestamp}). Fields without a value are left
+	in place, the way the old str.replace loops behaved.
+	"""
+
+	fieldPattern = re.compile(r"\{([^{}]+)\}")
+
+	cache = {}
+	cacheSize = 256
+
+	def __init__(self, pattern):
+		self.pattern = pattern
+		self.parts = []
+		self.fields = set()
+		self.shards = None
+
+		position = 0
+		for match in TileTemplate.fieldPattern.finditer(pattern):
+			if match.start() > position:
+				self.parts.append((pattern[position:match.start()], None))
+
+			field = match.group(1)
+			if field == "s" or field.startswith("switch:"):
+				# a template has one shard list; the first wins
+				if self.shards is None:
+					self.shards = TileTemplate.shardChoices(field)
+				field = "shard"
+
+			self.parts.append((match.group(0), field))
+			self.fields.add(field)
+			position = match.end()
+
+		if position < len(pattern):
+			self.parts.append((pattern[position:], None))
+
+		self.needsQuad = "quad" in self.fields
+
+	@staticmethod
+	def compile(pattern):
+
+		template = TileTemplate.cache.get(pattern)
+		if template is None:
+			template = TileTemplate(pattern)
+			if len(TileTemplate.cache) >= TileTemplate.cacheSize:
+				TileTemplate.cache.clear()
+			TileTemplate.cache[pattern] = template
+
+		return template
+
+	@staticmethod
+	def shardChoices(field):
+		# {s} follows the Leaflet convention of a, b and c subdomains
+		if field == "s":
+			return ["a", "b", "c"]
+		return [choice.strip() for choice in field[len("switch:"):].split(",") if choice.strip()]
+
+	def values(self, x, y, z, quad=None, extra=None):
+
+		values = dict(extra) if extra else {}
+
+		if x is not None and y is not None and z is not None:
+			values["x"] = str(x)
+			values["y"] = str(y)
+			values["z"] = str(z)
+			values["scale:22"] = str(23 - (z * 2))
+
+			if self.needsQuad:
+				values["quad"] = quad if quad is not None else TileTemplate.quadKey(x, y, z)
+
+			# neighbouring tiles land on different shards, and a tile always on the same one
+			if self.shards:
+				values["shard"] = self.shards[(x + y) % len(self.shards)]
+
+		return values
+
+	def render(self, x=None, y=None, z=None, quad=None, **extra):
+		values = self.values(x, y, z, quad, extra)
+		return "".join(values.get(field, text) if field is not None else text for text, field in self.parts)
+
+	def renderMany(self, xs, ys, z, **extra):
+		"""Render one string per (x, y) pair, computing all quadkeys in one batch."""
+
+		quads = TileTemplate.quadKeys(xs, ys, z) if self.needsQuad else [None] * len(xs)
+		return [self.render(x, y, z, quad, **extra) for x, y, quad in zip(xs, ys, quads)]
+
+	@staticmethod
+	def spreadBits(value):
+		# moves bit i of a 32-bit value to bit 2i
+		value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+		value = (value | (value << 8)) & 0x00FF00FF00FF00FF
+		value = (value | (value << 4)) & 0x0F0F0F0F0F0F0F0F
+		value = (value | (value << 2)) & 0x3333333333333333
+		value = (value | (value << 1)) & 0x5555555555555555
+		return value
+
+	# eight quadkey digits for every (y byte, x byte) pair, built on first use
+	pairDigits = None
+
+	@staticmethod
+	def buildPairDigits():
+		TileTemplate.pairDigits = ["".join("0123"[((pair >> bit) & 1) | (((pair >> (8 + bit)) & 1) << 1)] for bit in range(7, -1, -1)) for pair in range(65536)]
+		return TileTemplate.pairDigits
+
+	@staticmethod
+	def quadKey(x, y, z):
+
+		if z <= 0:
+			return ""
+
+		table = TileTemplate.pairDigits or TileTemplate.buildPairDigits()
+
+		if z <= 32:
+			digits = table[(((y >> 24) & 255) << 8) | ((x >> 24) & 255)] + table[(((y >> 16) & 255) << 8) | ((x >> 16) & 255)] + table[(((y >> 8) & 255) << 8) | ((x >> 8) & 255)] + table[((y & 255) << 8) | (x & 255)]
+		else:
+			digits = "".join(table[(((y >> shift) & 255) << 8) | ((x >> shift) & 255)] for shift in range(((z + 7) // 8 - 1) * 8, -1, -8))
+
+		return digits[-z:]
+
+	@staticmethod
+	def quadKeys(xs, ys, z):
+		"""Quadkeys for arrays of x and y (broadcast, e.g. a whole row), vectorized with numpy."""
+
+		xs, ys = np.broadcast_arrays(np.asarray(xs, dtype=np.uint64), np.asarray(ys, dtype=np.uint64))
+
+		if z <= 0:
+			return [""] * xs.size
+
+		# interleaved codes only fit 64 bits up to zoom 32
+		if z > 32:
+			return [TileTemplate.quadKey(int(x), int(y), z) for x, y in zip(xs.ravel(), ys.ravel())]
+
+		code = TileTemplate.spreadBits(xs.ravel()) | (TileTemplate.spreadBits(ys.ravel()) << np.uint64(1))
+
+		shifts = np.arange(2 * (z - 1), -1, -2, dtype=np.uint64)
+		digits = ((code[:, None] >> shifts) & np.uint64(3)).astype(np.uint8) + ord("0")
+
+		return [key.decode("ascii") for key in np.ascontiguousarray(digits).view("S" + str(z)).ravel()]
+
+	@staticmethod
+	def quadKeyRow(y, z, xStart, xEnd):
+		return TileTemplate.quadKeys(np.arange(xStart, xEnd + 1), y, z)
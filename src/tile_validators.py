@@ -0,0 +1,102 @@
+import hashlib
+import os
+import threading
+
+from batch_writer import BatchWriter
+from sqlite_pool import SqlitePool
+
+class TileValidators:
+	"""ETag, Last-Modified and content hash of every downloaded tile.
+
+	Rows live in a tile_validators table, inside the MBTiles/repo file or in a
+	sidecar SQLite file for directory output (see writer.validatorPath). Rows use
+	the TMS tile_row like the tiles table.
+	"""
+
+	insertQuery = "INSERT OR REPLACE INTO tile_validators (zoom_level, tile_column, tile_row, etag, last_modified, content_hash) VALUES (?, ?, ?, ?, ?, ?);"
+
+	prepared = set()
+	preparedLock = threading.Lock()
+
+	@staticmethod
+	def contentHash(tileData):
+		return hashlib.blake2b(tileData, digest_size=16).hexdigest()
+
+	@staticmethod
+	def prepare(storePath):
+
+		key = os.path.abspath(storePath)
+
+		with TileValidators.preparedLock:
+			if key in TileValidators.prepared:
+				return
+
+			directory = os.path.dirname(storePath)
+			if directory:
+				os.makedirs(directory, exist_ok=True)
+
+			database = SqlitePool.get(storePath)
+			with database.lock:
+				connection = database.writeConnection()
+				TileValidators.createTable(connection)
+				connection.commit()
+
+			TileValidators.prepared.add(key)
+
+	@staticmethod
+	def createTable(connection):
+		connection.execute("CREATE TABLE IF NOT EXISTS tile_validators (zoom_level integer, tile_column integer, tile_row integer, etag text, last_modified text, content_hash text);")
+		connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_validators_index ON tile_validators (zoom_level, tile_column, tile_row);")
+
+	@staticmethod
+	def get(storePath, x, y, z):
+		"""Return (etag, lastModified, contentHash) or None."""
+
+		if not os.path.exists(storePath):
+			return None
+
+		TileValidators.prepare(storePath)
+
+		c = SqlitePool.get(storePath).readConnection().cursor()
+		c.execute("SELECT etag, last_modified, content_hash FROM tile_validators WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (z, x, (2 ** z) - y - 1))
+
+		return c.fetchone()
+
+	@staticmethod
+	def put(storePath, x, y, z, validators, contentHash):
+
+		TileValidators.prepare(storePath)
+
+		invertedY = (2 ** z) - y - 1
+		BatchWriter.get(storePath, TileValidators.insertQuery).put((z, x, invertedY, validators.get("etag"), validators.get("lastModified"), contentHash))
+
+	@staticmethod
+	def flush(storePath):
+		# returns the rows failed batches dropped
+		return BatchWriter.flushFile(storePath)
+
+	@staticmethod
+	def merge(storePath, sourcePath):
+		"""Copy the rows of another store into storePath, replacing those of the same tiles."""
+
+		TileValidators.prepare(storePath)
+
+		database = SqlitePool.get(storePath)
+		with database.lock:
+			connection = database.writeConnection()
+			connection.execute("ATTACH DATABASE ? AS source", (sourcePath,))
+			try:
+				if connection.execute("SELECT COUNT(*) FROM source.sqlite_master WHERE name = 'tile_validators'").fetchone()[0]:
+					connection.execute("INSERT OR REPLACE INTO tile_validators (zoom_level, tile_column, tile_row, etag, last_modified, content_hash) SELECT zoom_level, tile_column, tile_row, etag, last_modified, content_hash FROM source.tile_validators;")
+					connection.commit()
+			finally:
+				connection.execute("DETACH DATABASE source")
+
+	@staticmethod
+	def close(storePath):
+
+		BatchWriter.close(storePath)
+		SqlitePool.close(storePath)
+
+		with TileValidators.preparedLock:
+			TileValidators.prepared.discard(os.path.abspath(storePath))
@@ -0,0 +1,166 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from file_writer import FileWriter
+from sqlite_pool import SqlitePool
+from tile_template import TileTemplate
+from tile_validators import TileValidators
+
+class Tilesets:
+	"""Read-only access to finished (or running) outputs under output/<name>,
+	for serving them as XYZ tiles and TileJSON.
+
+	MBTiles and repo files are read through pooled read-only SQLite
+	connections, directory outputs straight from the files, so serving does
+	not take the download lock.
+	"""
+
+	root = "output"
+	reloadAfter = 5.0
+
+	tileQueries = {
+		"mbtiles": "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+		"repo": "SELECT tile_cropped_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+	}
+
+	contentTypes = {
+		"png": "image/png",
+		"jpg": "image/jpeg",
+		"jpeg": "image/jpeg",
+		"webp": "image/webp",
+		"pbf": "application/x-protobuf",
+	}
+
+	entries = {}
+	entriesLock = threading.Lock()
+
+	@staticmethod
+	def get(name):
+		"""Return the tileset dict for output/<name>, or None if there is none."""
+
+		# a single path component, so requests cannot leave the output root
+		if not name or name.startswith(".") or "/" in name or "\\" in name:
+			return None
+
+		now = time.monotonic()
+
+		with Tilesets.entriesLock:
+			tileset = Tilesets.entries.get(name)
+			if tileset is not None and now - tileset["loaded"] < Tilesets.reloadAfter:
+				return tileset
+
+		tileset = Tilesets.load(os.path.join(Tilesets.root, name))
+
+		with Tilesets.entriesLock:
+			if tileset is None:
+				Tilesets.entries.pop(name, None)
+			else:
+				tileset["name"] = name
+				tileset["loaded"] = now
+				Tilesets.entries[name] = tileset
+
+		return tileset
+
+	@staticmethod
+	def load(directory):
+
+		if not os.path.isdir(directory):
+			return None
+
+		names = sorted(os.listdir(directory))
+		mbtiles = [name for name in names if name.endswith(".mbtiles")]
+		repos = [name for name in names if name.endswith(".repo")]
+
+		if mbtiles or repos:
+			outputType = "mbtiles" if mbtiles else "repo"
+			filePath = os.path.join(directory, (mbtiles or repos)[0])
+
+			try:
+				with SqlitePool.get(filePath).reader() as connection:
+					metadata = dict(connection.execute("SELECT name, value FROM metadata").fetchall())
+			except sqlite3.Error:
+				return None
+
+			return {"outputType": outputType, "filePath": filePath, "metadata": metadata}
+
+		metadataPath = os.path.join(directory, "metadata.json")
+		if not os.path.isfile(metadataPath):
+			return None
+
+		try:
+			with open(metadataPath, "r", encoding="utf-8") as jsonFile:
+				metadata = json.load(jsonFile)
+		except (OSError, ValueError):
+			return None
+
+		outputFile = metadata.get("output_file") or "{z}/{x}/{y}.png"
+
+		return {"outputType": "directory", "directory": directory, "template": TileTemplate.compile(outputFile), "metadata": metadata}
+
+	@staticmethod
+	def readTile(tileset, x, y, z):
+
+		if tileset["outputType"] == "directory":
+			return FileWriter.readTile(os.path.join(tileset["directory"], tileset["template"].render(x, y, z)), x, y, z)
+
+		invertedY = (2 ** z) - y - 1
+
+		with SqlitePool.get(tileset["filePath"]).reader() as connection:
+			row = connection.execute(Tilesets.tileQueries[tileset["outputType"]], (z, x, invertedY)).fetchone()
+
+		return bytes(row[0]) if row and row[0] is not None else None
+
+	@staticmethod
+	def etag(tileData):
+		return '"' + TileValidators.contentHash(tileData) + '"'
+
+	@staticmethod
+	def contentType(tileData, format=None):
+
+		# the stored format is not always right, so trust the bytes first
+		if tileData.startswith(b"\x89PNG"):
+			return "image/png"
+		if tileData.startswith(b"\xff\xd8"):
+			return "image/jpeg"
+		if tileData[:4] == b"RIFF" and tileData[8:12] == b"WEBP":
+			return "image/webp"
+
+		return Tilesets.contentTypes.get(str(format or "").lower(), "application/octet-stream")
+
+	@staticmethod
+	def tileJSON(tileset, baseUrl):
+
+		metadata = tileset["metadata"]
+		format = metadata.get("format") or "png"
+
+		def numbers(value):
+			try:
+				return [float(part) for part in str(value).split(",")]
+			except ValueError:
+				return None
+
+		result = {
+			"tilejson": "3.0.0",
+			"name": metadata.get("name") or tileset["name"],
+			"description": metadata.get("description"),
+			"attribution": metadata.get("attribution"),
+			"scheme": "xyz",
+			"format": format,
+			"tiles": [baseUrl + "/tiles/" + tileset["name"] + "/{z}/{x}/{y}." + format],
+		}
+
+		if metadata.get("minzoom") is not None:
+			result["minzoom"] = int(metadata["minzoom"])
+		if metadata.get("maxzoom") is not None:
+			result["maxzoom"] = int(metadata["maxzoom"])
+		if metadata.get("bounds"):
+			result["bounds"] = numbers(metadata["bounds"])
+		if metadata.get("center"):
+			result["center"] = numbers(metadata["center"])
+		if metadata.get("tilesize"):
+			result["tileSize"] = int(metadata["tilesize"])
+
+		return result
@@ -0,0 +1,123 @@
+import io
+import re
+
+from PIL import Image
+
+class Transcoder:
+	"""Re-encodes downloaded tiles before they reach the writer.
+
+	Instances only hold options, so they pickle cheaply and encode() can run on
+	a process pool, away from the download threads.
+	"""
+
+	formats = ("png", "jpg", "webp")
+
+	pillowFormats = {
+		"png": "PNG",
+		"jpg": "JPEG",
+		"webp": "WEBP",
+	}
+
+	urlFormatPattern = re.compile(r"(?:\.|format=|fmt=)(png|jpe?g|webp)\b", re.IGNORECASE)
+
+	def __init__(self, format, quality=None, colors=None, lossless=False):
+
+		format = Transcoder.normalizeFormat(format)
+		if format not in Transcoder.formats:
+			raise ValueError("Unknown tile format " + str(format))
+
+		if colors is not None and not 2 <= colors <= 256:
+			raise ValueError("Palette colors must be between 2 and 256")
+
+		if quality is not None and not 1 <= quality <= 100:
+			raise ValueError("Quality must be between 1 and 100")
+
+		self.format = format
+		self.quality = quality
+		self.colors = colors if format == "png" else None
+		self.lossless = lossless
+
+	@staticmethod
+	def normalizeFormat(format):
+		format = str(format or "").lower()
+		return "jpg" if format == "jpeg" else format
+
+	@staticmethod
+	def detectFormat(tileData):
+
+		if tileData.startswith(b"\x89PNG"):
+			return "png"
+		if tileData.startswith(b"\xff\xd8"):
+			return "jpg"
+		if tileData[:4] == b"RIFF" and tileData[8:12] == b"WEBP":
+			return "webp"
+
+		return None
+
+	@staticmethod
+	def formatFromUrl(url):
+		# the provider's extension or format parameter; most sources serve PNG otherwise
+		matches = Transcoder.urlFormatPattern.findall(url or "")
+		return Transcoder.normalizeFormat(matches[-1]) if matches else "png"
+
+	@staticmethod
+	def outputFormat(source, outputScale, transcoder=None):
+		"""The format to record in the tileset metadata."""
+
+		if transcoder is not None:
+			return transcoder.format
+
+		# stitched tiles are always saved as PNG
+		if outputScale > 1:
+			return "png"
+
+		return Transcoder.formatFromUrl(source)
+
+	def encode(self, tileData):
+
+		if tileData is None:
+			return None
+
+		sourceFormat = Transcoder.detectFormat(tileData)
+
+		image = Image.open(io.BytesIO(tileData))
+		image.load()
+
+		hasAlpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+
+		options = {}
+
+		if self.format == "jpg":
+			if hasAlpha:
+				# JPEG has no alpha; transparent areas become white
+				background = Image.new("RGB", image.size, (255, 255, 255))
+				background.paste(image.convert("RGBA"), mask=image.convert("RGBA").getchannel("A"))
+				image = background
+			elif image.mode != "RGB":
+				image = image.convert("RGB")
+			options = {"quality": self.quality or 85, "optimize": True}
+
+		elif self.format == "webp":
+			image = image.convert("RGBA" if hasAlpha else "RGB")
+			if self.lossless:
+				options = {"lossless": True, "quality": self.quality or 80, "method": 4}
+			else:
+				options = {"quality": self.quality or 80, "method": 4}
+
+		else:
+			if self.colors:
+				image = image.convert("RGBA" if hasAlpha else "RGB")
+				# median cut cannot quantize RGBA images
+				method = Image.FASTOCTREE if hasAlpha else Image.MEDIANCUT
+				image = image.quantize(colors=self.colors, method=method)
+			options = {"optimize": True}
+
+		output = io.BytesIO()
+		image.save(output, Transcoder.pillowFormats[self.format], **options)
+		encoded = output.getvalue()
+
+		# re-encoding an already compact tile in its own format can grow it
+		if sourceFormat == self.format and not self.colors and len(encoded) >= len(tileData):
+			return tileData
+
+		return encoded
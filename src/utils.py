@@ -20,17 +20,30 @@ import glob
 import os
 import base64
 import math
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image
 
+from http_pool import HttpPool
+from rate_limiter import RateLimiter
+from tile_template import TileTemplate
+from tile_cache import TileCache
+from blank_tiles import BlankTiles
+
 class Utils:
-	
+
+	childThreads = 32
+	childExecutor = None
+	childExecutorLock = threading.Lock()
+
 	@staticmethod
 	def randomString():
 		return uuid.uuid4().hex.upper()[0:6]
 
 	@staticmethod
-	def build_request(url):
+	def build_headers(url):
 		# Use a browser-like header to avoid 403 blocks from providers like Google
 		headers = {
 			"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0 Safari/537.36",
@@ -42,12 +55,16 @@ class Utils:
 		if "google" in url.lower():
 			headers["Referer"] = "https://www.google.com/maps"
 
-		return urllib.request.Request(url, headers=headers)
+		return headers
+
+	@staticmethod
+	def build_request(url):
+		return urllib.request.Request(url, headers=Utils.build_headers(url))
 
 	@staticmethod
 	def open_url(url):
 		request = Utils.build_request(url)
-		return urllib.request.urlopen(request, context=ssl._create_unverified_context())
+		return HttpPool.open(request)
 
 	def getChildTiles(x, y, z):
 		childX = x * 2
@@ -61,18 +78,19 @@ class Utils:
 			(childX, childY+1, childZ),
 		]
 
+	@staticmethod
+	def getChildGrid(x, y, z, scale):
+		# row-major children of (x, y, z) that make up one tile at a power-of-two scale
+		levels = scale.bit_length() - 1
+
+		return [(x * scale + column, y * scale + row, z + levels) for row in range(scale) for column in range(scale)]
+
+	@staticmethod
+	def isValidScale(scale):
+		return scale >= 1 and (scale & (scale - 1)) == 0
+
 	def makeQuadKey(tile_x, tile_y, level):
-		quadkey = ""
-		for i in range(level):
-			bit = level - i
-			digit = ord('0')
-			mask = 1 << (bit - 1)  # if (bit - 1) > 0 else 1 >> (bit - 1)
-			if (tile_x & mask) != 0:
-				digit += 1
-			if (tile_y & mask) != 0:
-				digit += 2
-			quadkey += chr(digit)
-		return quadkey
+		return TileTemplate.quadKey(tile_x, tile_y, level)
 
 	@staticmethod
 	def num2deg(xtile, ytile, zoom):
@@ -83,23 +101,22 @@ class Utils:
 		return (lat_deg, lon_deg)
 
 	@staticmethod
-	def qualifyURL(url, x, y, z):
+	def expandShards(url):
+		"""Return the URL once per shard, or just the URL when it has no {s}/{switch:...}."""
 
-		scale22 = 23 - (z * 2)
+		template = TileTemplate.compile(url)
+		if not template.shards:
+			return [url]
 
-		replaceMap = {
-			"x": str(x),
-			"y": str(y),
-			"z": str(z),
-			"scale:22": str(scale22),
-			"quad": Utils.makeQuadKey(x, y, z),
-		}
+		return ["".join(shard if field == "shard" else text for text, field in template.parts) for shard in template.shards]
 
-		for key, value in replaceMap.items():
-			newKey = str("{" + str(key) + "}")
-			url = url.replace(newKey, value)
+	@staticmethod
+	def sourceHosts(url):
+		return [urlparse(shard).netloc for shard in Utils.expandShards(url)]
 
-		return url
+	@staticmethod
+	def qualifyURL(url, x, y, z):
+		return TileTemplate.compile(url).render(x, y, z)
 
 	@staticmethod
 	def mergeQuadTile(quadTiles):
@@ -116,7 +133,8 @@ class Utils:
 		if width == 0 or height == 0:
 			return None
 
-		canvas = Image.new('RGB', (width, height))
+		mode = 'RGBA' if any(tile is not None and Utils.hasAlpha(tile) for tile in quadTiles) else 'RGB'
+		canvas = Image.new(mode, (width, height))
 
 		if quadTiles[0] is not None:
 			canvas.paste(quadTiles[0], box=(0,0))
@@ -133,66 +151,232 @@ class Utils:
 		return canvas
 
 	@staticmethod
-	def downloadFile(url, destination, x, y, z):
+	def hasAlpha(image):
+		return image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+
+	@staticmethod
+	def mergeTileGrid(childImages, scale):
+
+		present = [image for image in childImages if image is not None]
+		width, height = present[0].size
+		# cells without imagery stay transparent
+		mode = 'RGBA' if len(present) < len(childImages) or any(Utils.hasAlpha(image) for image in present) else 'RGB'
+
+		canvas = Image.new(mode, (width * scale, height * scale))
+
+		for index, image in enumerate(childImages):
+			if image is not None:
+				row, column = divmod(index, scale)
+				canvas.paste(image, box=(column * width, row * height))
+
+		return canvas
+
+	@staticmethod
+	def mergeTileGridData(childData, scale):
+
+		childImages = [Image.open(io.BytesIO(data)) if data is not None else None for data in childData]
+		canvas = Utils.mergeTileGrid(childImages, scale)
+
+		output = io.BytesIO()
+		canvas.save(output, "PNG")
+
+		return output.getvalue()
+
+	@staticmethod
+	def downsampleTileData(childData):
+		"""Build a tile from its four row-major children, any of which may be None."""
+
+		childImages = [Image.open(io.BytesIO(data)) if data is not None else None for data in childData]
+		present = [image for image in childImages if image is not None]
+
+		if not present:
+			return None
+
+		width, height = present[0].size
+		# missing children stay transparent instead of turning black
+		mode = 'RGBA' if len(present) < 4 or any(Utils.hasAlpha(image) for image in present) else 'RGB'
+
+		canvas = Image.new(mode, (width * 2, height * 2))
+
+		for index, image in enumerate(childImages):
+			if image is not None:
+				row, column = divmod(index, 2)
+				canvas.paste(image, box=(column * width, row * height))
+
+		output = io.BytesIO()
+		canvas.resize((width, height), Image.LANCZOS).save(output, "PNG")
+
+		return output.getvalue()
+
+	@staticmethod
+	def getChildExecutor():
+
+		with Utils.childExecutorLock:
+			if Utils.childExecutor is None:
+				Utils.childExecutor = ThreadPoolExecutor(max_workers=Utils.childThreads, thread_name_prefix="child-tiles")
+
+		return Utils.childExecutor
+
+	@staticmethod
+	def makeThumbnail(data, size=64):
+
+		output = io.BytesIO()
+
+		try:
+			image = Image.open(io.BytesIO(data))
+			image.thumbnail((size, size))
+			image.save(output, "PNG")
+		except Exception:
+			return None
+
+		return base64.b64encode(output.getvalue()).decode("utf-8")
+
+	@staticmethod
+	def downloadTile(url, x, y, z):
+		code, data, _ = Utils.downloadTileConditional(url, x, y, z)
+		return (code, data)
+
+	@staticmethod
+	def responseValidators(headers):
+		if headers is None:
+			return {}
+		return {"etag": headers.get("ETag"), "lastModified": headers.get("Last-Modified")}
+
+	@staticmethod
+	def downloadTileConditional(url, x, y, z, etag=None, lastModified=None):
+		"""Like downloadTile, but sends If-None-Match/If-Modified-Since and also
+		returns the response's validators. A 304 comes back as (304, None, validators),
+		a known placeholder of the source as (204, None, validators).
+		Unconditional requests are answered from the tile cache when it has the URL."""
 
 		url = Utils.qualifyURL(url, x, y, z)
 
+		if not etag and not lastModified:
+			cached = TileCache.get(url)
+			if cached is not None:
+				if BlankTiles.isPlaceholder(url, cached["data"]):
+					return (204, None, cached["validators"])
+				return (200, cached["data"], cached["validators"])
+
+		headers = Utils.build_headers(url)
+		if etag:
+			headers["If-None-Match"] = etag
+		if lastModified:
+			headers["If-Modified-Since"] = lastModified
+
 		code = 0
+		retryAfter = None
+		validators = {}
+
+		limiter = RateLimiter.forUrl(url)
+		started = limiter.acquire()
 
 		try:
-			with Utils.open_url(url) as response:
+			with HttpPool.open(urllib.request.Request(url, headers=headers)) as response:
 				code = response.getcode()
+				validators = Utils.responseValidators(response.headers)
+				# reading the (empty) body of a 304 lets the connection be reused
+				data = response.read()
+
 				if code != 200:
-					return code
+					return (code, None, validators)
 
-				directory = os.path.dirname(destination)
-				if directory != "":
-					os.makedirs(directory, exist_ok=True)
+				# "no imagery" placeholders are a miss, not a tile
+				if BlankTiles.isPlaceholder(url, data):
+					return (204, None, validators)
 
-				with open(destination, "wb") as out_file:
-					out_file.write(response.read())
+				return (code, data, validators)
 		except urllib.error.HTTPError as e:
 			code = e.code
+			validators = Utils.responseValidators(e.headers)
+			if e.headers is not None:
+				retryAfter = RateLimiter.parseRetryAfter(e.headers.get("Retry-After"))
 		except urllib.error.URLError as e:
 			print(e)
 			code = -1
+		finally:
+			limiter.release(started, code, retryAfter)
 
-		return code
+		return (code, None, validators)
 
+	@staticmethod
+	def proxyTile(url):
+		"""Return the cache entry for a qualified tile URL, fetching and caching it on a miss."""
+
+		cached = TileCache.get(url)
+		if cached is not None:
+			return cached
+
+		with Utils.open_url(url) as response:
+			data = response.read()
+			contentType = response.headers.get_content_type() or "image/png"
+			validators = Utils.responseValidators(response.headers)
+
+		entry = TileCache.put(url, data, contentType, validators)
+		if entry is None:
+			entry = {"data": data, "contentType": contentType, "etag": None, "validators": validators}
+
+		return entry
 
 	@staticmethod
-	def downloadFileScaled(url, destination, x, y, z, outputScale):
+	def downloadTileScaled(url, x, y, z, outputScale):
 
 		if outputScale == 1:
-			return Utils.downloadFile(url, destination, x, y, z)
+			return Utils.downloadTile(url, x, y, z)
+
+		if not Utils.isValidScale(outputScale):
+			return (0, None)
+
+		# children are fetched concurrently on a separate pool so callers that are
+		# themselves pool workers never wait on their own executor
+		childTiles = Utils.getChildGrid(x, y, z, outputScale)
+		executor = Utils.getChildExecutor()
+		futures = [executor.submit(Utils.downloadTile, url, childX, childY, childZ) for childX, childY, childZ in childTiles]
+
+		childData = []
+		failedCode = None
+
+		for future in futures:
+			code, data = future.result()
+			# a placeholder child (204) is an empty cell, not a failure
+			if code not in (200, 204) and failedCode is None:
+				failedCode = code
+			childData.append(data if code == 200 else None)
 
-		elif outputScale == 2:
+		if failedCode is not None:
+			return (failedCode, None)
 
-			childTiles = Utils.getChildTiles(x, y, z)
-			childImages = []
+		if all(data is None for data in childData):
+			return (204, None)
 
-			for childX, childY, childZ in childTiles:
-				
-				tempFile = Utils.randomString() + ".png"
-				tempFilePath = os.path.join("temp", tempFile)
+		return (200, Utils.mergeTileGridData(childData, outputScale))
 
-				code = Utils.downloadFile(url, tempFilePath, childX, childY, childZ)
+	@staticmethod
+	def writeTile(destination, data):
+
+		directory = os.path.dirname(destination)
+		if directory != "":
+			os.makedirs(directory, exist_ok=True)
+
+		with open(destination, "wb") as out_file:
+			out_file.write(data)
+
+	@staticmethod
+	def downloadFile(url, destination, x, y, z):
 
-				if code == 200:
-					image = Image.open(tempFilePath)
-				else:
-					return code
+		code, data = Utils.downloadTile(url, x, y, z)
 
-				childImages.append(image)
-			
-			canvas = Utils.mergeQuadTile(childImages)
-			canvas.save(destination, "PNG")
-			
-			return 200
+		if data is not None:
+			Utils.writeTile(destination, data)
 
-		#TODO implement custom scale
+		return code
 
-			
+	@staticmethod
+	def downloadFileScaled(url, destination, x, y, z, outputScale):
 
+		code, data = Utils.downloadTileScaled(url, x, y, z, outputScale)
 
+		if data is not None:
+			Utils.writeTile(destination, data)
 
+		return code